@@ -0,0 +1,89 @@
+"""
+Concurrent inbound messages to one DistributedAgent from many peers.
+
+"shared" replays the previous handling: every message runs on the agent's single working memory.
+"sessions" goes through on_message, with one memory per peer and admission control. The model is
+a stub that answers after --latency seconds. A leak is a prompt that carries another peer's
+history.
+
+    python benchmarks/bench_agent_concurrency.py --peers 32 --messages 4 --max-concurrency 8
+"""
+import argparse
+import os
+import re
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from isek.agent.distributed_agent import DistributedAgent
+from isek.constant.exceptions import AgentBusyError
+from isek.util.logger import LoggerManager
+
+
+class StubModel(object):
+    def __init__(self, latency):
+        self.latency = latency
+        self.leaks = 0
+        self.lock = threading.Lock()
+
+    def create(self, messages, systems=None, tool_schemas=None):
+        prompt = messages[0]["content"]
+        peers = set(re.findall(r"User:(peer-\d+)/", prompt))
+        if len(peers) > 1:
+            with self.lock:
+                self.leaks += 1
+        time.sleep(self.latency)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="ok", tool_calls=None))])
+
+
+def run(mode, args):
+    model = StubModel(args.latency)
+    agent = DistributedAgent(model=model, max_concurrency=args.max_concurrency, max_queue=args.max_queue,
+                             queue_timeout=args.queue_timeout)
+    latencies, rejected = [], [0]
+
+    def peer(p):
+        for i in range(args.messages):
+            message = f"peer-{p}/{i}"
+            start = time.perf_counter()
+            try:
+                if mode == "shared":
+                    agent.run(message)
+                else:
+                    agent.on_message(f"peer-{p}", message)
+                latencies.append(time.perf_counter() - start)
+            except AgentBusyError:
+                rejected[0] += 1
+
+    begin = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.peers) as executor:
+        list(executor.map(peer, range(args.peers)))
+    elapsed = time.perf_counter() - begin
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0
+    print(f"{mode:>8}: {len(latencies) / elapsed:7.1f} msg/s  p50 {statistics.median(latencies or [0]):6.2f}s  "
+          f"p99 {p99:6.2f}s  leaked prompts {model.leaks:>4}  rejected {rejected[0]:>4}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--peers", type=int, default=32)
+    parser.add_argument("--messages", type=int, default=4, help="messages per peer")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per model call")
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    parser.add_argument("--max-queue", type=int, default=32)
+    parser.add_argument("--queue-timeout", type=float, default=30)
+    args = parser.parse_args()
+
+    LoggerManager.init(debug=False)
+    for mode in ("shared", "sessions"):
+        run(mode, args)
+
+
+if __name__ == "__main__":
+    main()
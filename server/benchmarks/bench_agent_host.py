@@ -0,0 +1,97 @@
+"""
+Resources taken by many agents in one process: each agent with its own gRPC server, port and p2p
+sidecar through build_server ("standalone"), against all of them in one AgentHost ("hosted").
+The agents echo messages, no model is involved. Needs node, the p2p-server dependencies and the relay.
+
+    python benchmarks/bench_agent_host.py --agents 10 100 300
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from isek.node.agent_host import AgentHost
+from isek.node.p2p_node import P2PNode
+from isek.util.logger import LoggerManager
+
+
+class EchoNode(P2PNode):
+    def __init__(self, name, **kwargs):
+        self.name = name
+        super().__init__(**kwargs)
+
+    def build_node_id(self):
+        return self.name
+
+    def metadata(self):
+        return {"name": self.name, "intro": f"echo agent {self.name}"}
+
+    def on_message(self, sender, message):
+        return message
+
+
+def wait_until(predicate, timeout):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.05)
+
+
+def run(mode, agents, base_port, timeout):
+    """gRPC ports from base_port, sidecar ports from base_port + 500, up to 500 agents."""
+    threads_before = threading.active_count()
+    begin = time.perf_counter()
+    if mode == "standalone":
+        nodes = [EchoNode(f"agent-{i}", port=base_port + i, p2p_server_port=base_port + 500 + i,
+                          p2p_startup_timeout=timeout)
+                 for i in range(agents)]
+        for node in nodes:
+            threading.Thread(target=node.build_server, daemon=True).start()
+        wait_until(lambda: all(node.membership is not None for node in nodes), timeout)
+        host = None
+    else:
+        host = AgentHost(port=base_port, p2p_server_port=base_port + 500, p2p_startup_timeout=timeout)
+        nodes = [EchoNode(f"agent-{i}") for i in range(agents)]
+        for node in nodes:
+            host.add(node)
+        host.start()
+    elapsed = time.perf_counter() - begin
+    # let the joins settle before counting threads
+    time.sleep(1)
+
+    ports = len({node.port for node in nodes})
+    sidecars = {id(node.p2p_sidecar): node.p2p_sidecar for node in nodes}
+    threads = threading.active_count() - threads_before
+    print(f"{agents:>4} agents {mode:>10}: ready in {elapsed:6.2f}s, {ports:>4} gRPC ports, "
+          f"{len(sidecars):>4} sidecar processes, {threads:>5} threads")
+
+    if host is not None:
+        host.stop()
+    else:
+        for node in nodes:
+            if node.membership is not None:
+                node.membership.stop()
+        for sidecar in sidecars.values():
+            sidecar.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--agents", type=int, nargs="+", default=[10, 100, 300])
+    parser.add_argument("--port", type=int, default=45000)
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    LoggerManager.init(debug=False)
+    # standalone servers keep their ports until exit, every run gets its own range
+    base_port = args.port
+    for agents in args.agents:
+        for mode in ("standalone", "hosted"):
+            run(mode, agents, base_port, args.timeout)
+            base_port += 1000
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Report recall@k and QPS of the NodeIndex ANN index types against the exact flat baseline.
+
+Vectors are synthetic: Gaussian clusters, roughly like intros grouped by topic.
+
+    python benchmarks/bench_ann_index.py --sizes 10000 100000 1000000 --dim 384 --k 20
+"""
+import argparse
+import os
+import sys
+import time
+
+import faiss
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from isek.node.ann_index import DEFAULT_INDEX_PARAMS, INDEX_TYPES, build_ann_index
+
+
+def synthetic_vectors(size, dim, clusters, rng):
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, size)
+    vectors = centers[labels] + 0.3 * rng.standard_normal((size, dim)).astype(np.float32)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def run(index, queries, k):
+    start = time.perf_counter()
+    _, ids = index.search(queries, k)
+    return ids, len(queries) / (time.perf_counter() - start)
+
+
+def recall_at_k(ids, truth):
+    hits = sum(len(set(row) & set(true_row)) for row, true_row in zip(ids, truth))
+    return hits / truth.size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print(f"{'size':>9} {'index':>9} {'build s':>9} {'recall@k':>9} {'QPS':>10}")
+    for size in args.sizes:
+        vectors = synthetic_vectors(size, args.dim, max(16, size // 1000), rng)
+        queries = vectors[rng.choice(size, args.queries, replace=False)] \
+            + 0.1 * rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        faiss.normalize_L2(queries)
+        ids = np.arange(size, dtype=np.int64)
+        truth = None
+        for index_type in INDEX_TYPES:
+            start = time.perf_counter()
+            built_type, index = build_ann_index(index_type, args.dim, vectors, ids, DEFAULT_INDEX_PARAMS)
+            build_seconds = time.perf_counter() - start
+            result, qps = run(index, queries, args.k)
+            if truth is None:
+                truth = result
+            print(f"{size:>9} {built_type:>9} {build_seconds:>9.2f} {recall_at_k(result, truth):>9.3f} {qps:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
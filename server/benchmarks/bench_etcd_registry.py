@@ -0,0 +1,83 @@
+"""
+Measure etcd request load of node heartbeats against a local etcd.
+
+"legacy" replays the previous per-node heartbeat: a full get_prefix scan, a get plus ECDSA
+re-sign for signature verification and a unary lease refresh for every node every interval.
+"current" runs the same nodes through EtcdRegistry, which serves the node list from its watch
+cache, skips verification of unchanged entries and renews all leases over one keepalive stream.
+Load is read from etcd's own metrics (grpc_server_msg_received_total).
+
+    etcd &   # listening on localhost:2379
+    python benchmarks/bench_etcd_registry.py --nodes 50 --seconds 30
+"""
+import argparse
+import os
+import sys
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import etcd3
+
+from isek.node.etcd_registry import EtcdRegistry
+from isek.node.registry import DEFAULT_SHARD
+from isek.util.logger import LoggerManager
+
+
+def received_messages(metrics_url):
+    total = 0.0
+    with urllib.request.urlopen(metrics_url) as response:
+        for line in response.read().decode().splitlines():
+            if line.startswith("grpc_server_msg_received_total"):
+                total += float(line.rsplit(" ", 1)[1])
+    return total
+
+
+def run_heartbeats(registry, node_ids, seconds, interval, legacy):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        for node_id in node_ids:
+            if legacy:
+                entry, _ = registry.etcd_client.get(f"/{registry.parent_node_id}/{DEFAULT_SHARD}/{node_id}")
+                registry.sk.sign_deterministic(entry)
+                registry.leases[node_id].refresh()
+                list(registry.etcd_client.get_prefix(f"/{registry.parent_node_id}/"))
+            else:
+                registry.lease_refresh(node_id)
+                registry.get_available_nodes()
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=2379)
+    parser.add_argument("--nodes", type=int, default=50)
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--interval", type=float, default=5)
+    args = parser.parse_args()
+
+    LoggerManager.init(debug=False)
+    metrics_url = f"http://{args.host}:{args.port}/metrics"
+    for mode in ("legacy", "current"):
+        registry = EtcdRegistry(etcd_client=etcd3.client(host=args.host, port=args.port),
+                                parent_node_id=f"bench-{mode}-{int(time.time())}")
+        node_ids = [f"node-{i}" for i in range(args.nodes)]
+        for i, node_id in enumerate(node_ids):
+            registry.register_node(node_id, "localhost", 10000 + i, metadata={"intro": f"bench node {i}"})
+        registry.get_available_nodes()
+
+        before = received_messages(metrics_url)
+        start = time.time()
+        run_heartbeats(registry, node_ids, args.seconds, args.interval, legacy=(mode == "legacy"))
+        elapsed = time.time() - start
+        qps = (received_messages(metrics_url) - before) / elapsed
+        print(f"{mode:>8}: {args.nodes} nodes, {qps:8.1f} etcd requests/s")
+
+        for node_id in node_ids:
+            registry.deregister_node(node_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Simulate GossipMembership on an in-process network: protocol rounds until every node knows every
+other after all join at once through one seed, rounds until one more node joining later is known
+everywhere, rounds until a crashed node is declared dead everywhere, and messages per node per round.
+
+    python benchmarks/bench_gossip_membership.py --sizes 16 64 256
+"""
+import argparse
+import math
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from isek.node.gossip import GossipMembership
+from isek.util.logger import LoggerManager
+
+
+class Network(object):
+    def __init__(self):
+        self.nodes = {}
+        self.down = set()
+        self.messages = 0
+
+    def send(self, address, message, timeout):
+        self.messages += 1
+        if address in self.down or address not in self.nodes:
+            raise ConnectionError(address)
+        return self.nodes[address].handle(message)
+
+
+def run_round(nodes, network):
+    for address, membership in list(nodes.items()):
+        if address not in network.down:
+            membership.probe()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16, 64, 256])
+    parser.add_argument("--max-rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    LoggerManager.init(debug=False)
+    print(f"{'nodes':>6} {'log2 N':>7} {'bootstrap':>10} {'join rounds':>12} {'detect rounds':>14} "
+          f"{'msgs/node/round':>16}")
+    for size in args.sizes:
+        network = Network()
+        addresses = [f"/p2p/node-{i}" for i in range(size)]
+        for i, address in enumerate(addresses):
+            # Everyone joins through node-0, the rest of the membership spreads by gossip.
+            membership = GossipMembership({"node_id": f"node-{i}", "p2p_address": address},
+                                          send=network.send, seeds=addresses[:1] if i else [],
+                                          protocol_interval=1.0)
+            network.nodes[address] = membership
+            membership.join(membership.seeds)
+
+        bootstrap_rounds = 0
+        while bootstrap_rounds < args.max_rounds and any(len(m.nodes()) < size - 1
+                                                         for m in network.nodes.values()):
+            run_round(network.nodes, network)
+            bootstrap_rounds += 1
+
+        late = GossipMembership({"node_id": "late-node", "p2p_address": "/p2p/late-node"},
+                                send=network.send, seeds=addresses[:1], protocol_interval=1.0)
+        network.nodes["/p2p/late-node"] = late
+        late.join(late.seeds)
+        join_rounds = 0
+        network.messages = 0
+        while join_rounds < args.max_rounds and any("late-node" not in m.nodes()
+                                                    for m in network.nodes.values() if m is not late):
+            run_round(network.nodes, network)
+            join_rounds += 1
+        messages_per_round = network.messages / max(1, join_rounds) / len(network.nodes)
+
+        crashed = addresses[-1]
+        network.down.add(crashed)
+        alive = [m for address, m in network.nodes.items() if address != crashed]
+        detect_rounds = 0
+        while detect_rounds < args.max_rounds and any(f"node-{size - 1}" in m.nodes() for m in alive):
+            for membership in alive:
+                # Let suspicion timeouts elapse in simulated time, one protocol interval per round.
+                for member in membership.members.values():
+                    member["state_since"] -= membership.protocol_interval
+            run_round(network.nodes, network)
+            detect_rounds += 1
+        print(f"{size:>6} {math.log2(size):>7.1f} {bootstrap_rounds:>10} {join_rounds:>12} {detect_rounds:>14} "
+              f"{messages_per_round:>16.2f}")
+
+
+if __name__ == "__main__":
+    main()
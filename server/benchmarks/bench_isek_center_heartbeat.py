@@ -0,0 +1,57 @@
+"""
+Per-heartbeat latency and socket churn of isek center renewals: a new connection per request
+(module-level requests.post) against the pooled keep-alive session of IsekCenterRegistry.
+
+    cd isek && python bootstrap.py run registry &
+    python benchmarks/bench_isek_center_heartbeat.py --heartbeats 2000
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from isek.node.isek_center_registry import IsekCenterRegistry
+from isek.util.logger import LoggerManager
+
+
+def run(name, renew, heartbeats):
+    latencies = []
+    for _ in range(heartbeats):
+        start = time.perf_counter()
+        renew()
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"{name:>10}: mean {statistics.mean(latencies):7.3f} ms  p99 {p99:7.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8088)
+    parser.add_argument("--heartbeats", type=int, default=2000)
+    args = parser.parse_args()
+
+    LoggerManager.init(debug=False)
+    registry = IsekCenterRegistry(host=args.host, port=args.port)
+    registry.register_node("bench-heartbeat-node", "localhost", 10000)
+    renew_url = f"{registry.center_address}/isek_center/renew"
+
+    # A fresh connection per heartbeat, each leaves a socket in TIME_WAIT on the client.
+    run("per-call", lambda: requests.post(renew_url, json={"node_id": "bench-heartbeat-node"}), args.heartbeats)
+    # One keep-alive connection reused by every heartbeat.
+    run("pooled", lambda: registry.lease_refresh("bench-heartbeat-node"), args.heartbeats)
+    pools = registry.session.get_adapter(renew_url).poolmanager.pools
+    opened = sum(pools[key].num_connections for key in pools.keys())
+    print(f"{'sockets':>10}: per-call opened {args.heartbeats}, pooled opened {opened}")
+
+    registry.deregister_node("bench-heartbeat-node")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Load test of a running isek center: register, renew and list throughput with simulated nodes.
+
+    cd isek && python bootstrap.py run registry --server asgi --workers 4 &
+    python benchmarks/bench_isek_center_load.py --nodes 10000 --concurrency 64
+"""
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+thread_local = threading.local()
+
+
+def session():
+    if not hasattr(thread_local, "session"):
+        thread_local.session = requests.Session()
+    return thread_local.session
+
+
+def register(center, i):
+    return session().post(f"{center}/isek_center/register", json={
+        "node_id": f"load-node-{i}", "host": "10.0.0.1", "port": 20000 + i % 40000,
+        "metadata": {"name": f"load-node-{i}", "intro": f"simulated agent number {i}"}
+    }, timeout=30).status_code
+
+
+def renew(center, i):
+    return session().post(f"{center}/isek_center/renew", json={"node_id": f"load-node-{i}"}, timeout=30).status_code
+
+
+def list_nodes(center, _):
+    return session().get(f"{center}/isek_center/available_nodes", timeout=30).status_code
+
+
+def run(name, fn, center, count, concurrency):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        statuses = list(executor.map(lambda i: fn(center, i), range(count)))
+    elapsed = time.perf_counter() - start
+    errors = sum(1 for status in statuses if status != 200)
+    print(f"{name:>9}: {count:>6} requests in {elapsed:6.2f}s  {count / elapsed:9.1f} req/s  errors {errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--center", default="http://127.0.0.1:8088")
+    parser.add_argument("--nodes", type=int, default=10000)
+    parser.add_argument("--lists", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+
+    run("register", register, args.center, args.nodes, args.concurrency)
+    run("renew", renew, args.center, args.nodes, args.concurrency)
+    run("list", list_nodes, args.center, args.lists, args.concurrency)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Discovery cost of a flat isek center listing against shard-scoped listings, in-process on NodeTable.
+
+For each network size it reports what one agent downloads to list its peers (all nodes, or the
+nodes of its shard), the size of the shard summary used for routing, and how many of a round of
+`--churn` membership changes reach a watcher of all nodes against a watcher of one shard.
+
+    python benchmarks/bench_isek_center_shards.py --sizes 1000 10000 100000 --shards 100
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from isek.isek_center import NodeTable, dumps_bytes
+
+
+def node_info(i, shards):
+    return {
+        "node_id": f"node-{i}", "host": "10.0.0.1", "port": 20000 + i % 40000, "p2p_address": None,
+        "shard": f"shard-{i % shards}",
+        "metadata": {"name": f"node-{i}", "intro": f"simulated agent number {i}"}
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--shards", type=int, default=100)
+    parser.add_argument("--dim", type=int, default=64)
+    parser.add_argument("--churn", type=int, default=1000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    print(f"{'nodes':>8} {'flat list':>12} {'shard list':>12} {'summary':>10} "
+          f"{'flat delta':>11} {'shard delta':>12} {'shard list ms':>14}")
+    for size in args.sizes:
+        table = NodeTable()
+        for i in range(size):
+            table.register(node_info(i, args.shards), vector=[rng.gauss(0, 1) for _ in range(args.dim)])
+        flat_bytes = len(table.full_response()[1])
+        start = time.perf_counter()
+        shard_bytes = len(table.full_response(["shard-0"])[1])
+        shard_ms = (time.perf_counter() - start) * 1000
+        summary_bytes = len(dumps_bytes(table.shard_summaries()))
+
+        since_flat, since_shard = table.revision, table.scope_revision(["shard-0"])
+        for i in rng.sample(range(size), min(args.churn, size)):
+            info = node_info(i, args.shards)
+            info["metadata"]["intro"] += " (updated)"
+            table.register(info)
+        flat_delta = table.changes_since(since_flat)
+        shard_delta = table.changes_since(since_shard, ["shard-0"])
+        flat_changes = len(flat_delta["added"]) + len(flat_delta["changed"]) + len(flat_delta["removed"])
+        shard_changes = len(shard_delta["added"]) + len(shard_delta["changed"]) + len(shard_delta["removed"])
+        print(f"{size:>8} {flat_bytes:>12} {shard_bytes:>12} {summary_bytes:>10} "
+              f"{flat_changes:>11} {shard_changes:>12} {shard_ms:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
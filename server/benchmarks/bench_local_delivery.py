@@ -0,0 +1,96 @@
+"""
+Latency of one message hop between two nodes of the same process.
+
+"grpc" is the remote path: protobuf over a loopback gRPC channel to the receiver's server.
+"serialized" hands the message over in memory with the protobuf round trip kept, "direct" hands
+it over as is. The receiver echoes, no model is involved.
+
+    python benchmarks/bench_local_delivery.py --messages 2000
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from isek.node.node import Node
+from isek.node.registry import Registry
+from isek.util.logger import LoggerManager
+
+
+class MemoryRegistry(Registry):
+    def __init__(self):
+        super().__init__(watch_interval=0.1)
+        self.nodes = {}
+
+    def register_node(self, node_id, host, port, p2p_address=None, metadata=None, shard=None, vector=None):
+        self.nodes[node_id] = {"node_id": node_id, "host": host, "port": port, "metadata": metadata}
+
+    def get_available_nodes(self):
+        return dict(self.nodes)
+
+    def deregister_node(self, node_id):
+        self.nodes.pop(node_id, None)
+
+    def lease_refresh(self, node_id):
+        pass
+
+
+class EchoNode(Node):
+    def __init__(self, name, **kwargs):
+        self.name = name
+        super().__init__(**kwargs)
+
+    def build_node_id(self):
+        return self.name
+
+    def metadata(self):
+        return {"name": self.name, "intro": f"echo node {self.name}"}
+
+    def on_message(self, sender, message):
+        return message
+
+
+def measure(sender, receiver_id, messages, payload):
+    latencies = []
+    for _ in range(messages):
+        start = time.perf_counter()
+        sender.send_message(receiver_id, payload)
+        latencies.append((time.perf_counter() - start) * 1e6)
+    latencies.sort()
+    return statistics.mean(latencies), latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--payload", type=int, default=1024, help="message size in bytes")
+    parser.add_argument("--port", type=int, default=46000)
+    args = parser.parse_args()
+
+    LoggerManager.init(debug=False)
+    registry = MemoryRegistry()
+    receiver = EchoNode("receiver", port=args.port, registry=registry)
+    sender = EchoNode("sender", port=args.port + 1, registry=registry)
+    for node in (receiver, sender):
+        threading.Thread(target=node.build_server, daemon=True).start()
+    while "receiver" not in sender.all_nodes:
+        time.sleep(0.1)
+    time.sleep(0.5)
+
+    payload = "x" * args.payload
+    for mode, local_delivery, local_serialize in (("grpc", False, False),
+                                                  ("serialized", True, True),
+                                                  ("direct", True, False)):
+        sender.local_delivery = local_delivery
+        sender.local_serialize = local_serialize
+        measure(sender, "receiver", min(100, args.messages), payload)
+        mean, p50, p99 = measure(sender, "receiver", args.messages, payload)
+        print(f"{mode:>10}: mean {mean:8.1f} us  p50 {p50:8.1f} us  p99 {p99:8.1f} us")
+
+
+if __name__ == "__main__":
+    main()
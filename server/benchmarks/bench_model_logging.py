@@ -0,0 +1,85 @@
+"""
+Compare per-call CPU time and allocations of OpenAIModel.create logging on long conversations.
+
+The "eager" variant reproduces the previous behaviour (f-strings over the full messages and
+response built on every call); "lazy" is the current OpenAIModel.create. DEBUG is disabled in
+both, which is the production default.
+
+    python benchmarks/bench_model_logging.py --turns 200 --calls 500
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from isek.llm.openai_model import OpenAIModel
+from isek.util.logger import LoggerManager, logger
+
+
+class FakeCompletions:
+    def __init__(self, response):
+        self.response = response
+
+    def create(self, **kwargs):
+        return self.response
+
+
+def build_conversation(turns):
+    persona = "You are a helpful agent. " * 200
+    messages = [{"role": "system", "content": persona}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"question {i} " * 40})
+        messages.append({"role": "assistant", "content": f"answer {i} " * 40})
+    return messages
+
+
+def eager_create(model, messages, systems, tool_schemas=None):
+    messages = (systems if systems else []) + messages
+    logger.debug(f"Request model[{model.model_name}] messages: {messages}")
+    start_time = time.time()
+    response = model.client.chat.completions.create(model=model.model_name, messages=messages, tools=tool_schemas)
+    cost_seconds = time.time() - start_time
+    logger.debug(f"Request model[{model.model_name}] time taken[{cost_seconds:.2f}s] response[{response}]")
+    return response
+
+
+def measure(fn, calls):
+    tracemalloc.start()
+    start = time.process_time()
+    for _ in range(calls):
+        fn()
+    cpu = time.process_time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cpu / calls, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--calls", type=int, default=500)
+    args = parser.parse_args()
+
+    LoggerManager.init(debug=False)
+    messages = build_conversation(args.turns)
+    response = SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content="ok " * 100, tool_calls=None))],
+        usage=SimpleNamespace(prompt_tokens=12000, completion_tokens=100),
+    )
+    model = OpenAIModel(model_name="bench", api_key="bench")
+    model.client = SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions(response)))
+
+    eager_cpu, eager_peak = measure(lambda: eager_create(model, messages, []), args.calls)
+    lazy_cpu, lazy_peak = measure(lambda: model.create(messages=messages, systems=[]), args.calls)
+
+    print(f"conversation: {len(messages)} messages, calls: {args.calls}")
+    print(f"eager: {eager_cpu * 1e6:10.1f} us/call  peak alloc {eager_peak / 1024:10.1f} KiB")
+    print(f"lazy : {lazy_cpu * 1e6:10.1f} us/call  peak alloc {lazy_peak / 1024:10.1f} KiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Startup time of the p2p sidecar for 1, 10 and 50 agents in one process.
+
+"polling" replays the previous startup: spawn the sidecar and ask it for its p2p context once a
+second until it has a relay address. "handshake" spawns one P2PSidecar per agent and returns on
+the context line the sidecar prints. "shared" starts one shared P2PSidecar and attaches every
+agent to it. Agents start concurrently. Needs node, the p2p-server dependencies and the relay.
+
+    cd p2p-server && npm install && cd ..
+    python benchmarks/bench_p2p_sidecar_startup.py --agents 1 10 50
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import grpc
+
+from isek.node.p2p_client import P2PSidecarClient
+from isek.node.p2p_sidecar import P2P_SERVER_SCRIPT, P2PSidecar
+from isek.util.logger import LoggerManager
+
+
+def start_polling(port, agent_port, timeout):
+    process = subprocess.Popen(["node", P2P_SERVER_SCRIPT, f"--port={port}", f"--agent_port={agent_port}"],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    client = P2PSidecarClient(port)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if client.refresh_context().p2p_address:
+                return process, client
+        except grpc.RpcError:
+            pass
+        time.sleep(1)
+    raise TimeoutError(f"p2p server on {port} did not start")
+
+
+def run(mode, agents, base_port, timeout):
+    ports = [base_port + i for i in range(agents)]
+    started = []
+
+    def start(i):
+        agent_port = base_port + 1000 + i
+        if mode == "polling":
+            started.append(start_polling(ports[i], agent_port, timeout))
+            return
+        if mode == "shared":
+            sidecar = P2PSidecar.shared(base_port, agent_port, startup_timeout=timeout)
+        else:
+            sidecar = P2PSidecar(ports[i], agent_port, startup_timeout=timeout)
+        sidecar.attach(f"agent-{i}", lambda peer_id, p2p_address: None)
+        sidecar.start()
+        started.append(sidecar)
+
+    begin = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=agents) as executor:
+        list(executor.map(start, range(agents)))
+    elapsed = time.perf_counter() - begin
+
+    processes = len({id(s) for s in started})
+    for s in started:
+        if mode == "polling":
+            s[0].terminate()
+            s[1].close()
+        else:
+            s.stop()
+    return elapsed, processes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--agents", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--port", type=int, default=43000)
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    LoggerManager.init(debug=False)
+    for agents in args.agents:
+        for mode in ("polling", "handshake", "shared"):
+            elapsed, processes = run(mode, agents, args.port, args.timeout)
+            print(f"{agents:>3} agents {mode:>9}: all ready in {elapsed:6.2f}s, {processes:>3} sidecar processes")
+
+
+if __name__ == "__main__":
+    main()
@@ -33,16 +33,18 @@ class AbstractAgent(ABC):
     def build(self, daemon=False):
         pass
 
-    def run(self, input : str = None) -> None:
+    def run(self, input : str = None, memory: Optional[AgentMemory] = None) -> None:
         """
         Args:
             input:
                 user instructions or environment signals, such as text, image, file, web page, etc.
+            memory:
+                working memory of the conversation, the agent's own memory_manager by default.
         Returns:
             None
         """
         logger.info(f"[{self.persona.name}] ++++++++++Cycle Started++++++++++")
-        response = self.response(input)
+        response = self.response(input, memory)
         logger.info(f"[{self.persona.name}][Response]: {response}")
         logger.info(f"[{self.persona.name}] ----------Cycle Ended------------")
         
@@ -62,21 +64,23 @@ class AbstractAgent(ABC):
                 break
             self.run(text)
             
-    def response(self, input: str) -> str:
+    def response(self, input: str, memory: Optional[AgentMemory] = None) -> str:
         """
         Response to the input
         Args:
             input: user instructions or environment signals, such as text, image, file, web page, etc.
+            memory: working memory of the conversation, the agent's own memory_manager by default.
         Returns:
             str: response to the input
         """
+        memory = memory or self.memory_manager
         if input is not None and input != "":
             logger.info(f"[{self.persona.name}][Trigger: Input]: {input}")
         else:
             logger.info(f"[{self.persona.name}][Trigger: Heartbeat]")
-        self.memory_manager.store_memory_item("User:" + input)
+        memory.store_memory_item("User:" + input)
         # Build template for action phase
-        template = self._build_templates()
+        template = self._build_templates(memory)
         messages = []
         
         # Setup available tools for action phase
@@ -95,7 +99,7 @@ class AbstractAgent(ABC):
             
             # Process text response
             if response.content:
-                self.memory_manager.store_memory_item("Agent:" + response.content)
+                memory.store_memory_item("Agent:" + response.content)
                 
             # Check if we're done with tool calls
             if not response.tool_calls:
@@ -111,10 +115,10 @@ class AbstractAgent(ABC):
                 }
                 messages.append(result_message)
                 
-    def _build_templates(self):
+    def _build_templates(self, memory: Optional[AgentMemory] = None):
         """Build templates for the action phase."""
         # Get recent memory items
-        recent_memory = self.memory_manager.get_recent_memory_items()
+        recent_memory = (memory or self.memory_manager).get_recent_memory_items()
         # state = self.memory_manager.get_all_state_variables()
         # tasks = self.memory_manager.get_pending_tasks()
        
@@ -0,0 +1,73 @@
+import collections
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from isek.constant.exceptions import AgentBusyError
+
+
+class AdmissionControl(object):
+    """
+    Bounds the requests an agent works on at once.
+
+    At most `max_concurrency` requests run, and at most `max_queue` more wait for a free slot, in
+    arrival order. A request arriving when the queue is full, or still waiting after
+    `queue_timeout` seconds, is rejected with AgentBusyError, so overload shows up at the sender
+    as an error instead of as ever growing latency.
+
+        with admission.admit():
+            reply = agent.run(message)
+    """
+
+    def __init__(self, name: str, max_concurrency: int = 4, max_queue: int = 16,
+                 queue_timeout: Optional[float] = 30):
+        if max_concurrency < 1 or max_queue < 0:
+            raise ValueError("max_concurrency must be at least 1 and max_queue not negative")
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.condition = threading.Condition()
+        self.running = 0
+        self.queue = collections.deque()
+        self.rejected = 0
+
+    @contextmanager
+    def admit(self, deadline: Optional[float] = None):
+        self.acquire(deadline)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self, deadline: Optional[float] = None):
+        """Wait for a slot until `deadline` (time.monotonic), by default `queue_timeout` from now."""
+        with self.condition:
+            if self.running < self.max_concurrency and not self.queue:
+                self.running += 1
+                return
+            if len(self.queue) >= self.max_queue:
+                self.rejected += 1
+                raise AgentBusyError(self.name, f"{self.running} running and {len(self.queue)} queued")
+            waiter = object()
+            self.queue.append(waiter)
+            if deadline is None and self.queue_timeout is not None:
+                deadline = time.monotonic() + self.queue_timeout
+            while not (self.queue[0] is waiter and self.running < self.max_concurrency):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self.queue.remove(waiter)
+                    self.rejected += 1
+                    # the waiter behind us may be at the head now
+                    self.condition.notify_all()
+                    raise AgentBusyError(self.name, f"queued for more than {self.queue_timeout}s")
+                self.condition.wait(remaining)
+            self.queue.popleft()
+            self.running += 1
+            self.condition.notify_all()
+
+    def release(self):
+        with self.condition:
+            self.running -= 1
+            self.condition.notify_all()
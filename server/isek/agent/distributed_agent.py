@@ -1,23 +1,39 @@
 from isek.agent.abstract_agent import AbstractAgent
+from isek.agent.admission import AdmissionControl
+from isek.agent.session import SessionStore
 from isek.node.node import Node
 from isek.node.p2p_node import P2PNode
 from isek.util.logger import logger
 import threading
+import time
 
 
 class DistributedAgent(AbstractAgent, P2PNode):
 
     def __init__(
             self,
+            partner_candidates: int = 10,
+            max_concurrency: int = 4,
+            max_queue: int = 16,
+            queue_timeout: float = 30,
+            max_sessions: int = 1000,
             **kwargs
     ):
+        self.partner_candidates = partner_candidates
+        # Room for every admitted or queued message, plus a few threads so gossip is never starved.
+        # Behind an AgentHost this sizes the host's shared pool (see AgentHost).
+        kwargs.setdefault("server_workers", max_concurrency + max_queue + 4)
         # 调用 AbstractAgent 的构造方法
         AbstractAgent.__init__(self, **kwargs)
+        # Each peer talks to its own session, at most max_concurrency messages run at once.
+        self.sessions = SessionStore(self.persona.name, max_sessions=max_sessions)
         # 生成 intro
         self.intro = self.persona.bio
         # self.intro_vector = self.embedding.embedding_one(self.intro)
         # 调用 Node 的构造方法
         P2PNode.__init__(self, **kwargs)
+        self.admission = AdmissionControl(self.persona.name, max_concurrency=max_concurrency,
+                                          max_queue=max_queue, queue_timeout=queue_timeout)
 
     def build(self, daemon=False):
         if not daemon:
@@ -37,8 +53,14 @@ class DistributedAgent(AbstractAgent, P2PNode):
 
     def on_message(self, sender, message):
         logger.info(f"[{self.persona.name}] received message from {sender}: {message}")
-
-        return self.run(message)
+        # Messages of one conversation run one after the other, in arrival order. Only the first
+        # of them takes an admission slot, the others wait for the conversation without holding one.
+        # Both waits share one queue_timeout, a message is rejected once it has waited that long in all.
+        timeout = self.admission.queue_timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.sessions.open(sender) as session, session.lock.hold(timeout), \
+                self.admission.admit(deadline):
+            return self.run(message, memory=session.memory)
 
     def search_partners(self, query: str) -> str:
         """
@@ -48,9 +70,16 @@ class DistributedAgent(AbstractAgent, P2PNode):
         Returns: partner name and node_id
         """
         logger.info(f"[{self.persona.name}] Searching partners with query: {query}")
-        nodes = str(self.get_nodes_by_vector(query))
-        # 前期node少，用语意理解来匹配 后期vector来匹配
-        
+        # The vector index shortlists candidates, the LLM only picks among the shortlist.
+        candidates = self.get_nodes_by_vector(query, limit=self.partner_candidates)
+        if not candidates:
+            return "No partner found"
+        nodes = "\n".join(
+            f"name: {(node.get('metadata') or {}).get('name')}, node_id: {node.get('node_id')}, "
+            f"intro: {(node.get('metadata') or {}).get('intro')}"
+            for node in candidates
+        )
+
         matching_node_template = f"""
             I am looking for partners to help me with a query, here are the nodes I found:
             {nodes}
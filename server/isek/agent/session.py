@@ -0,0 +1,125 @@
+import collections
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from isek.agent.memory import AgentMemory
+from isek.constant.exceptions import AgentBusyError
+
+
+class ConversationLock(object):
+    """
+    A lock granted in request order, so the messages of a conversation run in the order they arrived.
+
+    threading.Lock wakes an arbitrary waiter. Here every waiter queues, as in AdmissionControl, and
+    one still waiting after `timeout` seconds gives up with AgentBusyError.
+    """
+
+    def __init__(self, name: str, session_id: str = None):
+        self.name = name
+        self.session_id = session_id
+        self.condition = threading.Condition()
+        self.held = False
+        self.queue = collections.deque()
+
+    @contextmanager
+    def hold(self, timeout: Optional[float] = None):
+        self.acquire(timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self, timeout: Optional[float] = None):
+        with self.condition:
+            if not self.held and not self.queue:
+                self.held = True
+                return
+            waiter = object()
+            self.queue.append(waiter)
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not (self.queue[0] is waiter and not self.held):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self.queue.remove(waiter)
+                    self.condition.notify_all()
+                    raise AgentBusyError(self.name, f"conversation {self.session_id} busy for more than {timeout}s")
+                self.condition.wait(remaining)
+            self.queue.popleft()
+            self.held = True
+
+    def release(self):
+        with self.condition:
+            self.held = False
+            self.condition.notify_all()
+
+
+class Session(object):
+    def __init__(self, name: str, session_id: str):
+        self.memory = AgentMemory()
+        self.lock = ConversationLock(name, session_id)
+        # callers between open and close, a session in use is never evicted
+        self.users = 0
+
+
+class SessionStore(object):
+    """
+    Conversation contexts of an agent, one per peer.
+
+    Each session has its own AgentMemory, so the history of one conversation never leaks into
+    another, and a ConversationLock that keeps the messages of one conversation in order while
+    different conversations run in parallel. At most `max_sessions` idle sessions are kept, the
+    least recently used idle session is dropped first; sessions in use are never dropped.
+
+        with sessions.open(peer) as session, session.lock.hold():
+            agent.run(message, memory=session.memory)
+    """
+
+    def __init__(self, name: str, max_sessions: int = 1000):
+        self.name = name
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        self.sessions: "OrderedDict[str, Session]" = OrderedDict()
+
+    @contextmanager
+    def open(self, session_id: str) -> Iterator[Session]:
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = Session(self.name, session_id)
+                self.sessions[session_id] = session
+            else:
+                self.sessions.move_to_end(session_id)
+            session.users += 1
+            self.__evict()
+        try:
+            yield session
+        finally:
+            with self.lock:
+                session.users -= 1
+                self.__evict()
+
+    def __evict(self):
+        """Caller must hold self.lock. Drop the least recently used idle sessions over max_sessions."""
+        excess = len(self.sessions) - self.max_sessions
+        if excess <= 0:
+            return
+        idle = []
+        for session_id, session in self.sessions.items():
+            if session.users == 0:
+                idle.append(session_id)
+                if len(idle) == excess:
+                    break
+        for session_id in idle:
+            self.sessions.pop(session_id)
+
+    def drop(self, session_id: str):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is not None and session.users == 0:
+                self.sessions.pop(session_id)
+
+    def __len__(self):
+        return len(self.sessions)
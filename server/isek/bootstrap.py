@@ -5,9 +5,13 @@ import isek_center
 from isek_config import IsekConfig
 
 
-def run_registry():
+def run_registry(server="flask", workers=1, data_dir=None):
     """Run the registry center"""
-    isek_center.main()
+    if server == "asgi":
+        from isek import isek_center_asgi
+        isek_center_asgi.main(workers=workers, data_dir=data_dir)
+    else:
+        isek_center.main(data_dir=data_dir)
     print("Running registry center...")
 
 
@@ -34,6 +38,9 @@ def main():
     run_parser= subparsers.add_parser("run", help="Run commands")
     run_parser.add_argument("subcommand", choices=["registry", "agent", "agents"], help="Run registry or agent")
     run_parser.add_argument("--config", type=str, default="default_config.yaml", help="Path to the TOML configuration file")
+    run_parser.add_argument("--server", choices=["flask", "asgi"], default="flask", help="Registry server mode")
+    run_parser.add_argument("--workers", type=int, default=1, help="Registry worker processes (asgi mode)")
+    run_parser.add_argument("--data-dir", type=str, default=None, help="Persist registry membership in this directory")
 
 
     # `isek clean` to clean Python cache files
@@ -45,7 +52,7 @@ def main():
 
     if args.command == "run":
         if args.subcommand == "registry":
-            run_registry()
+            run_registry(args.server, args.workers, args.data_dir)
         elif args.subcommand == "agent":
             run_agent(args.config)
     elif args.command == "clean":
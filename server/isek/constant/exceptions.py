@@ -5,3 +5,16 @@ class NodeUnavailableError(Exception):
         self.message = f"Node '{node_name}' is unavailable: {message}"
         super().__init__(self.message)
 
+
+class P2PServerStartError(Exception):
+    def __init__(self, port, message="p2p server did not start"):
+        self.port = port
+        self.message = f"p2p server[port:{port}]: {message}"
+        super().__init__(self.message)
+
+
+class AgentBusyError(Exception):
+    def __init__(self, agent_name, message="too many requests in flight"):
+        self.agent_name = agent_name
+        self.message = f"Agent '{agent_name}' is busy: {message}"
+        super().__init__(self.message)
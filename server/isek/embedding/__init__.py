@@ -1,11 +1,16 @@
 from .openai_embedding import OpenAIEmbedding
+from .local_embedding import LocalEmbedding
+from .cached_embedding import CachedEmbedding
 
 __all__ = [
     "OpenAIEmbedding",
+    "LocalEmbedding",
+    "CachedEmbedding",
     "embeddings"
 ]
 
 
 embeddings = {
-    "openai": OpenAIEmbedding
+    "openai": OpenAIEmbedding,
+    "local": LocalEmbedding
 }
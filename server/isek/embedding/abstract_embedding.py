@@ -3,15 +3,18 @@
 from abc import ABC, abstractmethod
 from typing import Optional
 
+import numpy as np
+
 
 class AbstractEmbedding(ABC):
 
     def __init__(self, dim: Optional[int]):
         self.dim = dim
 
-    def embedding_one(self, data: str) -> list[float]:
+    def embedding_one(self, data: str) -> np.ndarray:
         return self.embedding([data])[0]
 
     @abstractmethod
-    def embedding(self, datas: list[str]) -> list[list[float]]:
+    def embedding(self, datas: list[str]) -> np.ndarray:
+        """Embed `datas` into a C-contiguous float32 matrix with one row per input, in input order."""
         pass
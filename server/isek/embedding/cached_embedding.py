@@ -0,0 +1,167 @@
+"""encoding=utf-8"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from isek.embedding.abstract_embedding import AbstractEmbedding
+from isek.util.logger import logger
+
+# Mapping changes logged before index.json is rewritten, at least (or the number of cached texts).
+COMPACT_LOG_ENTRIES = 1000
+
+
+class CachedEmbedding(AbstractEmbedding):
+    """
+    Caching decorator for any AbstractEmbedding.
+
+    Vectors live in a memory-mapped file of `capacity` rows, and a JSON index maps the sha256 of
+    each text to its row. The index is kept in least-recently-used order so the oldest entry's row
+    is reused once the cache is full. Both files are loaded on startup, so texts that were embedded
+    by a previous process are not sent to the model again.
+
+    Row assignments are appended to index.log and folded into index.json once the log outgrows the
+    index, so a batch of misses writes a few lines rather than the whole index. Every row also holds
+    the sha256 of its text and a lookup whose row holds another text counts as a miss, so a crash
+    between writing vectors and the mapping never serves the wrong vector.
+
+    Cache hits only reorder the index in memory. The order on disk is the one of the last
+    compaction followed by the logged assignments, so after a restart an entry hit since then may
+    be evicted before entries that were used less recently.
+    """
+
+    def __init__(self, embedding: AbstractEmbedding, cache_dir: str, capacity: int = 100000):
+        super().__init__(embedding.dim)
+        if not embedding.dim:
+            raise ValueError("CachedEmbedding needs an embedding with a known 'dim'.")
+        self.embedding_model = embedding
+        self.capacity = capacity
+        self.namespace = f"{type(embedding).__name__}:{getattr(embedding, 'model_name', None)}:{embedding.dim}"
+        self.vectors_path = os.path.join(cache_dir, "vectors.f32")
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.log_path = os.path.join(cache_dir, "index.log")
+        self.row_dtype = np.dtype([("key", np.uint8, (32,)), ("vector", np.float32, (self.dim,))])
+        self.slots: OrderedDict[str, int] = OrderedDict()
+        self.free_slots = []
+        self.log_entries = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.rows = self.__warm_load()
+
+    def __warm_load(self) -> np.memmap:
+        expected_size = self.capacity * self.row_dtype.itemsize
+        index = None
+        if os.path.exists(self.index_path) and os.path.exists(self.vectors_path) \
+                and os.path.getsize(self.vectors_path) == expected_size:
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                logger.exception(f"Embedding cache index {self.index_path} is unreadable, starting empty.")
+        if index and index.get("namespace") == self.namespace:
+            self.slots = OrderedDict((key, slot) for key, slot in index["slots"])
+            self.__replay_log()
+            rows = np.memmap(self.vectors_path, dtype=self.row_dtype, mode="r+", shape=(self.capacity,))
+        else:
+            rows = np.memmap(self.vectors_path, dtype=self.row_dtype, mode="w+", shape=(self.capacity,))
+            self.__compact()
+        used = set(self.slots.values())
+        self.free_slots = [slot for slot in range(self.capacity - 1, -1, -1) if slot not in used]
+        logger.debug(f"Embedding cache loaded {len(self.slots)} vectors from {self.vectors_path}")
+        return rows
+
+    def __replay_log(self):
+        """Apply the row assignments logged after index.json was written, skipping a torn last line."""
+        if not os.path.exists(self.log_path):
+            return
+        slot_keys = {slot: key for key, slot in self.slots.items()}
+        with open(self.log_path, "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) != 2 or len(parts[0]) != 64 or not parts[1].isdigit() \
+                        or int(parts[1]) >= self.capacity:
+                    continue
+                key, slot = parts[0], int(parts[1])
+                evicted = slot_keys.get(slot)
+                if evicted is not None and evicted != key:
+                    self.slots.pop(evicted, None)
+                moved_from = self.slots.pop(key, None)
+                if moved_from is not None and moved_from != slot:
+                    slot_keys.pop(moved_from, None)
+                self.slots[key] = slot
+                slot_keys[slot] = key
+                self.log_entries += 1
+
+    def __append_log(self, assignments):
+        """Log (key, slot) row assignments in the order they were made."""
+        with open(self.log_path, "a", encoding="utf-8") as f:
+            f.write("".join(f"{key} {slot}\n" for key, slot in assignments))
+        self.log_entries += len(assignments)
+        if self.log_entries >= max(COMPACT_LOG_ENTRIES, len(self.slots)):
+            self.__compact()
+
+    def __compact(self):
+        """Write the whole index to index.json and start an empty log."""
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"namespace": self.namespace, "slots": list(self.slots.items())}, f)
+        os.replace(tmp_path, self.index_path)
+        open(self.log_path, "w").close()
+        self.log_entries = 0
+
+    def __store(self, key: str, vector) -> int:
+        if key in self.slots:
+            self.slots.move_to_end(key)
+            slot = self.slots[key]
+        elif self.free_slots:
+            slot = self.free_slots.pop()
+            self.slots[key] = slot
+        else:
+            _, slot = self.slots.popitem(last=False)
+            self.slots[key] = slot
+        self.rows[slot] = (np.frombuffer(bytes.fromhex(key), dtype=np.uint8), vector)
+        return slot
+
+    @staticmethod
+    def text_key(data: str) -> str:
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def embedding(self, datas: list[str]) -> np.ndarray:
+        keys = [self.text_key(data) for data in datas]
+        found = {}
+        missing = {}
+        with self.lock:
+            for key, data in zip(keys, datas):
+                if key in found or key in missing:
+                    continue
+                slot = self.slots.get(key)
+                if slot is not None and self.rows[slot]["key"].tobytes() != bytes.fromhex(key):
+                    # the row was rewritten for another text before a crash lost its mapping
+                    self.slots.pop(key)
+                    self.free_slots.append(slot)
+                    slot = None
+                if slot is None:
+                    missing[key] = data
+                else:
+                    self.slots.move_to_end(key)
+                    found[key] = np.array(self.rows[slot]["vector"])
+
+        if missing:
+            vectors = self.embedding_model.embedding(list(missing.values()))
+            with self.lock:
+                # a batch with more misses than capacity evicts some of its own keys again
+                assignments = []
+                for key, vector in zip(missing.keys(), vectors):
+                    assignments.append((key, self.__store(key, vector)))
+                    found[key] = vector
+                self.rows.flush()
+                self.__append_log(assignments)
+        logger.debug(f"Embedding cache hits[{len(datas) - len(missing)}] misses[{len(missing)}]")
+        result = np.empty((len(keys), self.dim), dtype=np.float32)
+        for row, key in enumerate(keys):
+            result[row] = found[key]
+        return result
@@ -0,0 +1,103 @@
+"""encoding=utf-8"""
+
+import hashlib
+import math
+import re
+from collections import Counter
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+
+from isek.embedding.abstract_embedding import AbstractEmbedding
+from isek.util.logger import logger
+from isek.util.tools import split_list
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def hashing_batch(datas: list[str], dim: int) -> np.ndarray:
+    """Hashing vectorizer rows of `datas`, a module function so worker processes can run it."""
+    matrix = np.zeros((len(datas), dim), dtype=np.float32)
+    for row, data in enumerate(datas):
+        tokens = TOKEN_PATTERN.findall(data.lower())
+        features = Counter(tokens)
+        features.update(f"{a} {b}" for a, b in zip(tokens, tokens[1:]))
+        for feature, count in features.items():
+            digest = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+            sign = 1.0 if digest >> 63 else -1.0
+            matrix[row, digest % dim] += sign * (1.0 + math.log(count))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class LocalEmbedding(AbstractEmbedding):
+    """
+    CPU-only embedding that needs no network access.
+
+    With a `model_name` it runs a sentence-transformers model locally (the package is an optional
+    dependency). Without one, or if sentence-transformers is not installed, it falls back to a
+    signed feature-hashing vectorizer over word unigrams and bigrams, which is deterministic across
+    processes and hosts.
+
+    `threads` sets torch's intra-op threads for a model. The hashing vectorizer is pure Python and
+    holds the GIL, so with `threads` > 1 its batches run on a process pool of that size instead;
+    `close` shuts it down.
+    """
+
+    def __init__(
+            self,
+            dim: Optional[int] = 384,
+            model_name: Optional[str] = None,
+            batch_size: int = 32,
+            threads: int = 1
+    ):
+        super().__init__(dim)
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.threads = max(1, threads)
+        self.model = None
+        if model_name:
+            self.model = self.__load_model(model_name)
+        if self.model is not None:
+            self.dim = self.model.get_sentence_embedding_dimension()
+        elif not self.dim:
+            raise ValueError("LocalEmbedding needs 'dim' when no sentence-transformers model is loaded.")
+        # worker processes are only spawned once batches are submitted
+        self.executor = ProcessPoolExecutor(max_workers=self.threads) if self.threads > 1 and self.model is None else None
+
+    def __load_model(self, model_name):
+        try:
+            import torch
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            logger.warning(f"sentence-transformers is not installed, LocalEmbedding[{model_name}] "
+                           f"falls back to the hashing vectorizer.")
+            return None
+        torch.set_num_threads(self.threads)
+        return SentenceTransformer(model_name, device="cpu")
+
+    def embedding(self, datas: list[str]) -> np.ndarray:
+        if not datas:
+            return np.empty((0, self.dim), dtype=np.float32)
+        if self.model is not None:
+            vectors = self.model.encode(datas, batch_size=self.batch_size, normalize_embeddings=True,
+                                        convert_to_numpy=True, show_progress_bar=False)
+            return np.ascontiguousarray(vectors, dtype=np.float32)
+        batches = split_list(datas, self.batch_size)
+        if self.executor is not None and len(batches) > 1:
+            matrices = list(self.executor.map(hashing_batch, batches, itertools.repeat(self.dim)))
+        else:
+            matrices = [self.hashing_batch(batch) for batch in batches]
+        return np.vstack(matrices)
+
+    def hashing_batch(self, datas: list[str]) -> np.ndarray:
+        return hashing_batch(datas, self.dim)
+
+    def close(self):
+        """Shut down the hashing process pool, if one was started."""
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -1,13 +1,15 @@
 """encoding=utf-8"""
 
 import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
+import numpy as np
 from openai import OpenAI
 
 from isek.embedding.abstract_embedding import AbstractEmbedding
 from isek.util.logger import logger
-from isek.util.tools import split_list
+from isek.util.tools import split_batches
 
 
 class OpenAIEmbedding(AbstractEmbedding):
@@ -20,16 +22,41 @@ class OpenAIEmbedding(AbstractEmbedding):
             dim: Optional[int],
             model_name: Optional[str] = "text-embedding-3-small",
             api_key: Optional[str] = None,
-            base_url: Optional[str] = None
+            base_url: Optional[str] = None,
+            batch_size: int = 16,
+            max_batch_tokens: int = 100000,
+            max_concurrency: int = 4
     ):
+        """
+        Args:
+            batch_size: maximum number of texts sent in one request.
+            max_batch_tokens: maximum estimated tokens sent in one request.
+            max_concurrency: maximum number of requests in flight at the same time.
+        """
         super().__init__(dim)
         self.model_name = model_name
         self.client = OpenAI(base_url=base_url, api_key=api_key)
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_concurrency))
 
-    def embedding(self, datas: list[str]) -> list[list[float]]:
-        data_array = split_list(datas, 16)
-        all_results = []
-        for sub_datas in data_array:
-            result = self.client.embeddings.create(input=sub_datas, model=self.model_name)
-            all_results.extend([r.embedding for r in result.data])
-        return all_results
+    @staticmethod
+    def estimate_tokens(data: str) -> int:
+        # About four characters per token for English text, good enough for batch limits.
+        return len(data) // 4 + 1
+
+    def __embedding_batch(self, sub_datas: list[str]) -> np.ndarray:
+        result = self.client.embeddings.create(input=sub_datas, model=self.model_name)
+        rows = sorted(result.data, key=lambda r: r.index)
+        return np.asarray([r.embedding for r in rows], dtype=np.float32)
+
+    def embedding(self, datas: list[str]) -> np.ndarray:
+        if not datas:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        batches = split_batches(datas, self.batch_size, self.max_batch_tokens, self.estimate_tokens)
+        logger.debug(f"Embedding model[{self.model_name}] {len(datas)} texts in {len(batches)} batches")
+        # executor.map yields results in submission order, so rows stay aligned with `datas`.
+        matrices = list(self.executor.map(self.__embedding_batch, batches))
+        if len(matrices) == 1:
+            return np.ascontiguousarray(matrices[0])
+        return np.concatenate(matrices, axis=0)
@@ -1,12 +1,701 @@
-from flask import Flask, request, jsonify, Blueprint
+import heapq
+import json
+import os
+import sqlite3
+import uuid
+from collections import deque
+
+from flask import Flask, Response, request, jsonify, Blueprint
 import threading
 import time
 
-isek_center_blueprint = Blueprint('isek_center_blueprint', __name__, url_prefix='/isek_center')
+from isek.util.shard import DEFAULT_SHARD, shard_of
 
-nodes = {}
+isek_center_blueprint = Blueprint('isek_center_blueprint', __name__, url_prefix='/isek_center')
 
 LEASE_DURATION = 30
+# Number of membership changes kept for delta sync, older clients get a full node list.
+CHANGE_LOG_SIZE = 10000
+# Upper bound for the `wait` long-poll parameter of /available_nodes, in seconds.
+MAX_WAIT_SECONDS = 60
+# How often expired leases are collected, in seconds.
+CLEANUP_INTERVAL = 1
+
+try:
+    import orjson
+
+    def dumps_bytes(data):
+        return orjson.dumps(data)
+except ImportError:
+    def dumps_bytes(data):
+        return json.dumps(data).encode("utf-8")
+
+
+def new_epoch():
+    """Id of a revision series. Revisions of different epochs are unrelated, e.g. before and after a restart."""
+    return uuid.uuid4().hex[:12]
+
+
+def revision_etag(epoch, revision):
+    return f'"{epoch}:{revision}"'
+
+
+def normalized(vector):
+    """Unit-length copy of `vector`, None for an empty or zero vector."""
+    if not vector:
+        return None
+    norm = sum(x * x for x in vector) ** 0.5
+    return [x / norm for x in vector] if norm > 0 else None
+
+
+class LeaseLog(object):
+    """
+    Crash-recoverable membership store for NodeTable: an append-only log of membership changes
+    plus a periodic snapshot, both in `data_dir`.
+
+    Lease renewals are not logged. On recovery every node gets a fresh lease, which gives agents
+    one lease period to renew before they expire. The epoch of the revisions is kept next to
+    them, so clients can go on with deltas across restarts.
+    """
+
+    def __init__(self, data_dir, snapshot_every=10000):
+        self.data_dir = data_dir
+        self.snapshot_every = snapshot_every
+        self.snapshot_path = os.path.join(data_dir, "snapshot.json")
+        self.log_path = os.path.join(data_dir, "membership.log")
+        self.epoch_path = os.path.join(data_dir, "epoch")
+        self.epoch = None
+        self.records_since_snapshot = 0
+        self.unsynced = False
+        os.makedirs(data_dir, exist_ok=True)
+        self.log_file = None
+
+    def load(self):
+        """Returns (revision, {node_id: (node_info, created_revision, vector)}) from the snapshot and the log."""
+        revision = 0
+        nodes = {}
+        self.epoch = self.__load_epoch()
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            revision = snapshot["revision"]
+            nodes = {entry[0]: (entry[1], entry[2], entry[3] if len(entry) > 3 else None)
+                     for entry in snapshot["nodes"]}
+        if os.path.exists(self.log_path):
+            valid_size = 0
+            with open(self.log_path, "rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn last line from a crash mid-write, everything before it is intact.
+                        break
+                    valid_size += len(line)
+                    if record["revision"] <= revision:
+                        continue
+                    if record["op"] == "put":
+                        nodes[record["node_info"]["node_id"]] = (record["node_info"], record["created_revision"],
+                                                                 record.get("vector"))
+                    else:
+                        nodes.pop(record["node_id"], None)
+                    revision = record["revision"]
+                    self.records_since_snapshot += 1
+            # Cut the torn tail, new records must start on a clean line.
+            os.truncate(self.log_path, valid_size)
+        self.log_file = open(self.log_path, "a", encoding="utf-8")
+        return revision, nodes
+
+    def __load_epoch(self):
+        """The stored epoch, a new one when there is none or the revisions start over without snapshot and log."""
+        if os.path.exists(self.epoch_path) and (os.path.exists(self.snapshot_path) or os.path.exists(self.log_path)):
+            with open(self.epoch_path, "r", encoding="utf-8") as f:
+                epoch = f.read().strip()
+            if epoch:
+                return epoch
+        epoch = new_epoch()
+        tmp_path = f"{self.epoch_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(epoch)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.epoch_path)
+        return epoch
+
+    def append_put(self, revision, node_info, created_revision, vector=None):
+        record = {"op": "put", "revision": revision, "node_info": node_info, "created_revision": created_revision}
+        if vector is not None:
+            record["vector"] = vector
+        self.__append(record)
+
+    def append_delete(self, revision, node_id):
+        self.__append({"op": "del", "revision": revision, "node_id": node_id})
+
+    def __append(self, record):
+        self.log_file.write(json.dumps(record) + "\n")
+        self.log_file.flush()
+        self.records_since_snapshot += 1
+        self.unsynced = True
+
+    def should_snapshot(self):
+        return self.records_since_snapshot >= self.snapshot_every
+
+    def snapshot(self, revision, nodes):
+        """Write a snapshot of `nodes` ({node_id: (node_info, created_revision, vector)}) and truncate the log."""
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"revision": revision,
+                       "nodes": [[node_id, node_info, created_revision, vector]
+                                 for node_id, (node_info, created_revision, vector) in nodes.items()]}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self.log_file.close()
+        self.log_file = open(self.log_path, "w", encoding="utf-8")
+        self.records_since_snapshot = 0
+
+    def sync(self):
+        """fsync the log, called once per cleanup cycle instead of once per record."""
+        if self.log_file and self.unsynced:
+            os.fsync(self.log_file.fileno())
+            self.unsynced = False
+
+
+class NodeTable(object):
+    """
+    Thread-safe registry state of the isek center.
+
+    Membership (the node map, revision, change log and expiry heap) is guarded by one lock, while
+    lease renewals, the hot path, only take one of `stripes` per-node locks. Expiry uses a min-heap
+    of (expires_at, node_id): a renewal does not touch the heap, a popped entry whose node was
+    renewed meanwhile is pushed back with its new deadline, so collecting costs O(expired). The
+    serialized full node list is cached until membership changes.
+
+    Nodes are grouped into shards (capabilities or regions). Each shard keeps its members, the
+    revision that last changed it, and the sum of its members' intro vectors, so listings, deltas
+    and long-polls can be scoped to a few shards and the per-shard summary costs O(shards).
+
+    With a `lease_log` every membership change is logged, and the table is recovered from it on
+    construction. Revisions count within `epoch`, which changes whenever the table starts over
+    without its history, so a client never applies deltas or ETags of another table instance.
+    """
+
+    def __init__(self, lease_duration=LEASE_DURATION, change_log_size=CHANGE_LOG_SIZE, stripes=64,
+                 lease_log: LeaseLog = None):
+        self.lease_duration = lease_duration
+        self.change_log_size = change_log_size
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.stripe_locks = [threading.Lock() for _ in range(stripes)]
+        self.nodes = {}
+        self.expiry_heap = []
+        # Monotonically increasing membership revision, bumped when a node is added, changed or
+        # removed. Lease renewals do not change membership and keep the revision.
+        self.revision = 0
+        self.epoch = new_epoch()
+        self.change_log = deque()
+        self.change_log_floor = 0
+        # shard -> member node ids / last revision that changed the shard / sum and count of member vectors
+        self.shard_members = {}
+        self.shard_revisions = {}
+        self.shard_vector_sums = {}
+        self.shard_vector_counts = {}
+        # shard scope (None for all shards) -> (revision, serialized full response)
+        self.full_response_cache = {}
+        self.summaries_cache = None
+        self.lease_log = lease_log
+        if lease_log:
+            self.__recover()
+
+    def __recover(self):
+        revision, nodes = self.lease_log.load()
+        self.epoch = self.lease_log.epoch
+        expires_at = time.time() + self.lease_duration
+        for node_id, (node_info, created_revision, vector) in nodes.items():
+            self.nodes[node_id] = {
+                "node_info": node_info,
+                "vector": vector,
+                "created_revision": created_revision,
+                "expires_at": expires_at,
+                "heap_deadline": expires_at
+            }
+            heapq.heappush(self.expiry_heap, (expires_at, node_id))
+            self.__add_member(node_id, self.nodes[node_id])
+        # Deltas from before the restart are gone, older clients get a full list.
+        self.revision = revision
+        self.change_log_floor = revision
+        self.shard_revisions = {shard: revision for shard in self.shard_members}
+
+    def __stripe_lock(self, node_id):
+        return self.stripe_locks[hash(node_id) % len(self.stripe_locks)]
+
+    def __record_change(self, node_id, shards):
+        """Caller must hold self.lock. `shards` are the shards the node left or joined."""
+        self.revision += 1
+        self.change_log.append((self.revision, node_id, frozenset(shards)))
+        while len(self.change_log) > self.change_log_size:
+            self.change_log_floor = self.change_log.popleft()[0]
+        for shard in shards:
+            self.shard_revisions[shard] = self.revision
+        self.full_response_cache = {}
+        self.summaries_cache = None
+        self.changed.notify_all()
+
+    def __add_member(self, node_id, node):
+        """Caller must hold self.lock."""
+        shard = shard_of(node["node_info"])
+        self.shard_members.setdefault(shard, set()).add(node_id)
+        vector = node.get("vector")
+        if vector:
+            vector_sum = self.shard_vector_sums.get(shard)
+            self.shard_vector_sums[shard] = list(vector) if vector_sum is None \
+                else [a + b for a, b in zip(vector_sum, vector)]
+            self.shard_vector_counts[shard] = self.shard_vector_counts.get(shard, 0) + 1
+
+    def __remove_member(self, node_id, node):
+        """Caller must hold self.lock."""
+        shard = shard_of(node["node_info"])
+        members = self.shard_members.get(shard)
+        if members is not None:
+            members.discard(node_id)
+        vector = node.get("vector")
+        if vector and shard in self.shard_vector_sums:
+            self.shard_vector_counts[shard] -= 1
+            if self.shard_vector_counts[shard] <= 0:
+                self.shard_vector_sums.pop(shard)
+                self.shard_vector_counts.pop(shard)
+            else:
+                self.shard_vector_sums[shard] = [a - b for a, b in zip(self.shard_vector_sums[shard], vector)]
+        if members is not None and not members:
+            self.shard_members.pop(shard)
+
+    def register(self, node_info, vector=None):
+        node_id = node_info["node_id"]
+        expires_at = time.time() + self.lease_duration
+        with self.lock, self.__stripe_lock(node_id):
+            old_node = self.nodes.get(node_id)
+            changed = old_node is None or old_node["node_info"] != node_info or old_node["vector"] != vector
+            node = {
+                "node_info": node_info,
+                "vector": vector,
+                "created_revision": old_node["created_revision"] if old_node else self.revision + 1,
+                "expires_at": expires_at,
+                # deadline of this node's one live heap entry, other entries for it are stale
+                "heap_deadline": old_node["heap_deadline"] if old_node else expires_at
+            }
+            if changed:
+                if old_node is not None:
+                    self.__remove_member(node_id, old_node)
+                self.__add_member(node_id, node)
+                self.__record_change(node_id, {shard_of(node_info), shard_of(old_node["node_info"]) if old_node
+                                               else shard_of(node_info)})
+            self.nodes[node_id] = node
+            if old_node is None:
+                heapq.heappush(self.expiry_heap, (expires_at, node_id))
+            if self.lease_log and changed:
+                self.lease_log.append_put(self.revision, node_info, node["created_revision"], vector)
+
+    def deregister(self, node_id):
+        with self.lock, self.__stripe_lock(node_id):
+            node = self.nodes.pop(node_id, None)
+            if node is None:
+                return False
+            self.__remove_member(node_id, node)
+            self.__record_change(node_id, {shard_of(node["node_info"])})
+            if self.lease_log:
+                self.lease_log.append_delete(self.revision, node_id)
+            return True
+
+    def renew(self, node_id):
+        with self.__stripe_lock(node_id):
+            node = self.nodes.get(node_id)
+            if node is None:
+                return False
+            node["expires_at"] = time.time() + self.lease_duration
+            return True
+
+    def renew_many(self, node_ids):
+        """Renew the leases of node_ids, returns the ids the table does not know."""
+        return [node_id for node_id in node_ids if not self.renew(node_id)]
+
+    def expire(self, now=None):
+        now = now or time.time()
+        expired_node_ids = []
+        with self.lock:
+            while self.expiry_heap and self.expiry_heap[0][0] <= now:
+                deadline, node_id = heapq.heappop(self.expiry_heap)
+                with self.__stripe_lock(node_id):
+                    node = self.nodes.get(node_id)
+                    if node is None or node["heap_deadline"] != deadline:
+                        continue
+                    if node["expires_at"] > now:
+                        node["heap_deadline"] = node["expires_at"]
+                        heapq.heappush(self.expiry_heap, (node["expires_at"], node_id))
+                        continue
+                    self.nodes.pop(node_id)
+                self.__remove_member(node_id, node)
+                self.__record_change(node_id, {shard_of(node["node_info"])})
+                if self.lease_log:
+                    self.lease_log.append_delete(self.revision, node_id)
+                expired_node_ids.append(node_id)
+            if self.lease_log:
+                self.lease_log.sync()
+                if self.lease_log.should_snapshot():
+                    self.lease_log.snapshot(self.revision, {
+                        node_id: (node["node_info"], node["created_revision"], node["vector"])
+                        for node_id, node in self.nodes.items()})
+        return expired_node_ids
+
+    def __scope_revision(self, shards):
+        """Caller must hold self.lock. The revision that last changed any of `shards`, or the table when None."""
+        if shards is None:
+            return self.revision
+        return max((self.shard_revisions.get(shard, 0) for shard in shards), default=0)
+
+    def scope_revision(self, shards=None):
+        with self.lock:
+            return self.__scope_revision(shards)
+
+    def revisions(self):
+        """(table revision, {shard: revision that last changed it})."""
+        with self.lock:
+            return self.revision, dict(self.shard_revisions)
+
+    def wait_for_change(self, since, timeout, shards=None):
+        with self.lock:
+            if since == self.__scope_revision(shards):
+                self.changed.wait_for(lambda: self.__scope_revision(shards) != since, timeout=timeout)
+            return self.__scope_revision(shards)
+
+    def changes_since(self, since, shards=None):
+        """
+        Nodes added, changed and removed after `since`, or None if the change log does not reach back that far.
+        With `shards` only their nodes are reported, a node that moved out of them is reported removed.
+        """
+        with self.lock:
+            if since is None or not self.change_log_floor <= since <= self.revision:
+                return None
+            response = {"epoch": self.epoch, "revision": self.__scope_revision(shards), "full": False,
+                        "added": {}, "changed": {}, "removed": []}
+            changed_node_ids = set()
+            for rev, node_id, changed_shards in reversed(self.change_log):
+                if rev <= since:
+                    break
+                if shards is None or not changed_shards.isdisjoint(shards):
+                    changed_node_ids.add(node_id)
+            for node_id in changed_node_ids:
+                node = self.nodes.get(node_id)
+                if node is None or (shards is not None and shard_of(node["node_info"]) not in shards):
+                    response["removed"].append(node_id)
+                elif node["created_revision"] > since:
+                    response["added"][node_id] = node["node_info"]
+                else:
+                    response["changed"][node_id] = node["node_info"]
+            return response
+
+    def full_response(self, shards=None):
+        """(revision, serialized CommonResponse with every node of `shards`), rebuilt only after membership changes."""
+        key = tuple(sorted(shards)) if shards is not None else None
+        with self.lock:
+            if key not in self.full_response_cache:
+                if shards is None:
+                    available_nodes = {k: v["node_info"] for k, v in self.nodes.items()}
+                else:
+                    available_nodes = {node_id: self.nodes[node_id]["node_info"]
+                                       for shard in key for node_id in self.shard_members.get(shard, ())}
+                revision = self.__scope_revision(shards)
+                data = {
+                    "epoch": self.epoch,
+                    "revision": revision,
+                    "full": True,
+                    "available_nodes": available_nodes
+                }
+                self.full_response_cache[key] = (revision, dumps_bytes(CommonResponse.success(data)))
+            return self.full_response_cache[key]
+
+    def shard_summaries(self):
+        """{shard: {"count", "revision", "centroid"}}, the centroid is the normalized mean of the members' vectors."""
+        with self.lock:
+            if self.summaries_cache is None:
+                self.summaries_cache = {
+                    shard: {
+                        "count": len(members),
+                        "revision": self.shard_revisions.get(shard, 0),
+                        "centroid": normalized(self.shard_vector_sums.get(shard))
+                    }
+                    for shard, members in self.shard_members.items()
+                }
+            return self.summaries_cache
+
+
+class SqliteNodeTable(object):
+    """
+    NodeTable with the same interface, kept in a SQLite database in WAL mode so several server
+    worker processes share one lease state. Expiry is served by an index on expires_at, and
+    change notification across processes is polled with `poll_interval`.
+    """
+
+    def __init__(self, db_path, lease_duration=LEASE_DURATION, change_log_size=CHANGE_LOG_SIZE,
+                 poll_interval=0.05):
+        self.lease_duration = lease_duration
+        self.change_log_size = change_log_size
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS nodes (
+                node_id TEXT PRIMARY KEY,
+                node_info TEXT NOT NULL,
+                created_revision INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                shard TEXT NOT NULL DEFAULT '{DEFAULT_SHARD}',
+                vector TEXT
+            );
+            CREATE INDEX IF NOT EXISTS nodes_expires_at ON nodes (expires_at);
+            CREATE INDEX IF NOT EXISTS nodes_shard ON nodes (shard);
+            CREATE TABLE IF NOT EXISTS changes (
+                revision INTEGER PRIMARY KEY AUTOINCREMENT,
+                node_id TEXT NOT NULL,
+                shards TEXT NOT NULL DEFAULT ''
+            );
+            CREATE TABLE IF NOT EXISTS shards (
+                shard TEXT PRIMARY KEY,
+                revision INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS shard_vectors (
+                shard TEXT PRIMARY KEY,
+                vector_count INTEGER NOT NULL,
+                vector_sum TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        """)
+        # The revisions live as long as the database, the first worker to open it picks their epoch.
+        self.conn.execute("INSERT OR IGNORE INTO meta VALUES ('epoch', ?)", (new_epoch(),))
+        self.epoch = self.conn.execute("SELECT value FROM meta WHERE key = 'epoch'").fetchone()[0]
+        self.full_response_cache = {}
+        self.summaries_cache = None
+
+    def __transaction(self, fn):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self.conn)
+                self.conn.execute("COMMIT")
+                return result
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def __record_change(self, conn, node_id, shards):
+        cursor = conn.execute("INSERT INTO changes (node_id, shards) VALUES (?, ?)", (node_id, "\n".join(shards)))
+        conn.execute("DELETE FROM changes WHERE revision <= ?", (cursor.lastrowid - self.change_log_size,))
+        conn.executemany("INSERT OR REPLACE INTO shards VALUES (?, ?)",
+                         [(shard, cursor.lastrowid) for shard in shards])
+        return cursor.lastrowid
+
+    @staticmethod
+    def __add_vector(conn, shard, vector_json, sign):
+        """Add (sign 1) or subtract (sign -1) a member's vector to its shard's running sum."""
+        if vector_json is None:
+            return
+        vector = json.loads(vector_json)
+        row = conn.execute("SELECT vector_count, vector_sum FROM shard_vectors WHERE shard = ?", (shard,)).fetchone()
+        count = (row[0] if row else 0) + sign
+        if count <= 0:
+            conn.execute("DELETE FROM shard_vectors WHERE shard = ?", (shard,))
+            return
+        vector_sum = [a + sign * b for a, b in zip(json.loads(row[1]), vector)] if row else vector
+        conn.execute("INSERT OR REPLACE INTO shard_vectors VALUES (?, ?, ?)", (shard, count, json.dumps(vector_sum)))
+
+    @staticmethod
+    def __revision_in(conn, shards=None):
+        if shards is None:
+            row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+        else:
+            row = conn.execute(f"SELECT MAX(revision) FROM shards WHERE shard IN ({','.join('?' * len(shards))})",
+                               list(shards)).fetchone() if shards else None
+        return row[0] if row and row[0] is not None else 0
+
+    @property
+    def revision(self):
+        return self.scope_revision()
+
+    def scope_revision(self, shards=None):
+        with self.lock:
+            return self.__revision_in(self.conn, shards)
+
+    def revisions(self):
+        """(table revision, {shard: revision that last changed it})."""
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                revision = self.__revision_in(self.conn)
+                shard_revisions = dict(self.conn.execute("SELECT shard, revision FROM shards").fetchall())
+            finally:
+                self.conn.execute("COMMIT")
+        return revision, shard_revisions
+
+    def register(self, node_info, vector=None):
+        node_id = node_info["node_id"]
+        node_info_json = json.dumps(node_info, sort_keys=True)
+        vector_json = json.dumps(vector) if vector is not None else None
+
+        def register_in(conn):
+            row = conn.execute("SELECT node_info, created_revision, shard, vector FROM nodes WHERE node_id = ?",
+                               (node_id,)).fetchone()
+            created_revision = row[1] if row else None
+            if row is None or row[0] != node_info_json or row[3] != vector_json:
+                shards = {shard_of(node_info), row[2] if row else shard_of(node_info)}
+                revision = self.__record_change(conn, node_id, shards)
+                created_revision = created_revision if created_revision is not None else revision
+                if row is not None:
+                    self.__add_vector(conn, row[2], row[3], -1)
+                self.__add_vector(conn, shard_of(node_info), vector_json, 1)
+            conn.execute("INSERT OR REPLACE INTO nodes (node_id, node_info, created_revision, expires_at, shard, vector) "
+                         "VALUES (?, ?, ?, ?, ?, ?)",
+                         (node_id, node_info_json, created_revision, time.time() + self.lease_duration,
+                          shard_of(node_info), vector_json))
+        self.__transaction(register_in)
+
+    def deregister(self, node_id):
+        def deregister_in(conn):
+            row = conn.execute("SELECT shard, vector FROM nodes WHERE node_id = ?", (node_id,)).fetchone()
+            if row is None:
+                return False
+            conn.execute("DELETE FROM nodes WHERE node_id = ?", (node_id,))
+            self.__add_vector(conn, row[0], row[1], -1)
+            self.__record_change(conn, node_id, {row[0]})
+            return True
+        return self.__transaction(deregister_in)
+
+    def renew(self, node_id):
+        with self.lock:
+            cursor = self.conn.execute("UPDATE nodes SET expires_at = ? WHERE node_id = ?",
+                                       (time.time() + self.lease_duration, node_id))
+        return cursor.rowcount > 0
+
+    def renew_many(self, node_ids):
+        def renew_in(conn):
+            expires_at = time.time() + self.lease_duration
+            return [node_id for node_id in node_ids
+                    if conn.execute("UPDATE nodes SET expires_at = ? WHERE node_id = ?",
+                                    (expires_at, node_id)).rowcount == 0]
+        return self.__transaction(renew_in)
+
+    def expire(self, now=None):
+        now = now or time.time()
+
+        def expire_in(conn):
+            rows = conn.execute("SELECT node_id, shard, vector FROM nodes WHERE expires_at <= ?", (now,)).fetchall()
+            for node_id, shard, vector_json in rows:
+                conn.execute("DELETE FROM nodes WHERE node_id = ?", (node_id,))
+                self.__add_vector(conn, shard, vector_json, -1)
+                self.__record_change(conn, node_id, {shard})
+            return [node_id for node_id, _, _ in rows]
+        return self.__transaction(expire_in)
+
+    def wait_for_change(self, since, timeout, shards=None):
+        deadline = time.time() + timeout
+        revision = self.scope_revision(shards)
+        while since == revision and time.time() < deadline:
+            time.sleep(self.poll_interval)
+            revision = self.scope_revision(shards)
+        return revision
+
+    def changes_since(self, since, shards=None):
+        """
+        Nodes added, changed and removed after `since`, or None if the change log does not reach back that far.
+        With `shards` only their nodes are reported, a node that moved out of them is reported removed.
+        """
+        if since is None:
+            return None
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                revision = self.__revision_in(self.conn)
+                oldest = self.conn.execute("SELECT MIN(revision) FROM changes").fetchone()[0]
+                floor = oldest - 1 if oldest is not None else revision
+                if not floor <= since <= revision:
+                    return None
+                scope_revision = self.__revision_in(self.conn, shards)
+                rows = self.conn.execute(
+                    "SELECT c.node_id, c.shards, n.node_info, n.created_revision, n.shard FROM changes c "
+                    "LEFT JOIN nodes n ON n.node_id = c.node_id WHERE c.revision > ?", (since,)).fetchall()
+            finally:
+                self.conn.execute("COMMIT")
+        response = {"epoch": self.epoch, "revision": scope_revision, "full": False,
+                    "added": {}, "changed": {}, "removed": []}
+        seen = set()
+        for node_id, changed_shards, node_info, created_revision, shard in rows:
+            if node_id in seen or (shards is not None and set(changed_shards.split("\n")).isdisjoint(shards)):
+                continue
+            seen.add(node_id)
+            if node_info is None or (shards is not None and shard not in shards):
+                response["removed"].append(node_id)
+            elif created_revision > since:
+                response["added"][node_id] = json.loads(node_info)
+            else:
+                response["changed"][node_id] = json.loads(node_info)
+        return response
+
+    def full_response(self, shards=None):
+        """(revision, serialized CommonResponse with every node of `shards`), rebuilt only after membership changes."""
+        key = tuple(sorted(shards)) if shards is not None else None
+        revision = self.scope_revision(shards)
+        cache = self.full_response_cache.get(key)
+        if cache is not None and cache[0] == revision:
+            return cache
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                revision = self.__revision_in(self.conn, shards)
+                if shards is None:
+                    rows = self.conn.execute("SELECT node_id, node_info FROM nodes").fetchall()
+                else:
+                    rows = self.conn.execute(
+                        f"SELECT node_id, node_info FROM nodes WHERE shard IN ({','.join('?' * len(key))})",
+                        key).fetchall()
+            finally:
+                self.conn.execute("COMMIT")
+        data = {
+            "epoch": self.epoch,
+            "revision": revision,
+            "full": True,
+            "available_nodes": {node_id: json.loads(node_info) for node_id, node_info in rows}
+        }
+        self.full_response_cache[key] = (revision, dumps_bytes(CommonResponse.success(data)))
+        return self.full_response_cache[key]
+
+    def shard_summaries(self):
+        """{shard: {"count", "revision", "centroid"}}, the centroid is the normalized mean of the members' vectors."""
+        revision = self.revision
+        cache = self.summaries_cache
+        if cache is not None and cache[0] == revision:
+            return cache[1]
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                revision = self.__revision_in(self.conn)
+                shard_revisions = dict(self.conn.execute("SELECT shard, revision FROM shards").fetchall())
+                counts = self.conn.execute("SELECT shard, COUNT(*) FROM nodes GROUP BY shard").fetchall()
+                vector_sums = {shard: json.loads(vector_sum) for shard, vector_sum in
+                               self.conn.execute("SELECT shard, vector_sum FROM shard_vectors").fetchall()}
+            finally:
+                self.conn.execute("COMMIT")
+        summaries = {
+            shard: {
+                "count": count,
+                "revision": shard_revisions.get(shard, 0),
+                "centroid": normalized(vector_sums.get(shard))
+            }
+            for shard, count in counts
+        }
+        self.summaries_cache = (revision, summaries)
+        return summaries
 
 
 class CommonResponse(object):
@@ -35,6 +724,9 @@ class CommonResponse(object):
         }
 
 
+node_table = NodeTable()
+
+
 @isek_center_blueprint.route('/register', methods=['POST'])
 def register():
     data = request.json
@@ -47,14 +739,14 @@ def register():
     if not node_id or not host or not port:
         return CommonResponse.fail(message="node_id and host/port are required", code=400)
 
-    nodes[node_id] = {
+    node_table.register({
         "node_id": node_id,
         "host": host,
         "port": port,
         "p2p_address": p2p_address,
-        "metadata": metadata,
-        "expires_at": time.time() + LEASE_DURATION
-    }
+        "shard": data.get('shard'),
+        "metadata": metadata
+    }, vector=data.get('vector'))
 
     return CommonResponse.success()
 
@@ -64,49 +756,79 @@ def deregister():
     data = request.json
     node_id = data.get('node_id')
 
-    if not node_id or node_id not in nodes:
+    if not node_id or not node_table.deregister(node_id):
         return CommonResponse.fail(message="Invalid node_id", code=400)
 
-    nodes.pop(node_id)
-
     return CommonResponse.success()
 
 
 @isek_center_blueprint.route('/available_nodes', methods=['GET'])
 def get_available_nodes():
-    current_time = time.time()
-    available_nodes = {k: v for k, v in nodes.items() if v['expires_at'] > current_time}
-    response = {
-        "available_nodes": available_nodes
-    }
-    return CommonResponse.success(response)
+    """
+    Without `since` returns every available node. With `since=<revision>` returns only the nodes
+    added, changed and removed after that revision, or the full list with "full": true when the
+    change log no longer reaches back that far. Responds 304 when If-None-Match holds the current
+    revision's ETag. Clients pass the `epoch` of their last response along with `since`; a
+    revision of another epoch (the center restarted without its history) gets the full list.
+
+    With `wait=<seconds>` and `since` equal to the current revision, the request is held open
+    (long-poll) until membership changes or the wait runs out.
+
+    With one or more `shard=<name>` only the nodes of those shards are listed, and revisions are
+    the last revision that changed one of them, so changes elsewhere neither wake nor reach the client.
+    """
+    since = request.args.get('since', type=int)
+    epoch = request.args.get('epoch')
+    if epoch is not None and epoch != node_table.epoch:
+        since = None
+    wait = min(request.args.get('wait', default=0, type=float), MAX_WAIT_SECONDS)
+    shards = request.args.getlist('shard') or None
+    revision = node_table.wait_for_change(since, wait, shards) if wait > 0 else node_table.scope_revision(shards)
+    if request.if_none_match.contains(f"{node_table.epoch}:{revision}"):
+        return '', 304, {'ETag': revision_etag(node_table.epoch, revision)}
+    delta = node_table.changes_since(since, shards)
+    if delta is not None:
+        return CommonResponse.success(delta), 200, {'ETag': revision_etag(node_table.epoch, delta["revision"])}
+    revision, body = node_table.full_response(shards)
+    return Response(body, mimetype='application/json', headers={'ETag': revision_etag(node_table.epoch, revision)})
+
+
+@isek_center_blueprint.route('/shards', methods=['GET'])
+def get_shards():
+    """Per-shard node count, revision and intro centroid, for routing a query to the shards worth listing."""
+    return CommonResponse.success({"epoch": node_table.epoch, "revision": node_table.revision,
+                                   "shards": node_table.shard_summaries()})
 
 
 @isek_center_blueprint.route('/renew', methods=['POST'])
 def renew():
     data = request.json
+    node_ids = data.get('node_ids')
+    if node_ids is not None:
+        # Batched renew of every node of one process, answers which of them the center does not know.
+        return CommonResponse.success({"missing": node_table.renew_many(node_ids)})
     node_id = data.get('node_id')
 
-    if not node_id or node_id not in nodes:
+    if not node_id or not node_table.renew(node_id):
         return CommonResponse.fail(message="Invalid node_id", code=400)
 
-    nodes[node_id]['expires_at'] = time.time() + LEASE_DURATION
-
     return CommonResponse.success()
 
 
 def cleanup_expired_nodes():
     while True:
-        current_time = time.time()
-        expired_nodes = [k for k, v in nodes.items() if v['expires_at'] <= current_time]
-
-        for node_id in expired_nodes:
-            nodes.pop(node_id, None)
-
-        time.sleep(5)
-
-
-def main():
+        node_table.expire()
+        time.sleep(CLEANUP_INTERVAL)
+
+
+def main(data_dir=None):
+    """
+    Args:
+        data_dir: keep membership in a crash-recoverable lease log there, so a restart keeps it.
+    """
+    global node_table
+    if data_dir:
+        node_table = NodeTable(lease_log=LeaseLog(data_dir))
     cleanup_thread = threading.Thread(target=cleanup_expired_nodes, daemon=True)
     cleanup_thread.start()
     app = Flask(__name__)
@@ -0,0 +1,216 @@
+"""
+Async (ASGI) server mode for the isek center, serving the same /isek_center/* API as the Flask
+blueprint in isek_center.py with orjson responses.
+
+With one worker the lease state lives in memory, and is logged to ISEK_CENTER_DATA_DIR when set.
+With several workers every worker process opens the same SQLite database (ISEK_CENTER_DB) so they
+share one lease state.
+
+The node table blocks (locks, SQLite transactions, lease log fsyncs), so handlers call it on the
+threadpool and the event loop only parses requests and waits.
+
+    cd server && uvicorn isek.isek_center_asgi:app --host 0.0.0.0 --port 8088 --workers 4
+"""
+import asyncio
+import os
+import threading
+from contextlib import asynccontextmanager
+from typing import List
+
+from fastapi import APIRouter, FastAPI, Query, Request
+from fastapi.responses import ORJSONResponse, Response
+from starlette.concurrency import run_in_threadpool
+
+from isek.isek_center import (CLEANUP_INTERVAL, MAX_WAIT_SECONDS, CommonResponse, LeaseLog, NodeTable,
+                              SqliteNodeTable, revision_etag)
+
+DB_PATH_ENV = "ISEK_CENTER_DB"
+DATA_DIR_ENV = "ISEK_CENTER_DATA_DIR"
+# How long the revision watch waits on the table at a time, bounds how late it notices shutdown.
+WATCH_TIMEOUT = 1
+
+router = APIRouter(prefix="/isek_center", default_response_class=ORJSONResponse)
+
+
+def create_node_table():
+    db_path = os.environ.get(DB_PATH_ENV)
+    if db_path:
+        return SqliteNodeTable(db_path)
+    data_dir = os.environ.get(DATA_DIR_ENV)
+    return NodeTable(lease_log=LeaseLog(data_dir) if data_dir else None)
+
+
+node_table = create_node_table()
+
+
+class RevisionWatch(object):
+    """
+    Revision changes of the node table for every long-poll of this worker.
+
+    One thread waits on the table (its Condition in memory, one poll per interval with SQLite) and
+    publishes the table and shard revisions it then reads to the event loop, waking the waiting
+    requests, which compare their scope against them without touching the table.
+    """
+
+    def __init__(self, table, loop):
+        self.table = table
+        self.loop = loop
+        self.revision, self.shard_revisions = table.revisions()
+        # replaced on every change, waiters hold the one of the revisions they saw
+        self.changed = asyncio.Event()
+        self.stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.__follow, daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def __follow(self):
+        revision = self.revision
+        while not self.stopped.is_set():
+            if self.table.wait_for_change(revision, WATCH_TIMEOUT) == revision:
+                continue
+            revision, shard_revisions = self.table.revisions()
+            self.loop.call_soon_threadsafe(self.__publish, revision, shard_revisions)
+
+    def __publish(self, revision, shard_revisions):
+        self.revision, self.shard_revisions = revision, shard_revisions
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def scope_revision(self, shards=None):
+        if shards is None:
+            return self.revision
+        return max((self.shard_revisions.get(shard, 0) for shard in shards), default=0)
+
+    async def wait_for_change(self, since, timeout, shards=None):
+        """Wait until the revision of `shards` is no longer `since`, at most `timeout` seconds."""
+        deadline = self.loop.time() + timeout
+        while self.scope_revision(shards) == since:
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(self.changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return
+
+
+revision_watch: RevisionWatch = None
+
+
+@router.post("/register")
+async def register(request: Request):
+    data = await request.json()
+    node_id = data.get('node_id')
+    host = data.get('host')
+    port = data.get('port')
+
+    if not node_id or not host or not port:
+        return CommonResponse.fail(message="node_id and host/port are required", code=400)
+
+    await run_in_threadpool(node_table.register, {
+        "node_id": node_id,
+        "host": host,
+        "port": port,
+        "p2p_address": data.get('p2p_address'),
+        "shard": data.get('shard'),
+        "metadata": data.get('metadata')
+    }, vector=data.get('vector'))
+    return CommonResponse.success()
+
+
+@router.post("/deregister")
+async def deregister(request: Request):
+    data = await request.json()
+    node_id = data.get('node_id')
+
+    if not node_id or not await run_in_threadpool(node_table.deregister, node_id):
+        return CommonResponse.fail(message="Invalid node_id", code=400)
+    return CommonResponse.success()
+
+
+@router.post("/renew")
+async def renew(request: Request):
+    data = await request.json()
+    node_ids = data.get('node_ids')
+    if node_ids is not None:
+        return CommonResponse.success({"missing": await run_in_threadpool(node_table.renew_many, node_ids)})
+    node_id = data.get('node_id')
+
+    if not node_id or not await run_in_threadpool(node_table.renew, node_id):
+        return CommonResponse.fail(message="Invalid node_id", code=400)
+    return CommonResponse.success()
+
+
+def available_nodes_response(if_none_match, since, shards):
+    revision = node_table.scope_revision(shards)
+    etag = revision_etag(node_table.epoch, revision)
+    if etag in [value.strip() for value in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+    delta = node_table.changes_since(since, shards)
+    if delta is not None:
+        return ORJSONResponse(CommonResponse.success(delta),
+                              headers={"ETag": revision_etag(node_table.epoch, delta["revision"])})
+    revision, body = node_table.full_response(shards)
+    return Response(body, media_type="application/json", headers={"ETag": revision_etag(node_table.epoch, revision)})
+
+
+@router.get("/available_nodes")
+async def get_available_nodes(request: Request, since: int = None, epoch: str = None, wait: float = 0,
+                              shard: List[str] = Query(None)):
+    """Same contract as the Flask endpoint: deltas with `since` of `epoch`, 304 on a matching ETag, long-poll with `wait`, scoped by `shard`."""
+    if epoch is not None and epoch != node_table.epoch:
+        since = None
+    wait = min(wait, MAX_WAIT_SECONDS)
+    shards = shard or None
+    if wait > 0 and since is not None:
+        await revision_watch.wait_for_change(since, wait, shards)
+    return await run_in_threadpool(available_nodes_response, request.headers.get("if-none-match", ""), since, shards)
+
+
+@router.get("/shards")
+async def get_shards():
+    def shards_response():
+        return CommonResponse.success({"epoch": node_table.epoch, "revision": node_table.revision,
+                                       "shards": node_table.shard_summaries()})
+    return await run_in_threadpool(shards_response)
+
+
+async def cleanup_expired_nodes():
+    while True:
+        await run_in_threadpool(node_table.expire)
+        await asyncio.sleep(CLEANUP_INTERVAL)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global revision_watch
+    revision_watch = RevisionWatch(node_table, asyncio.get_running_loop())
+    revision_watch.start()
+    cleanup = asyncio.create_task(cleanup_expired_nodes())
+    yield
+    cleanup.cancel()
+    revision_watch.stop()
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+app.include_router(router)
+
+
+def main(host="0.0.0.0", port=8088, workers=1, db_path=None, data_dir=None):
+    import uvicorn
+
+    if data_dir:
+        os.environ[DATA_DIR_ENV] = data_dir
+    if workers > 1 and not db_path and not os.environ.get(DB_PATH_ENV):
+        db_path = os.path.join(data_dir or ".isek", "isek_center.db")
+    if db_path:
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        os.environ[DB_PATH_ENV] = db_path
+    uvicorn.run("isek.isek_center_asgi:app", host=host, port=port, workers=workers)
+
+
+if __name__ == '__main__':
+    main()
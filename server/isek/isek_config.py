@@ -8,7 +8,7 @@ from llm.openai_model import OpenAIModel
 from embedding.openai_embedding import OpenAIEmbedding
 from node import EtcdRegistry, IsekCenterRegistry
 from llm import llms
-from embedding import embeddings
+from embedding import embeddings, CachedEmbedding
 import etcd3
 
 
@@ -21,6 +21,8 @@ class IsekConfig:
         except Exception as e:
             logger.exception(f"Error loading IsekConfig: {e}")
             raise e
+        # Agents loaded from one config share a registry, and with it one heartbeat and watch thread.
+        self.registry = None
 
     def get(self, *keys):
         value = self.config
@@ -47,18 +49,33 @@ class IsekConfig:
         port = self.get("distributed.server", "port")
         p2p_server_port = self.get("distributed.server", "p2p_server_port")
         registry = self.load_registry()
-        embedding = self.load_embedding()
+        # The embedding only backs the partner search index, skip loading it when that is disabled.
+        embedding = self.load_embedding() if self.get("distributed.search_partner_by_vector") else None
+        gossip_options = dict(self.get_sub_config("distributed.gossip") or {})
+        p2p_call_timeout = self.get("distributed.server", "p2p_call_timeout") or 30
+        p2p_startup_timeout = self.get("distributed.server", "p2p_startup_timeout") or 30
         return DistributedAgent(
             host=host, port=port, registry=registry, p2p_server_port=p2p_server_port,
-            persona=persona, model=llm, embedding=embedding
+            persona=persona, model=llm, embedding=embedding,
+            node_index_options=self.get_sub_config("distributed.node_index"),
+            gossip_seeds=gossip_options.pop("seeds", None), gossip_options=gossip_options,
+            p2p_call_timeout=p2p_call_timeout, p2p_startup_timeout=p2p_startup_timeout,
+            p2p_shared_server=bool(self.get("distributed.server", "p2p_shared_server")),
+            local_delivery=self.get("distributed.server", "local_delivery") is not False,
+            local_serialize=bool(self.get("distributed.server", "local_serialize")),
+            **{key: agent_config[key] for key in ("max_concurrency", "max_queue", "queue_timeout", "max_sessions")
+               if agent_config.get(key) is not None}
         )
 
     def load_registry(self):
+        if self.registry is not None:
+            return self.registry
         registry_mode = self.get("registry")
         if registry_mode == "etcd":
-            return self.load_etcd_registry()
+            self.registry = self.load_etcd_registry()
         else:
-            return self.load_isek_center_registry()
+            self.registry = self.load_isek_center_registry()
+        return self.registry
 
     def load_etcd_registry(self):
         etcd_client = etcd3.Etcd3Client(**self.get_sub_config("registry.etcd"))
@@ -77,4 +94,8 @@ class IsekConfig:
         embedding_mode = self.get("embedding")
         if embedding_mode is None:
             return None
-        return embeddings.get(embedding_mode)(**self.get_sub_config(f"embedding.{embedding_mode}"))
+        embedding = embeddings.get(embedding_mode)(**self.get_sub_config(f"embedding.{embedding_mode}"))
+        cache_config = self.get_sub_config("embedding.cache")
+        if cache_config:
+            embedding = CachedEmbedding(embedding, **cache_config)
+        return embedding
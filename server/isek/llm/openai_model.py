@@ -3,6 +3,7 @@
 import time
 import os
 import json
+import random
 from isek.util.logger import logger
 from isek.llm.abstract_model import AbstractModel
 from isek.util.tools import function_to_schema, load_json_from_chat_response
@@ -22,11 +23,18 @@ class OpenAIModel(AbstractModel):
             self,
             model_name: Optional[str] = "gpt-4o-mini",
             api_key: Optional[str] = None,
-            base_url: Optional[str] = None
+            base_url: Optional[str] = None,
+            payload_log_sample_rate: float = 0.0
     ):
+        """
+        Args:
+            payload_log_sample_rate: fraction of calls (0.0 - 1.0) whose full messages and response
+                are written to the debug log. Every call still logs sizes, token usage and timing.
+        """
         super().__init__()
         self.model_name = model_name
         self.client = OpenAI(base_url=base_url, api_key=api_key)
+        self.payload_log_sample_rate = payload_log_sample_rate
 
     def generate_json(self, prompt, system_messages=None, retry=3, check_json_def=None):
         for i in range(retry):
@@ -62,17 +70,43 @@ class OpenAIModel(AbstractModel):
     ):
         try:
             messages = (systems if systems else []) + messages
-
-            logger.debug(f"Request model[{self.model_name}] messages: {messages}")
-            start_time = time.time()
+            log_payload = self.__sample_payload()
+            if log_payload:
+                logger.opt(lazy=True).debug("Request model[{}] messages: {}",
+                                            lambda: self.model_name, lambda: messages)
+            start_time = time.perf_counter()
             response = self.client.chat.completions.create(
                 model=self.model_name,
                 messages=messages,
                 tools=tool_schemas
             )
-            cost_seconds = time.time() - start_time
-            logger.debug(f"Request model[{self.model_name}] time taken[{cost_seconds:.2f}s] response[{response}]")
+            cost_seconds = time.perf_counter() - start_time
+            logger.opt(lazy=True).debug(
+                "Request model[{}] time taken[{:.2f}s] messages[{}] chars[{}] tools[{}] "
+                "prompt_tokens[{}] completion_tokens[{}]",
+                lambda: self.model_name, lambda: cost_seconds, lambda: len(messages),
+                lambda: messages_char_count(messages), lambda: len(tool_schemas or []),
+                lambda: getattr(response.usage, "prompt_tokens", None),
+                lambda: getattr(response.usage, "completion_tokens", None)
+            )
+            if log_payload:
+                logger.opt(lazy=True).debug("Request model[{}] response[{}]",
+                                            lambda: self.model_name, lambda: response)
             return response
         except Exception as e:
             logger.exception(f"Request model[{self.model_name}] error.")
             raise e
+
+    def __sample_payload(self) -> bool:
+        rate = self.payload_log_sample_rate
+        return rate > 0 and (rate >= 1 or random.random() < rate)
+
+
+def messages_char_count(messages: List) -> int:
+    """Total content length of chat messages, without stringifying the messages themselves."""
+    total = 0
+    for message in messages:
+        content = message.get("content") if isinstance(message, dict) else getattr(message, "content", None)
+        if isinstance(content, str):
+            total += len(content)
+    return total
@@ -0,0 +1,135 @@
+import threading
+from concurrent import futures
+from typing import Dict, Optional
+
+import grpc
+
+from isek.node.noderpc import node_pb2_grpc
+from isek.node.p2p_node import P2PNode
+from isek.node.p2p_sidecar import P2PSidecar
+from isek.util.logger import logger
+
+# Smallest gRPC pool of a host, also for hosts started without nodes.
+MIN_WORKERS = 32
+
+class AgentHost(node_pb2_grpc.IsekP2PNodeServiceServicer):
+    """
+    Runs many P2PNodes (DistributedAgents) of one process behind one gRPC server and port.
+
+    Agents added here never call build_server. They share the host's p2p sidecar, so the process
+    runs one Node.js process and one relay connection, and every agent is addressed as
+    <sidecar p2p address>#<node_id>. Inbound messages are routed to the agent named by that
+    receiver node id. The gRPC server of all agents runs on one shared executor, sized to the sum
+    of their `server_workers` at start unless `max_workers` is given, so each agent keeps room for
+    the messages its admission control queues; threads only start under load. One heartbeat
+    thread probes the gossip membership of every agent each `protocol_interval` on a small pool,
+    in place of one probe thread and ping-req pool per agent, so the gossip thread count stays
+    fixed however many agents are hosted.
+
+        host = AgentHost(port=8080, p2p_server_port=3000)
+        for agent in agents:
+            host.add(agent)
+        host.start()
+        host.wait_for_termination()
+    """
+
+    def __init__(self,
+                 host: str = "localhost",
+                 port: int = 8080,
+                 p2p_server_port: int = 3000,
+                 max_workers: Optional[int] = None,
+                 gossip_workers: int = 8,
+                 protocol_interval: float = 2.0,
+                 p2p_startup_timeout: float = 30,
+                 p2p_call_timeout: float = 30):
+        self.host = host
+        self.port = port
+        self.p2p_server_port = p2p_server_port
+        self.protocol_interval = protocol_interval
+        self.sidecar = P2PSidecar(p2p_server_port, port, startup_timeout=p2p_startup_timeout,
+                                  call_timeout=p2p_call_timeout, is_shared=True)
+        self.max_workers = max_workers
+        # created on start, once the hosted nodes are known
+        self.executor = None
+        # Probes wait on ping timeouts, keep them from starving the messages on the gRPC executor.
+        # Their ping-reqs need a pool of their own, a probe would deadlock waiting on its own pool.
+        self.probe_executor = futures.ThreadPoolExecutor(max_workers=gossip_workers, thread_name_prefix="gossip-probe")
+        self.gossip_executor = futures.ThreadPoolExecutor(max_workers=gossip_workers, thread_name_prefix="gossip")
+        # membership changes reach the agents' node indexes here, one delivery per agent at a time
+        self.notify_executor = futures.ThreadPoolExecutor(max_workers=gossip_workers, thread_name_prefix="gossip-notify")
+        self.nodes: Dict[str, P2PNode] = {}
+        self.probing = set()
+        self.lock = threading.Lock()
+        self.server = None
+        self.started = False
+        self.stopped = threading.Event()
+
+    def add(self, node: P2PNode):
+        """Host `node`; it joins the network right away when the host is already started."""
+        with self.lock:
+            if node.node_id in self.nodes:
+                raise ValueError(f"Node {node.node_id} is already hosted")
+            self.nodes[node.node_id] = node
+            started = self.started
+        if started:
+            node.join_host(self)
+
+    def remove(self, node_id: str):
+        with self.lock:
+            node = self.nodes.pop(node_id, None)
+        if node is not None:
+            node.leave_host()
+
+    def start(self):
+        """Start the sidecar, the gRPC server and the heartbeat, and bring up the added nodes."""
+        self.sidecar.start()
+        with self.lock:
+            max_workers = self.max_workers or max(
+                MIN_WORKERS, sum(node.server_workers for node in self.nodes.values()))
+        self.executor = futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="agent-host")
+        self.server = grpc.server(self.executor)
+        node_pb2_grpc.add_IsekP2PNodeServiceServicer_to_server(self, self.server)
+        self.server.add_insecure_port(f'[::]:{self.port}')
+        self.server.start()
+        with self.lock:
+            self.started = True
+            nodes = list(self.nodes.values())
+        for node in nodes:
+            node.join_host(self)
+        threading.Thread(target=self.__heartbeat_loop, daemon=True).start()
+        logger.info(f"Agent host started on port {self.port} with {len(nodes)} nodes...")
+
+    def wait_for_termination(self):
+        self.server.wait_for_termination()
+
+    def stop(self):
+        self.stopped.set()
+        for node_id in list(self.nodes):
+            self.remove(node_id)
+        if self.server is not None:
+            self.server.stop(grace=1)
+        self.sidecar.stop()
+
+    def call_peer(self, request, context):
+        node = self.sidecar.tenant_of(request.receiver_p2p_address)
+        if node is None:
+            context.abort(grpc.StatusCode.NOT_FOUND, f"No hosted node at {request.receiver_p2p_address}")
+        return node.call_peer(request, context)
+
+    def __heartbeat_loop(self):
+        while not self.stopped.wait(self.protocol_interval):
+            with self.lock:
+                nodes = [node for node_id, node in self.nodes.items()
+                         if node.membership is not None and node_id not in self.probing]
+                self.probing.update(node.node_id for node in nodes)
+            for node in nodes:
+                self.probe_executor.submit(self.__probe, node)
+
+    def __probe(self, node: P2PNode):
+        try:
+            node.membership.probe()
+        except Exception:
+            logger.exception(f"[{node.node_id}] Gossip probe error.")
+        finally:
+            with self.lock:
+                self.probing.discard(node.node_id)
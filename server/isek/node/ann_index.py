@@ -0,0 +1,102 @@
+import math
+
+import faiss
+
+from isek.util.logger import logger
+
+INDEX_FLAT = "flat"
+INDEX_HNSW = "hnsw"
+INDEX_IVF_FLAT = "ivf_flat"
+INDEX_IVF_PQ = "ivf_pq"
+INDEX_AUTO = "auto"
+
+INDEX_TYPES = (INDEX_FLAT, INDEX_HNSW, INDEX_IVF_FLAT, INDEX_IVF_PQ)
+
+DEFAULT_INDEX_PARAMS = {
+    # collection size at or above which "auto" switches to each index type
+    "hnsw_threshold": 10000,
+    "ivf_flat_threshold": 200000,
+    "ivf_pq_threshold": 1000000,
+    # HNSW graph degree, build-time and search-time beam width
+    "hnsw_m": 32,
+    "hnsw_ef_construction": 80,
+    "hnsw_ef_search": 64,
+    # IVF cell count (None = 4 * sqrt(n)) and cells probed per query
+    "ivf_nlist": None,
+    "ivf_nprobe": 16,
+    # PQ sub-quantizer count (None = largest of 64/32/16/8/4 dividing dim) and bits per code
+    "pq_m": None,
+    "pq_nbits": 8,
+}
+
+# faiss k-means wants at least this many training points per centroid
+MIN_POINTS_PER_CENTROID = 39
+
+
+def choose_index_type(size, params):
+    if size >= params["ivf_pq_threshold"]:
+        return INDEX_IVF_PQ
+    if size >= params["ivf_flat_threshold"]:
+        return INDEX_IVF_FLAT
+    if size >= params["hnsw_threshold"]:
+        return INDEX_HNSW
+    return INDEX_FLAT
+
+
+def supports_remove(index_type):
+    """HNSW graphs cannot delete vectors, they are compacted by rebuilding."""
+    return index_type != INDEX_HNSW
+
+
+def pq_subquantizers(dim, params):
+    return params["pq_m"] or next((m for m in (64, 32, 16, 8, 4) if dim % m == 0), None)
+
+
+def training_size(index_type, dim, params):
+    """Vectors needed to train `index_type`, 0 when it needs no training, None when it cannot be trained for `dim`."""
+    if index_type == INDEX_IVF_FLAT:
+        return MIN_POINTS_PER_CENTROID
+    if index_type == INDEX_IVF_PQ:
+        if not pq_subquantizers(dim, params):
+            return None
+        return (1 << params["pq_nbits"]) * MIN_POINTS_PER_CENTROID
+    return 0
+
+
+def build_ann_index(index_type, dim, vectors, ids, params):
+    """
+    Build an IndexIDMap of `index_type` holding `vectors` under `ids`, training it on `vectors`.
+    All types use the inner product metric, so for L2-normalized vectors scores are cosine similarities.
+    IVF types fall back to a flat index when there are too few vectors to train on.
+    """
+    size = len(vectors)
+    if index_type in (INDEX_IVF_FLAT, INDEX_IVF_PQ):
+        nlist = params["ivf_nlist"] or int(4 * math.sqrt(max(size, 1)))
+        nlist = min(nlist, size // MIN_POINTS_PER_CENTROID)
+        pq_m = pq_subquantizers(dim, params)
+        needed = training_size(index_type, dim, params)
+        if nlist < 1 or needed is None or size < needed:
+            logger.warning(f"Not enough vectors[{size}] to train {index_type} index, using flat index.")
+            index_type = INDEX_FLAT
+
+    if index_type == INDEX_HNSW:
+        base_index = faiss.IndexHNSWFlat(dim, params["hnsw_m"], faiss.METRIC_INNER_PRODUCT)
+        base_index.hnsw.efConstruction = params["hnsw_ef_construction"]
+        base_index.hnsw.efSearch = params["hnsw_ef_search"]
+    elif index_type == INDEX_IVF_FLAT:
+        base_index = faiss.IndexIVFFlat(faiss.IndexFlatIP(dim), dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        base_index.nprobe = params["ivf_nprobe"]
+    elif index_type == INDEX_IVF_PQ:
+        base_index = faiss.IndexIVFPQ(faiss.IndexFlatIP(dim), dim, nlist, pq_m, params["pq_nbits"],
+                                      faiss.METRIC_INNER_PRODUCT)
+        base_index.nprobe = params["ivf_nprobe"]
+    else:
+        index_type = INDEX_FLAT
+        base_index = faiss.IndexFlatIP(dim)
+
+    if not base_index.is_trained:
+        base_index.train(vectors)
+    index = faiss.IndexIDMap(base_index)
+    if size:
+        index.add_with_ids(vectors, ids)
+    return index_type, index
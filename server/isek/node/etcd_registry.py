@@ -1,22 +1,48 @@
 import json
-from typing import Optional, Dict
+import threading
+import time
+from typing import Optional, Dict, List
 
 import etcd3
+from etcd3 import etcdrpc
+from etcd3.events import PutEvent, DeleteEvent
 import base64
 from ecdsa.keys import SigningKey, VerifyingKey
 from ecdsa.curves import NIST256p
 
 from isek.util.logger import logger
 from isek.node.registry import Registry
+from isek.util.shard import DEFAULT_SHARD
 
 
 class EtcdRegistry(Registry):
+    """
+    Registry backed by etcd.
+
+    The node list is served from a local cache kept current by one prefix watch, so
+    `get_available_nodes` does not touch etcd. Leases of all nodes registered through this
+    instance are renewed over a single LeaseKeepAlive stream, and a node's stored entry is only
+    signature-checked again when it changes.
+
+    Nodes are stored under `/{parent_node_id}/{shard}/{node_id}`. With `shards` only those shard
+    prefixes are watched, one stream each, so the cache holds just the relevant part of the network.
+    Node vectors are not stored in etcd, shard summaries carry counts only.
+
+    Versions before sharding stored nodes under `/{parent_node_id}/{node_id}`. Such entries are
+    still listed by unsharded registries. Those nodes renew through their old key, so moving them
+    under their shard (`migrate_legacy_keys`) is an offline step, run once every writer uses the
+    new layout.
+    """
+
     def __init__(self,
                  host: Optional[str] = None,
                  port: Optional[int] = None,
                  parent_node_id: Optional[str] = "root",
                  etcd_client: Optional[etcd3.Etcd3Client] = None,
-                 ttl: int = 30):
+                 ttl: int = 30,
+                 cache_timeout: float = 10,
+                 shards: Optional[List[str]] = None):
+        super().__init__(shards=shards)
 
         if host and port and etcd_client:
             logger.warning("Both 'host/port' and 'etcd_client' provided. Using 'etcd_client'.")
@@ -38,9 +64,54 @@ class EtcdRegistry(Registry):
         # 设置租约生存时间（秒）
         self.ttl = ttl
         self.leases = {}
+        # register_node arguments of locally hosted nodes, used to re-register after a lost lease
+        self.local_nodes = {}
+        self.lost_leases = set()
+        self.keepalive_thread = None
+        self.keepalive_lock = threading.Lock()
+
+        # watch-maintained cache: node_id -> node_info, and the raw stored entries behind it
+        self.cache_timeout = cache_timeout
+        self.nodes_cache: Dict[str, dict] = {}
+        self.raw_entries: Dict[str, bytes] = {}
+        self.verified_entries: Dict[str, bytes] = {}
+        self.cache_ready = threading.Event()
+        # watched prefix -> (nodes, raw entries) under it, merged into nodes_cache and raw_entries
+        self.prefix_caches = {}
+        self.prefix_lock = threading.Lock()
+
+    def migrate_legacy_keys(self) -> int:
+        """
+        Move entries stored as /{parent}/{node_id} to /{parent}/{shard}/{node_id}, returns how many moved.
+        Only once no running node uses the old layout, such nodes could no longer renew their lease.
+        """
+        prefix = f"/{self.parent_node_id}/"
+        moved = 0
+        for value, metadata in self.etcd_client.get_prefix(prefix):
+            key = metadata.key.decode("utf-8")
+            if "/" in key[len(prefix):]:
+                continue
+            try:
+                node_info = json.loads(value.decode("utf-8"))['node_info']
+            except Exception:
+                logger.exception(f"Legacy etcd entry {key} is unreadable, left in place.")
+                continue
+            new_key = self.__key(self.__node_id_of(metadata.key), node_info.get("shard"))
+            transactions = self.etcd_client.transactions
+            # Only if nobody changed the entry meanwhile, and under the same lease so it still expires.
+            succeeded, _ = self.etcd_client.transaction(
+                compare=[transactions.value(key) == value],
+                success=[transactions.put(new_key, value, lease=metadata.lease_id or None),
+                         transactions.delete(key)],
+                failure=[])
+            moved += 1 if succeeded else 0
+        if moved:
+            logger.info(f"Moved {moved} etcd entries of the pre-shard layout under their shards.")
+        return moved
 
     def register_node(self, node_id: str, host: str, port: int,
-                      p2p_address: Optional[str] = None, metadata: Optional[Dict[str, str]] = None):
+                      p2p_address: Optional[str] = None, metadata: Optional[Dict[str, str]] = None,
+                      shard: Optional[str] = None, vector: Optional[List[float]] = None):
         """注册节点到注册中心，使用租约保证节点自动过期"""
         vk = self.sk.verifying_key
         vk_bytes = vk.to_string()
@@ -51,6 +122,7 @@ class EtcdRegistry(Registry):
             "host": host,
             "port": port,
             "p2p_address": p2p_address,
+            "shard": shard,
             "public_key": vk_base64,
             "metadata": metadata or {}
         }
@@ -65,51 +137,200 @@ class EtcdRegistry(Registry):
 
         # 创建租约，设置TTL，自动删除失效节点
         lease = self.etcd_client.lease(self.ttl)
-        self.leases[node_id] = lease
+        node_entry_json = json.dumps(node_entry)
+        key = self.__key(node_id, shard)
+        self.etcd_client.put(key, node_entry_json, lease=lease)
 
-        key = f"/{self.parent_node_id}/{node_id}"
-        self.etcd_client.put(key, json.dumps(node_entry), lease=lease)
+        with self.keepalive_lock:
+            self.leases[node_id] = lease
+            self.lost_leases.discard(node_id)
+            self.local_nodes[node_id] = dict(host=host, port=port, p2p_address=p2p_address, metadata=metadata,
+                                             shard=shard)
+            # We just signed this entry ourselves, no need to verify it again.
+            self.verified_entries[node_id] = node_entry_json.encode("utf-8")
+            if self.keepalive_thread is None:
+                self.keepalive_thread = threading.Thread(target=self.__keepalive_loop, daemon=True)
+                self.keepalive_thread.start()
 
         logger.info(f"Node {node_id} registered with info: {node_info}")
 
     def lease_refresh(self, node_id: str):
-        """启动后台线程进行自动续约"""
-        lease_refresh_response = None
+        """Leases are renewed by the shared keepalive stream, this only re-registers a node whose lease was lost."""
         try:
+            if node_id in self.lost_leases:
+                logger.warning(f"Lease of node {node_id} was lost, registering again.")
+                self.register_node(node_id, **self.local_nodes[node_id])
+                return
             self.__verify_signature(node_id)
-            self.leases[node_id].refresh()
-            # logger.debug(f"Lease renewed for node: {node_id}, response: {lease_refresh_response}")
         except Exception as e:
-            logger.exception(f"Lease renewal failed for node {node_id}, response: {lease_refresh_response}: {e}")
+            logger.exception(f"Lease renewal failed for node {node_id}: {e}")
+
+    def __keepalive_requests(self):
+        while True:
+            with self.keepalive_lock:
+                lease_ids = [(node_id, lease.id) for node_id, lease in self.leases.items()]
+            for _, lease_id in lease_ids:
+                yield etcdrpc.LeaseKeepAliveRequest(ID=lease_id)
+            time.sleep(max(1.0, self.ttl / 3))
+
+    def __keepalive_loop(self):
+        """One bidirectional LeaseKeepAlive stream renews every local lease."""
+        while True:
+            try:
+                responses = self.etcd_client.leasestub.LeaseKeepAlive(
+                    self.__keepalive_requests(),
+                    credentials=self.etcd_client.call_credentials,
+                    metadata=self.etcd_client.metadata
+                )
+                for response in responses:
+                    if response.TTL <= 0:
+                        with self.keepalive_lock:
+                            for node_id, lease in self.leases.items():
+                                if lease.id == response.ID:
+                                    self.lost_leases.add(node_id)
+            except Exception:
+                logger.exception("Etcd lease keepalive stream error, reconnecting.")
+                time.sleep(1)
 
     def get_available_nodes(self) -> Dict[str, dict]:
         """获取当前可用节点列表"""
+        if self.__ensure_cache():
+            return dict(self.nodes_cache)
+        return self.__scan_nodes()
+
+    def __ensure_cache(self) -> bool:
+        with self.watch_lock:
+            if self.watch_thread is None:
+                self.watch_thread = threading.Thread(target=self._watch_loop, daemon=True)
+                self.watch_thread.start()
+        return self.cache_ready.wait(self.cache_timeout)
+
+    def __key(self, node_id: str, shard: Optional[str]) -> str:
+        return f"/{self.parent_node_id}/{shard or DEFAULT_SHARD}/{node_id}"
+
+    def __prefixes(self, shards: Optional[List[str]]) -> List[str]:
+        if shards is None:
+            return [f"/{self.parent_node_id}/"]
+        return [f"/{self.parent_node_id}/{shard}/" for shard in shards]
+
+    def __scan_nodes(self, shards: Optional[List[str]] = None) -> Dict[str, dict]:
         nodes = {}
-        for value, metadata in self.etcd_client.get_prefix(f"/{self.parent_node_id}/"):
-            node_id = metadata.key.decode("utf-8").split(f"/{self.parent_node_id}/")[-1]
-            try:
-                nodes[node_id] = json.loads(value.decode("utf-8"))['node_info']
-            except Exception as e:
-                logger.exception(f"Error decoding node {node_id}: {e}")
+        for prefix in self.__prefixes(shards if shards is not None else self.shards):
+            for value, metadata in self.etcd_client.get_prefix(prefix):
+                node_id = self.__node_id_of(metadata.key)
+                try:
+                    nodes[node_id] = json.loads(value.decode("utf-8"))['node_info']
+                except Exception as e:
+                    logger.exception(f"Error decoding node {node_id}: {e}")
         return nodes
 
+    def get_nodes_in_shards(self, shards: List[str]) -> Dict[str, dict]:
+        """Nodes of `shards`, from the cache when they are all watched, else one scan of their prefixes."""
+        if self.shards is None or set(shards) <= set(self.shards):
+            return super().get_nodes_in_shards(shards)
+        return self.__scan_nodes(shards)
+
+    def _watch_loop(self):
+        """One watch stream per watched prefix, the extra ones on their own threads."""
+        prefixes = self.__prefixes(self.shards)
+        for prefix in prefixes[1:]:
+            threading.Thread(target=self.__watch_prefix, args=(prefix,), daemon=True).start()
+        self.__watch_prefix(prefixes[0])
+
+    def __watch_prefix(self, prefix: str):
+        """Keep the prefix's nodes current with etcd's native prefix watch, resuming right after the snapshot revision."""
+        while True:
+            try:
+                response = self.etcd_client.get_prefix_response(prefix)
+                nodes = {}
+                raw_entries = {}
+                # node_id -> key it was last put under, only this thread reads it
+                keys = {}
+                for kv in response.kvs:
+                    self.__apply_put(nodes, raw_entries, kv.key, kv.value)
+                    keys[self.__node_id_of(kv.key)] = kv.key
+                self.__publish(prefix, nodes, raw_entries)
+                events_iterator, cancel = self.etcd_client.watch_prefix(
+                    prefix, start_revision=response.header.revision + 1)
+                for event in events_iterator:
+                    # Copy on write, readers of nodes_cache never see a dict being mutated.
+                    nodes = dict(nodes)
+                    raw_entries = dict(raw_entries)
+                    if isinstance(event, PutEvent):
+                        self.__apply_put(nodes, raw_entries, event.key, event.value)
+                        keys[self.__node_id_of(event.key)] = event.key
+                    elif isinstance(event, DeleteEvent):
+                        node_id = self.__node_id_of(event.key)
+                        # a node moved under another key keeps the entry of its new key
+                        if keys.get(node_id) != event.key:
+                            continue
+                        keys.pop(node_id)
+                        nodes.pop(node_id, None)
+                        raw_entries.pop(node_id, None)
+                    self.__publish(prefix, nodes, raw_entries)
+            except Exception:
+                logger.exception(f"Etcd watch error on {prefix}, resubscribing.")
+                with self.prefix_lock:
+                    self.prefix_caches.pop(prefix, None)
+                    self.cache_ready.clear()
+                time.sleep(self.watch_interval)
+
+    def __publish(self, prefix: str, nodes: Dict[str, dict], raw_entries: Dict[str, bytes]):
+        with self.prefix_lock:
+            self.prefix_caches[prefix] = (nodes, raw_entries)
+            if len(self.prefix_caches) < len(self.__prefixes(self.shards)):
+                return
+            if len(self.prefix_caches) == 1:
+                self.nodes_cache, self.raw_entries = nodes, raw_entries
+            else:
+                merged_nodes, merged_raw_entries = {}, {}
+                for prefix_nodes, prefix_raw_entries in self.prefix_caches.values():
+                    merged_nodes.update(prefix_nodes)
+                    merged_raw_entries.update(prefix_raw_entries)
+                self.nodes_cache, self.raw_entries = merged_nodes, merged_raw_entries
+            self.cache_ready.set()
+            nodes = dict(self.nodes_cache)
+        self._notify_watchers(nodes)
+
+    def __node_id_of(self, key: bytes) -> str:
+        return key.decode("utf-8").rsplit("/", 1)[-1]
+
+    def __apply_put(self, nodes, raw_entries, key: bytes, value: bytes):
+        node_id = self.__node_id_of(key)
+        try:
+            nodes[node_id] = json.loads(value.decode("utf-8"))['node_info']
+            raw_entries[node_id] = value
+        except Exception as e:
+            logger.exception(f"Error decoding node {node_id}: {e}")
+
     def deregister_node(self, node_id: str):
         """从注册中心移除节点并撤销租约"""
-        key = f"/{self.parent_node_id}/{node_id}"
+        local_node = self.local_nodes.get(node_id) or {}
+        key = self.__key(node_id, local_node.get("shard"))
         self.__verify_signature(node_id)
         self.etcd_client.delete(key)
-        if node_id in self.leases:
-            self.leases[node_id].revoke()
-            del self.leases[node_id]
+        with self.keepalive_lock:
+            lease = self.leases.pop(node_id, None)
+            self.local_nodes.pop(node_id, None)
+            self.lost_leases.discard(node_id)
+            self.verified_entries.pop(node_id, None)
+        if lease:
+            lease.revoke()
         logger.info(f"Node {node_id} deregistered.")
 
     def __verify_signature(self, node_id):
-        key = f"/{self.parent_node_id}/{node_id}"
-        node_entry_json = self.etcd_client.get(key)[0]
+        """Verify the stored entry of node_id, skipped when it is unchanged since the last successful check."""
+        node_entry_json = self.raw_entries.get(node_id) if self.cache_ready.is_set() else None
+        if node_entry_json is None:
+            key = self.__key(node_id, (self.local_nodes.get(node_id) or {}).get("shard"))
+            node_entry_json = self.etcd_client.get(key)[0]
 
         if not node_entry_json:
             raise ValueError(f"Node {node_id} not found")
 
+        if self.verified_entries.get(node_id) == node_entry_json:
+            return
+
         node_entry = json.loads(node_entry_json.decode("utf-8"))
         node_info = node_entry["node_info"]
         node_base64_signature = node_entry["signature"]
@@ -126,3 +347,5 @@ class EtcdRegistry(Registry):
 
         if not vk.verify(calculated_signature, node_info_json):
             raise ValueError(f"Node {node_id} has an invalid signature!")
+
+        self.verified_entries[node_id] = node_entry_json
@@ -0,0 +1,385 @@
+import json
+import math
+import random
+import threading
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from isek.util.logger import logger
+
+ALIVE = "alive"
+SUSPECT = "suspect"
+DEAD = "dead"
+# Gossip messages share the call_peer channel with agent messages, this key tells them apart.
+GOSSIP_KEY = "isek_gossip"
+GOSSIP_PREFIX = '{"' + GOSSIP_KEY + '"'
+
+
+class GossipMembership(object):
+    """
+    SWIM membership over a request/reply transport, without a central registry.
+
+    Every `protocol_interval` the node probes one member, in a shuffled round-robin order: a direct
+    ping, and when that gets no ack, ping-req through `indirect_checks` other members. A member
+    nobody can reach is suspected, and declared dead when it does not refute the suspicion within
+    the suspicion timeout. A member refutes by raising its incarnation number.
+
+    Membership updates (joins with their node_info, suspicions, deaths) are piggybacked on the
+    pings and acks: at most `max_piggyback` per message, each retransmitted about
+    `retransmit_mult` * log(N) times, so updates reach everyone in O(log N) rounds while a node
+    sends one probe per interval whatever the network size. Every `sync_every` periods the node
+    also exchanges its recently changed members with one random member (push-pull anti-entropy):
+    each change is sent in about `retransmit_mult` * log(N) syncs, at most `sync_size` per message,
+    which repairs the rare update whose piggybacked retransmissions all missed a node. Only a
+    joining node gets the full member list.
+
+    `on_change` gets the members believed up after changes, on `notifier` (a thread of its own by
+    default), one call at a time and always with the latest membership, so a slow callback never
+    holds up gossip and never sees an older membership after a newer one.
+
+    `send(p2p_address, message, timeout)` delivers a message and returns the reply, raising on failure.
+    Incoming messages for which `is_gossip` is true are answered with `handle`. Many memberships in
+    one process can share `executor` for their ping-reqs and `notifier`, and be probed by one caller
+    (see AgentHost).
+    """
+
+    def __init__(self,
+                 node_info: dict,
+                 send: Callable[[str, str, float], str],
+                 seeds: Optional[List[str]] = None,
+                 on_change: Optional[Callable[[Dict[str, dict]], None]] = None,
+                 protocol_interval: float = 2.0,
+                 ping_timeout: float = 1.0,
+                 indirect_checks: int = 3,
+                 suspicion_mult: int = 4,
+                 retransmit_mult: int = 3,
+                 max_piggyback: int = 8,
+                 sync_every: int = 15,
+                 sync_size: int = 64,
+                 dead_retention: float = 300,
+                 executor: Optional[Executor] = None,
+                 notifier: Optional[Executor] = None):
+        self.node_info = node_info
+        self.node_id = node_info["node_id"]
+        self.incarnation = 0
+        self.send = send
+        self.seeds = list(seeds or [])
+        self.on_change = on_change
+        self.protocol_interval = protocol_interval
+        self.ping_timeout = ping_timeout
+        self.indirect_checks = indirect_checks
+        self.suspicion_mult = suspicion_mult
+        self.retransmit_mult = retransmit_mult
+        self.max_piggyback = max_piggyback
+        self.sync_every = sync_every
+        self.sync_size = sync_size
+        self.dead_retention = dead_retention
+
+        self.lock = threading.RLock()
+        # node_id -> {"node_info", "incarnation", "state", "state_since", "synced"}, dead members stay
+        # as tombstones for dead_retention seconds so stale alive updates cannot revive them. "synced"
+        # counts the syncs that carried the member's current state.
+        self.members: Dict[str, dict] = {}
+        # node_id -> [update, times sent], one pending update per member
+        self.broadcasts: Dict[str, list] = {}
+        self.probe_order = []
+        self.probe_index = 0
+        self.periods = 0
+        self.stopped = threading.Event()
+        self.thread = None
+        self.executor = executor or ThreadPoolExecutor(max_workers=max(1, indirect_checks))
+        self.notifier = notifier or ThreadPoolExecutor(max_workers=1, thread_name_prefix="gossip-notify")
+        self.owns_notifier = notifier is None
+        # a change on_change has not seen yet / an on_change delivery loop is running
+        self.notify_pending = False
+        self.notifying = False
+        self.__queue_update(self.__self_update())
+
+    @staticmethod
+    def is_gossip(message: str) -> bool:
+        return isinstance(message, str) and message.startswith(GOSSIP_PREFIX)
+
+    def start(self, probe_loop: bool = True):
+        """Join through the seeds and start probing, unless the caller runs `probe` itself."""
+        self.join(self.seeds)
+        if probe_loop:
+            self.thread = threading.Thread(target=self.__probe_loop, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.owns_notifier:
+            self.notifier.shutdown(wait=False)
+
+    def nodes(self) -> Dict[str, dict]:
+        """node_id -> node_info of the members believed up, suspected ones included."""
+        with self.lock:
+            return {node_id: member["node_info"] for node_id, member in self.members.items()
+                    if member["state"] != DEAD}
+
+    def join(self, seeds: List[str]) -> bool:
+        """Announce this node to the seeds, and learn the full membership from the first that answers."""
+        for seed in seeds:
+            if seed == self.node_info.get("p2p_address"):
+                continue
+            reply = self.__request(seed, {"type": "join", "updates": [self.__self_update()]})
+            if reply is not None:
+                self.__merge(reply.get("members", []))
+                return True
+        return False
+
+    def leave(self):
+        """Announce this node's departure to a few members, and stop probing."""
+        with self.lock:
+            self.incarnation += 1
+            farewell = {"node_id": self.node_id, "state": DEAD, "incarnation": self.incarnation}
+            targets = [member["node_info"].get("p2p_address") for member in self.members.values()
+                       if member["state"] != DEAD]
+        for address in random.sample(targets, min(len(targets), self.indirect_checks)):
+            self.__request(address, {"type": "ping", "updates": [farewell]})
+        self.stop()
+
+    def update_self(self, node_info: dict):
+        """Publish new node_info of this node, for example a changed p2p address or metadata."""
+        with self.lock:
+            self.node_info = node_info
+            self.incarnation += 1
+            self.__queue_update(self.__self_update())
+
+    def handle(self, message: str) -> str:
+        """Answer a gossip message received over the transport."""
+        payload = json.loads(message)[GOSSIP_KEY]
+        self.__merge(payload.get("updates", []))
+        message_type = payload.get("type")
+        reply = {"type": "ack"}
+        if message_type in ("join", "sync"):
+            self.__merge(payload.get("members", []))
+            reply["members"] = self.__member_updates() if message_type == "join" else self.__sync_updates()
+            with self.lock:
+                tombstone = self.members.get(payload.get("sender"))
+                if tombstone is not None and tombstone["state"] == DEAD:
+                    # A restarted node starts over at incarnation 0, hand it its death notice to refute.
+                    reply["members"].append({"node_id": payload["sender"], "state": DEAD,
+                                             "incarnation": tombstone["incarnation"]})
+        elif message_type == "ping_req":
+            # Probe the target on behalf of the sender, who could not reach it directly.
+            if self.__request(payload["target"], {"type": "ping"}) is None:
+                reply["type"] = "nack"
+        return self.__encode(reply)
+
+    def probe(self):
+        """One protocol period: probe the next member, suspect it if nobody can reach it, expire old suspicions."""
+        target = self.__next_target()
+        if target is None:
+            if self.seeds:
+                self.join(self.seeds)
+        else:
+            node_id, address = target
+            if not self.__ping(address):
+                logger.debug(f"[{self.node_id}] Member {node_id} did not ack, suspecting it.")
+                self.__suspect(node_id)
+        self.periods += 1
+        if self.sync_every and self.periods % self.sync_every == 0:
+            self.__sync()
+        self.__expire()
+
+    def __sync(self):
+        """Push-pull anti-entropy: swap recently changed members with one random live member."""
+        with self.lock:
+            addresses = [member["node_info"].get("p2p_address") for member in self.members.values()
+                         if member["state"] == ALIVE]
+        if addresses:
+            reply = self.__request(random.choice(addresses), {"type": "sync", "members": self.__sync_updates()})
+            if reply is not None:
+                self.__merge(reply.get("members", []))
+
+    def __probe_loop(self):
+        while not self.stopped.wait(self.protocol_interval):
+            try:
+                self.probe()
+            except Exception:
+                logger.exception(f"[{self.node_id}] Gossip probe error.")
+
+    def __ping(self, address: str) -> bool:
+        if self.__request(address, {"type": "ping"}) is not None:
+            return True
+        with self.lock:
+            relays = [member["node_info"].get("p2p_address") for member in self.members.values()
+                      if member["state"] == ALIVE and member["node_info"].get("p2p_address") != address]
+        relays = random.sample(relays, min(len(relays), self.indirect_checks))
+        replies = self.executor.map(
+            lambda relay: self.__request(relay, {"type": "ping_req", "target": address}, self.ping_timeout * 2),
+            relays)
+        return any(reply is not None and reply.get("type") == "ack" for reply in replies)
+
+    def __request(self, address: str, payload: dict, timeout: Optional[float] = None) -> Optional[dict]:
+        """Send payload with piggybacked updates, merge the reply's updates, None when there is no reply."""
+        if not address:
+            return None
+        try:
+            reply = self.send(address, self.__encode(payload), timeout or self.ping_timeout)
+            reply_payload = json.loads(reply)[GOSSIP_KEY]
+        except Exception:
+            return None
+        self.__merge(reply_payload.get("updates", []))
+        return reply_payload
+
+    def __encode(self, payload: dict) -> str:
+        payload = dict(payload, sender=self.node_id)
+        payload["updates"] = payload.get("updates", []) + self.__take_broadcasts()
+        return json.dumps({GOSSIP_KEY: payload})
+
+    def __self_update(self) -> dict:
+        return {"node_id": self.node_id, "state": ALIVE, "incarnation": self.incarnation, "node_info": self.node_info}
+
+    @staticmethod
+    def __member_update(node_id: str, member: dict) -> dict:
+        return {"node_id": node_id, "state": member["state"], "incarnation": member["incarnation"],
+                "node_info": member["node_info"]}
+
+    def __member_updates(self) -> List[dict]:
+        """Every member believed up, for a joining node."""
+        with self.lock:
+            updates = [self.__member_update(node_id, member)
+                       for node_id, member in self.members.items() if member["state"] != DEAD]
+        return updates + [self.__self_update()]
+
+    def __sync_updates(self) -> List[dict]:
+        """The least synced members still within the retransmit limit, at most sync_size of them."""
+        with self.lock:
+            limit = self.__retransmit_limit()
+            recent = sorted(((member["synced"], node_id) for node_id, member in self.members.items()
+                             if member["synced"] < limit))[:self.sync_size]
+            updates = []
+            for _, node_id in recent:
+                member = self.members[node_id]
+                member["synced"] += 1
+                updates.append(self.__member_update(node_id, member))
+        return updates + [self.__self_update()]
+
+    def __retransmit_limit(self) -> int:
+        return self.retransmit_mult * max(1, math.ceil(math.log2(len(self.members) + 2)))
+
+    def __queue_update(self, update: dict):
+        with self.lock:
+            self.broadcasts[update["node_id"]] = [update, 0]
+
+    def __take_broadcasts(self) -> List[dict]:
+        """The least sent pending updates, at most max_piggyback of them."""
+        with self.lock:
+            limit = self.__retransmit_limit()
+            pending = sorted(self.broadcasts.items(), key=lambda item: item[1][1])[:self.max_piggyback]
+            updates = []
+            for node_id, entry in pending:
+                updates.append(entry[0])
+                entry[1] += 1
+                if entry[1] >= limit:
+                    self.broadcasts.pop(node_id)
+            return updates
+
+    def __merge(self, updates: List[dict]):
+        changed = False
+        with self.lock:
+            for update in updates:
+                changed = self.__apply(update) or changed
+        if changed and self.on_change:
+            self.__notify()
+
+    def __notify(self):
+        """Start delivering to on_change, or leave the change to the delivery loop already running."""
+        with self.lock:
+            self.notify_pending = True
+            if self.notifying or self.stopped.is_set():
+                return
+            self.notifying = True
+        try:
+            self.notifier.submit(self.__deliver)
+        except RuntimeError:
+            # the notifier shut down meanwhile
+            with self.lock:
+                self.notifying = False
+
+    def __deliver(self):
+        """Call on_change with the latest membership until no change is left undelivered."""
+        while True:
+            with self.lock:
+                if not self.notify_pending or self.stopped.is_set():
+                    self.notifying = False
+                    return
+                self.notify_pending = False
+                nodes = self.nodes()
+            try:
+                self.on_change(nodes)
+            except Exception:
+                logger.exception(f"[{self.node_id}] Gossip membership callback error.")
+
+    def __apply(self, update: dict) -> bool:
+        """Apply one update under SWIM's incarnation rules, True when the visible membership changed."""
+        node_id = update["node_id"]
+        state = update["state"]
+        incarnation = update["incarnation"]
+        if node_id == self.node_id:
+            if state != ALIVE and incarnation >= self.incarnation:
+                # Refute a suspicion or death notice about ourselves.
+                self.incarnation = incarnation + 1
+                self.__queue_update(self.__self_update())
+            return False
+        member = self.members.get(node_id)
+        if state == ALIVE:
+            if member is not None and incarnation <= member["incarnation"]:
+                return False
+            self.members[node_id] = {"node_info": update["node_info"], "incarnation": incarnation,
+                                     "state": ALIVE, "state_since": time.time(), "synced": 0}
+            self.__queue_update(update)
+            return member is None or member["state"] == DEAD or member["node_info"] != update["node_info"]
+        if member is None or member["state"] == DEAD:
+            return False
+        if state == SUSPECT:
+            if incarnation < member["incarnation"] or (member["state"] == SUSPECT
+                                                       and incarnation == member["incarnation"]):
+                return False
+            member.update(state=SUSPECT, incarnation=incarnation, state_since=time.time(), synced=0)
+            self.__queue_update(update)
+            return False
+        if incarnation < member["incarnation"]:
+            return False
+        member.update(state=DEAD, incarnation=incarnation, state_since=time.time(), synced=0)
+        self.__queue_update(update)
+        return True
+
+    def __suspect(self, node_id: str):
+        with self.lock:
+            member = self.members.get(node_id)
+            if member is None or member["state"] != ALIVE:
+                return
+            update = {"node_id": node_id, "state": SUSPECT, "incarnation": member["incarnation"]}
+        self.__merge([update])
+
+    def __expire(self):
+        """Declare suspects dead after the suspicion timeout, which grows with log(N), and drop old tombstones."""
+        now = time.time()
+        with self.lock:
+            timeout = self.suspicion_mult * max(1.0, math.log10(len(self.members) + 1)) * self.protocol_interval
+            dead = [{"node_id": node_id, "state": DEAD, "incarnation": member["incarnation"]}
+                    for node_id, member in self.members.items()
+                    if member["state"] == SUSPECT and now - member["state_since"] > timeout]
+            for node_id in [node_id for node_id, member in self.members.items()
+                            if member["state"] == DEAD and now - member["state_since"] > self.dead_retention]:
+                self.members.pop(node_id)
+        self.__merge(dead)
+
+    def __next_target(self):
+        """Next member to probe in a randomized round-robin, reshuffled after every full round."""
+        with self.lock:
+            if self.probe_index >= len(self.probe_order):
+                self.probe_order = [node_id for node_id, member in self.members.items() if member["state"] != DEAD]
+                random.shuffle(self.probe_order)
+                self.probe_index = 0
+            while self.probe_index < len(self.probe_order):
+                node_id = self.probe_order[self.probe_index]
+                self.probe_index += 1
+                member = self.members.get(node_id)
+                if member is not None and member["state"] != DEAD:
+                    return node_id, member["node_info"].get("p2p_address")
+            return None
@@ -1,70 +1,204 @@
-import json
-from typing import Optional, Dict
+import threading
+import time
+from typing import Optional, Dict, List
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from isek.util.logger import logger
 from isek.node.registry import Registry
 
+try:
+    import orjson
+
+    def loads_response(response):
+        return orjson.loads(response.content)
+except ImportError:
+    def loads_response(response):
+        return response.json()
+
 
 class IsekCenterRegistry(Registry):
     def __init__(self,
                  host: Optional[str] = "localhost",
                  port: Optional[int] = 8088,
+                 watch_timeout: float = 30,
+                 heartbeat_interval: float = 5,
+                 connect_timeout: float = 3,
+                 read_timeout: float = 10,
+                 retries: int = 2,
+                 pool_size: int = 10,
+                 shards: Optional[List[str]] = None,
                  ):
+        super().__init__(heartbeat_interval=heartbeat_interval, shards=shards)
+        self.watch_timeout = watch_timeout
         self.center_address = f"http://{host}:{port}"
-        self.node_info = {}
+        # Every request is bounded, a hung center must not freeze the heartbeat or watch thread.
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # One pooled session for all nodes of the process, heartbeats reuse its keep-alive connections.
+        # Failed connects and gateway errors are retried. Read timeouts are not, a request the center
+        # may already have applied is not sent twice and a long-poll is not stretched.
+        self.session = requests.Session()
+        retry = Retry(total=retries, read=0, backoff_factor=0.2, status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset(["GET", "POST"]), raise_on_status=False)
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry))
+        # node_id -> registration payload of nodes registered through this registry
+        self.node_infos: Dict[str, dict] = {}
+        # Local mirror of the center's node list, kept current by applying revision deltas.
+        self.nodes_mirror: Dict[str, dict] = {}
+        # revisions of the mirror count within the center's epoch, a new epoch brings a full list
+        self.epoch = None
+        self.revision = None
+        self.mirror_lock = threading.Lock()
 
     def register_node(self, node_id: str, host: str, port: int,
-                      p2p_address: Optional[str] = None, metadata: Optional[Dict[str, str]] = None):
+                      p2p_address: Optional[str] = None, metadata: Optional[Dict[str, str]] = None,
+                      shard: Optional[str] = None, vector: Optional[List[float]] = None):
         """注册节点到注册中心，使用租约保证节点自动过期"""
 
-        register_url = f"{self.center_address}/isek_center/register"
-        self.node_info = {
+        node_info = {
             "node_id": node_id,
             "host": host,
             "port": port,
             "p2p_address": p2p_address,
+            "shard": shard,
             "metadata": metadata or {}
         }
+        if vector is not None:
+            node_info["vector"] = [float(x) for x in vector]
+        self.__register(node_info)
+        self.node_infos[node_id] = node_info
 
-        response = requests.post(url=register_url, json=self.node_info)
-        response_json = json.loads(response.content)
+    def __register(self, node_info):
+        node_id = node_info["node_id"]
+        response_json = self.__post("register", node_info)
         if response_json['code'] != 200:
             raise RuntimeError(f'Register isek center error {response_json}')
-        logger.debug(f"Node {node_id} registered, response info: {response.content}")
+        logger.debug(f"Node {node_id} registered, response info: {response_json}")
+
+    def __post(self, path, payload):
+        response = self.session.post(url=f"{self.center_address}/isek_center/{path}", json=payload,
+                                     timeout=(self.connect_timeout, self.read_timeout))
+        return loads_response(response)
 
     def lease_refresh(self, node_id: str):
-        lease_refresh_url = f"{self.center_address}/isek_center/renew"
         node_info = {
             "node_id": node_id,
         }
 
-        response = requests.post(url=lease_refresh_url, json=node_info)
-        response_json = json.loads(response.content)
+        response_json = self.__post("renew", node_info)
+        if response_json['code'] == 400 and node_id in self.node_infos:
+            # The center lost our lease (expired, or restarted without its lease log), register again.
+            logger.warning(f"Lease of node {node_id} rejected by isek center, registering again.")
+            self.__register(self.node_infos[node_id])
+            return
         if response_json['code'] != 200:
-            raise RuntimeError(f'deregister from isek center error {response_json}')
+            raise RuntimeError(f'Lease refresh from isek center error {response_json}')
         # logger.debug(f"Node {node_id} lease refresh.")
 
+    def lease_refresh_many(self, node_ids):
+        """Renew all given nodes with one batched request, registering again the ones the center lost."""
+        response_json = self.__post("renew", {"node_ids": list(node_ids)})
+        if response_json['code'] != 200:
+            raise RuntimeError(f'Lease refresh from isek center error {response_json}')
+        for node_id in response_json['data']['missing']:
+            if node_id not in self.node_infos:
+                continue
+            logger.warning(f"Lease of node {node_id} rejected by isek center, registering again.")
+            try:
+                self.__register(self.node_infos[node_id])
+            except Exception:
+                logger.exception(f"Register node {node_id} again failed.")
+
+    def get_available_nodes(self, wait: float = 0) -> Dict[str, dict]:
+        """获取当前可用节点列表
 
-    def get_available_nodes(self) -> Dict[str, dict]:
-        """获取当前可用节点列表"""
+        Args:
+            wait: long-poll up to this many seconds for a membership change before answering.
+        """
         register_url = f"{self.center_address}/isek_center/available_nodes"
-        response = requests.get(url=register_url)
-        response_json = json.loads(response.content)
+        # The request runs outside the lock so a long-poll does not block other callers.
+        since, epoch = self.revision, self.epoch
+        params = {"shard": self.shards} if self.shards else {}
+        headers = {}
+        if since is not None:
+            params["since"] = since
+            if epoch is not None:
+                params["epoch"] = epoch
+            headers["If-None-Match"] = f'"{epoch}:{since}"'
+            if wait > 0:
+                params["wait"] = wait
+        # A long-poll is answered after up to `wait` seconds, allow for that on top of the read timeout.
+        response = self.session.get(url=register_url, params=params, headers=headers,
+                                    timeout=(self.connect_timeout, self.read_timeout + params.get("wait", 0)))
+        with self.mirror_lock:
+            if response.status_code != 304:
+                response_json = loads_response(response)
+                if response_json['code'] != 200:
+                    raise RuntimeError(f'Get available nodes from isek center error {response_json}')
+                self.__apply_nodes_response(response_json['data'])
+            return dict(self.nodes_mirror)
+
+    def get_shard_summaries(self) -> Dict[str, dict]:
+        """The center's per-shard node count, revision and intro centroid."""
+        response = self.session.get(url=f"{self.center_address}/isek_center/shards",
+                                    timeout=(self.connect_timeout, self.read_timeout))
+        response_json = loads_response(response)
+        if response_json['code'] != 200:
+            raise RuntimeError(f'Get shards from isek center error {response_json}')
+        return response_json['data']['shards']
+
+    def get_nodes_in_shards(self, shards: List[str]) -> Dict[str, dict]:
+        """One full listing of `shards`, outside the mirror of the watched shards."""
+        response = self.session.get(url=f"{self.center_address}/isek_center/available_nodes",
+                                    params={"shard": list(shards)},
+                                    timeout=(self.connect_timeout, self.read_timeout))
+        response_json = loads_response(response)
         if response_json['code'] != 200:
             raise RuntimeError(f'Get available nodes from isek center error {response_json}')
         return response_json['data']['available_nodes']
 
+    def _watch_loop(self):
+        """Long-poll the center, so changes arrive right away and a stable membership costs one request per timeout."""
+        while True:
+            revision = (self.epoch, self.revision)
+            try:
+                nodes = self.get_available_nodes(wait=self.watch_timeout)
+            except Exception:
+                logger.exception("Watch isek center error.")
+                time.sleep(self.watch_interval)
+                continue
+            if (self.epoch, self.revision) != revision:
+                self._notify_watchers(nodes)
+
+    def __apply_nodes_response(self, data):
+        # Responses to concurrent requests may arrive out of order, never move the mirror back.
+        # A delta is only sent for the epoch the request named, a full list of another epoch
+        # replaces the mirror whatever its revision.
+        full = data.get("full", True)
+        if self.revision is not None and data.get("revision") is not None and data["revision"] <= self.revision \
+                and (not full or data.get("epoch") == self.epoch):
+            return
+        if full:
+            self.nodes_mirror = dict(data["available_nodes"])
+        else:
+            self.nodes_mirror.update(data["added"])
+            self.nodes_mirror.update(data["changed"])
+            for node_id in data["removed"]:
+                self.nodes_mirror.pop(node_id, None)
+        self.revision = data.get("revision")
+        self.epoch = data.get("epoch")
+
     def deregister_node(self, node_id: str):
         """从注册中心移除节点并撤销租约"""
-        register_url = f"{self.center_address}/isek_center/deregister"
         node_info = {
             "node_id": node_id,
         }
 
-        response = requests.post(url=register_url, json=node_info)
-        response_json = json.loads(response.content)
+        response_json = self.__post("deregister", node_info)
         if response_json['code'] != 200:
             raise RuntimeError(f'deregister from isek center error {response_json}')
+        self.node_infos.pop(node_id, None)
         logger.info(f"Node {node_id} deregistered.")
@@ -0,0 +1,67 @@
+import threading
+from concurrent import futures
+from concurrent.futures import Executor, Future
+from typing import Callable, Dict, Optional, Tuple
+
+from isek.node.noderpc import node_pb2
+
+
+class LocalTransport(object):
+    """
+    Delivers messages between nodes of the same process without gRPC or the p2p network.
+
+    Every node registers the address other nodes know it by (host:port for a Node, the p2p
+    address for a P2PNode) with a handler `handler(sender_node_id, message) -> reply` and the
+    executor its gRPC server runs on. A sender that finds the receiver's address here submits the
+    message to that executor, so local messages take the receiver's workers as remote ones do, and
+    a node handling a message can message other local nodes without waiting on a pool it holds
+    itself. The sender gets a Future of the reply. Nodes registered without an executor share the
+    transport's own.
+
+    With serialize the request and reply go through their protobuf encoding both ways, as they
+    would on the wire, so tests see the same copies and type checks as remote calls.
+    """
+
+    def __init__(self, max_workers: int = 32):
+        # a ThreadPoolExecutor is a work queue with workers started on demand
+        self.executor = futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="local-node")
+        self.lock = threading.Lock()
+        # address -> (handler, executor of the receiving node)
+        self.handlers: Dict[str, Tuple[Callable[[str, str], str], Executor]] = {}
+
+    def register(self, address: str, handler: Callable[[str, str], str], executor: Optional[Executor] = None):
+        if not address:
+            return
+        with self.lock:
+            self.handlers[address] = (handler, executor or self.executor)
+
+    def unregister(self, address: str, handler: Optional[Callable[[str, str], str]] = None):
+        """Forget `address`, only while it still maps to `handler` when that is given."""
+        with self.lock:
+            registered = self.handlers.get(address)
+            if registered is not None and (handler is None or registered[0] == handler):
+                self.handlers.pop(address)
+
+    def is_local(self, address: str) -> bool:
+        return address in self.handlers
+
+    def send(self, sender_node_id: str, address: str, message: str, serialize: bool = False) -> Optional[Future]:
+        """Queue `message` for the node at `address`, None when that node is not in this process."""
+        registered = self.handlers.get(address)
+        if registered is None:
+            return None
+        handler, executor = registered
+        if serialize:
+            payload = node_pb2.CallRequest(sender_node_id=sender_node_id, message=message).SerializeToString()
+            return executor.submit(self.__deliver_serialized, handler, payload)
+        return executor.submit(handler, sender_node_id, message)
+
+    @staticmethod
+    def __deliver_serialized(handler, payload):
+        request = node_pb2.CallRequest.FromString(payload)
+        reply = node_pb2.CallResponse(reply=handler(request.sender_node_id, request.message)).SerializeToString()
+        return node_pb2.CallResponse.FromString(reply).reply
+
+
+# The nodes of this process, shared by every Node and P2PNode.
+local_transport = LocalTransport()
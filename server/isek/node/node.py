@@ -1,5 +1,6 @@
+import itertools
 import json
-import threading
+import time
 from abc import ABC, abstractmethod
 from concurrent import futures
 from typing import Dict
@@ -16,6 +17,7 @@ from isek.util.logger import logger
 from isek.node.node_index import NodeIndex
 from isek.embedding.abstract_embedding import AbstractEmbedding
 from isek.node.isek_center_registry import IsekCenterRegistry
+from isek.node.local_transport import local_transport
 
 
 class Node(node_pb2_grpc.IsekNodeServiceServicer, ABC):
@@ -24,6 +26,13 @@ class Node(node_pb2_grpc.IsekNodeServiceServicer, ABC):
                  port: int = 8080,
                  registry: Registry = IsekCenterRegistry(),
                  embedding: AbstractEmbedding = None,
+                 node_index_options: Dict = None,
+                 shard: str = None,
+                 local_delivery: bool = True,
+                 local_serialize: bool = False,
+                 call_timeout: float = 30,
+                 routed_shards: int = 3,
+                 routing_ttl: float = 10,
                  **kwargs
                  ):
         if not host or not port or not registry:
@@ -32,10 +41,24 @@ class Node(node_pb2_grpc.IsekNodeServiceServicer, ABC):
         self.host = host
         self.port = port
         self.registry = registry
+        # capability or region this node is listed under in a sharded registry
+        self.shard = shard
+        # Messages to nodes of this process skip gRPC, local_serialize keeps the protobuf round trip for tests.
+        self.local_delivery = local_delivery
+        self.local_serialize = local_serialize
+        # deadline of a call to another node, in seconds
+        self.call_timeout = call_timeout
+        # with a sharded registry, how many best matching shards a vector search also lists
+        self.routed_shards = routed_shards
+        # seconds shard summaries and routed shard listings are reused, key -> (time, value)
+        self.routing_ttl = routing_ttl
+        self.routing_cache = {}
+        # serves gRPC and local deliveries to this node, created by build_server
+        self.executor = None
         self.all_nodes = {}
         self.node_index = None
         if embedding:
-            self.node_index = NodeIndex(embedding)
+            self.node_index = NodeIndex(embedding, **(node_index_options or {}))
         self.node_list = None
         # self.__build_server()
 
@@ -52,38 +75,41 @@ class Node(node_pb2_grpc.IsekNodeServiceServicer, ABC):
         pass
 
     def build_server(self):
-        self.registry.register_node(node_id=self.node_id, host=self.host, port=self.port, metadata=self.metadata())
-        self.__bootstrap_heartbeat()
+        metadata = self.metadata()
+        self.registry.register_node(node_id=self.node_id, host=self.host, port=self.port, metadata=metadata,
+                                    shard=self.shard, vector=self.__intro_vector(metadata))
+        self.registry.start_heartbeat(self.node_id)
+        self.registry.watch(self.__on_nodes_changed)
+        self.executor = futures.ThreadPoolExecutor(max_workers=10)
+        local_transport.register(self.__address(), self.on_message, self.executor)
         self.__bootstrap_grpc_server()
 
-    def __bootstrap_heartbeat(self):
-        self.registry.lease_refresh(self.node_id)
-        self.__refresh_nodes()
-        # logger.debug(f"{self.node_id} get all available nodes: {self.all_nodes}")
-        timer = threading.Timer(5, self.__bootstrap_heartbeat)
-        timer.daemon = True
-        timer.start()
-
-    def __refresh_nodes(self):
-        all_nodes = self.registry.get_available_nodes()
-        # todo self.node_index.compare_and_build(all_nodes)
-        # is_nodes_changed = False
-        # for node_id, node_info in all_nodes.items():
-        #     if node_id not in self.all_nodes:
-        #         is_nodes_changed = True
-        #         break
-        # if is_nodes_changed or len(all_nodes) != len(self.all_nodes):
-        #     node_ids, vectors = zip(*[(node_id, n['metadata']['intro_vector']) for node_id, n in all_nodes.items()])
-        #     vector_dim = len(vectors[0])
-        #     vectors = np.array(vectors, dtype='float32')
-        #     self.node_index = faiss.IndexFlatL2(vector_dim)
-        #     self.node_index.add(vectors)
-        #     self.node_list = node_ids
-        #     logger.debug("Node index rebuild finished.")
+    def __address(self):
+        return f"{self.host}:{self.port}"
+
+    def __intro_vector(self, metadata):
+        """This node's normalized intro embedding for its shard's centroid, None without an embedding."""
+        if self.node_index is None:
+            return None
+        try:
+            vector = np.array(self.node_index.embedding.embedding([(metadata or {}).get("intro") or ""]),
+                              dtype=np.float32, order="C")
+            faiss.normalize_L2(vector)
+            return vector[0].tolist()
+        except Exception:
+            logger.exception(f"[{self.node_id}] Intro embedding failed, registering without a vector.")
+            return None
+
+    def __on_nodes_changed(self, all_nodes):
+        if self.node_index is not None:
+            try:
+                self.node_index.compare_and_build(all_nodes)
+            except Exception:
+                logger.exception(f"[{self.node_id}] Node index update failed.")
         self.all_nodes = all_nodes
 
     def __bootstrap_grpc_server(self):
-        server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+        server = grpc.server(self.executor)
         node_pb2_grpc.add_IsekNodeServiceServicer_to_server(self, server)
 
         # 监听端口
@@ -105,29 +131,84 @@ class Node(node_pb2_grpc.IsekNodeServiceServicer, ABC):
         receiver_node = self.all_nodes.get(receiver_node_id, None)
         if not receiver_node:
             raise NodeUnavailableError(receiver_node)
+        address = f"{receiver_node['host']}:{receiver_node['port']}"
+        local = local_transport.send(self.node_id, address, message, self.local_serialize) if self.local_delivery else None
+        if local is not None:
+            reply = local.result(timeout=self.call_timeout)
+            logger.info(f"[{self.node_id}] receive message from [{receiver_node_id}]: {reply}")
+            return f"{reply}"
         # 连接到 gRPC 服务
-        channel = grpc.insecure_channel(f"{receiver_node['host']}:{receiver_node['port']}")
+        channel = grpc.insecure_channel(address)
         stub = node_pb2_grpc.IsekNodeServiceStub(channel)
 
         # 创建请求消息
         request = node_pb2.CallRequest(sender_node_id=self.node_id, receiver_node_id=receiver_node_id, message=message)
 
         # 调用远程服务方法
-        response = stub.call(request)
+        response = stub.call(request, timeout=self.call_timeout)
         # log the response
         logger.info(f"[{self.node_id}] receive message from [{receiver_node_id}]: {response.reply}")
         return f"{response.reply}"
 
-    def get_nodes_by_vector(self, query, limit=20):
-        return self.all_nodes.values()
-        # todo
-        # if len(self.all_nodes) > limit and self.node_index is not None:
-        #     node_ids = self.node_index.search(query, limit=limit)
-        #     results = [self.all_nodes[node_id] for node_id in node_ids]
-        # else:
-        #     results = self.all_nodes.values()
-        # return results
+    def get_nodes_by_vector(self, query, limit=20, min_score=None):
+        """
+        Return the nodes whose intro best matches `query`, most similar first.
+        Without a node index the first `limit` known nodes are returned, unranked.
+        With a sharded registry only the watched shards are indexed, so the nodes of the
+        `routed_shards` shards that best match `query` (see route_shards) are ranked with them.
+        """
+        if self.node_index is None:
+            return list(itertools.islice(self.all_nodes.values(), limit))
+        query_vector = self.node_index.embed([query])
+        results = [(score, self.all_nodes[node_id])
+                   for node_id, score in self.node_index.search_vectors(query_vector, limit=limit,
+                                                                        min_score=min_score)[0]
+                   if node_id in self.all_nodes]
+        if self.registry.shards is not None:
+            results += self.__search_routed_shards(query, query_vector, min_score)
+            results.sort(key=lambda result: result[0], reverse=True)
+        return [node for _, node in results[:limit]]
+
+    def __search_routed_shards(self, query, query_vector, min_score=None):
+        """(score, node) of the nodes in the best matching shards this node does not watch."""
+        shards = [shard for shard in self.route_shards(query, limit=self.routed_shards, query_vector=query_vector)
+                  if shard not in self.registry.shards]
+        nodes = [node for shard in shards for node_id, node in self.__routing_cached(
+                     ("shard", shard), lambda: self.registry.get_nodes_in_shards([shard])).items()
+                 if node_id not in self.all_nodes]
+        if not nodes:
+            return []
+        # Intros are cached by md5, a routed shard only costs embeddings for nodes new to this node.
+        vectors = self.node_index.intro_vectors([(node.get("metadata") or {}).get("intro") or "" for node in nodes])
+        scores = (vectors @ query_vector[0]).tolist()
+        return [(score, node) for score, node in zip(scores, nodes) if min_score is None or score >= min_score]
+
+    def __routing_cached(self, key, load):
+        cached = self.routing_cache.get(key)
+        if cached is not None and time.monotonic() - cached[0] < self.routing_ttl:
+            return cached[1]
+        value = load()
+        self.routing_cache[key] = (time.monotonic(), value)
+        return value
+
+    def route_shards(self, query, limit=3, query_vector=None):
+        """
+        The `limit` shards whose intro centroid best matches `query`, for listing only those with
+        `registry.get_nodes_in_shards`. Without centroids the largest shards come first.
+        `query_vector` is the query already embedded with `node_index.embed`.
+        """
+        summaries = self.__routing_cached("summaries", self.registry.get_shard_summaries)
+        scores = {shard: 0.0 for shard in summaries}
+        with_centroid = [shard for shard, summary in summaries.items() if summary.get("centroid")]
+        if self.node_index is not None and with_centroid:
+            if query_vector is None:
+                query_vector = self.node_index.embed([query])
+            centroids = np.array([summaries[shard]["centroid"] for shard in with_centroid], dtype=np.float32)
+            for shard, score in zip(with_centroid, (centroids @ query_vector[0]).tolist()):
+                # Shards without a centroid stay at 0, below any matching shard.
+                scores[shard] = 1.0 + score
+        return sorted(summaries, key=lambda shard: (scores[shard], summaries[shard]["count"]), reverse=True)[:limit]
 
     def call(self, request, context):
         # 返回消息
-        return node_pb2.CallResponse(reply=self.on_message(request.sender, request.message))
+        return node_pb2.CallResponse(reply=self.on_message(request.sender_node_id, request.message))
@@ -1,61 +1,428 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional
+
 import faiss
 import numpy as np
 from isek.util.tools import dict_md5
 from isek.util.logger import logger
 from isek.embedding.abstract_embedding import AbstractEmbedding
+from isek.node.ann_index import (INDEX_AUTO, INDEX_HNSW, INDEX_IVF_FLAT, INDEX_IVF_PQ, INDEX_TYPES,
+                                 DEFAULT_INDEX_PARAMS, build_ann_index, choose_index_type, supports_remove,
+                                 training_size)
 
 
 class NodeIndex(object):
-    def __init__(self, embedding: AbstractEmbedding):
+    """
+    Vector index over node intros, updated incrementally.
+
+    Every indexed vector gets a stable integer id in a faiss.IndexIDMap. Removed or replaced
+    vectors are tombstoned and filtered out of search results. They are physically removed in
+    one batch once they make up more than `compact_ratio` of the index, so an update costs
+    O(changed nodes) and not O(all nodes).
+
+    Vectors are L2-normalized and indexed by inner product, so search scores are cosine similarities.
+
+    `index_type` is one of "flat", "hnsw", "ivf_flat", "ivf_pq" or "auto", which picks the type
+    from the collection size using the thresholds in `index_params` (see DEFAULT_INDEX_PARAMS).
+    Trained index types are trained on the first build and whenever the chosen type changes. One
+    that fell back to flat for lack of training vectors is built again once there are enough.
+
+    With a `snapshot_dir` the index is loaded from disk on startup and saved after updates (at
+    most every `snapshot_interval` seconds, an update inside the interval is saved when it ends),
+    so restarts do not re-embed every known node. With `mmap` the snapshot is memory-mapped
+    read-only, letting processes on one host share its pages; the first update then copies it
+    into a private, writable index.
+
+    `intro_vectors` embeds intros of nodes outside the index, e.g. of shards a query was routed
+    to, keeping the last `intro_cache_size` vectors by intro md5.
+    """
+
+    def __init__(self, embedding: AbstractEmbedding, compact_ratio: float = 0.2,
+                 index_type: str = INDEX_AUTO, index_params: Optional[dict] = None,
+                 snapshot_dir: Optional[str] = None, snapshot_interval: float = 60, mmap: bool = True,
+                 intro_cache_size: int = 10000):
+        if index_type != INDEX_AUTO and index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index_type '{index_type}', expected one of {(INDEX_AUTO,) + INDEX_TYPES}")
         self.node_info_dict = {}
-        self.node_ids = []
-        self.node_index = None
+        self.id_to_node = {}
+        self.tombstones = set()
+        self.next_id = 0
         self.embedding = embedding
         self.dim = self.embedding.dim
+        self.compact_ratio = compact_ratio
+        self.index_type = index_type
+        self.index_params = {**DEFAULT_INDEX_PARAMS, **(index_params or {})}
+        # type requested for the current index, and the type actually built (may fall back to flat)
+        self.requested_index_type = None
+        self.built_index_type = None
+        self.node_index = None
+        self.mmapped = False
+        self.snapshot_dir = snapshot_dir
+        self.snapshot_interval = snapshot_interval
+        self.last_snapshot_time = 0
+        self.snapshot_timer = None
+        # data files this instance wrote to snapshot_dir, deleted once meta.json no longer names them
+        self.snapshot_files = set()
+        # updates and saves, which may come from the trailing snapshot timer
+        self.lock = threading.RLock()
+        # intro md5 -> normalized vector of nodes that are not indexed, least recently used first
+        self.intro_cache: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.intro_cache_size = intro_cache_size
+        if snapshot_dir:
+            self.load(snapshot_dir, mmap=mmap)
+
+    @property
+    def node_ids(self):
+        return list(self.node_info_dict.keys())
 
     def compare_and_build(self, all_nodes):
-        has_vector_nodes = {}
-        not_has_vector_nodes = {}
-        not_has_vector_intros = []
+        with self.lock:
+            self.__compare_and_build(all_nodes)
+
+    def __compare_and_build(self, all_nodes):
+        removed_node_ids = [node_id for node_id in self.node_info_dict if node_id not in all_nodes]
+        changed_node_ids = []
+        changed_md5s = []
+        changed_intros = []
         for node_id, node_info in all_nodes.items():
             node_md5 = dict_md5(node_info)
             if (node_id not in self.node_info_dict
                     or self.node_info_dict[node_id]['md5'] != node_md5):
-                not_has_vector_nodes[node_id] = {
-                    "md5": node_md5
-                }
-                not_has_vector_intros.append(node_info["metadata"]["intro"])
-            else:
-                has_vector_nodes[node_id] = self.node_info_dict[node_id]
-
-        vectors = self.embedding.embedding(not_has_vector_intros)
-        for node_id, vector in zip(not_has_vector_nodes.keys(), vectors):
-            not_has_vector_nodes[node_id]['vector'] = vector
-
-        self.node_info_dict = has_vector_nodes | not_has_vector_nodes
-        if len(not_has_vector_nodes) > 0:
+                changed_node_ids.append(node_id)
+                changed_md5s.append(node_md5)
+                changed_intros.append((node_info.get("metadata") or {}).get("intro") or "")
+
+        self.remove_many(removed_node_ids)
+        if changed_node_ids:
+            vectors = self.embedding.embedding(changed_intros)
+            self.upsert_many(changed_node_ids, vectors, changed_md5s)
+        if removed_node_ids or changed_node_ids:
+            logger.debug(f"Node index updated, changed[{len(changed_node_ids)}] removed[{len(removed_node_ids)}]")
+            if self.snapshot_dir:
+                self.__schedule_save()
+
+    def __schedule_save(self):
+        """Caller must hold self.lock. Save now, or when the snapshot interval ends."""
+        delay = self.last_snapshot_time + self.snapshot_interval - time.time()
+        if delay <= 0:
+            self.save(self.snapshot_dir)
+        elif self.snapshot_timer is None:
+            self.snapshot_timer = threading.Timer(delay, self.__trailing_save)
+            self.snapshot_timer.daemon = True
+            self.snapshot_timer.start()
+
+    def __trailing_save(self):
+        with self.lock:
+            self.snapshot_timer = None
+            try:
+                self.save(self.snapshot_dir)
+            except Exception:
+                logger.exception(f"Save node index snapshot to {self.snapshot_dir} error.")
+
+    def upsert_many(self, node_ids, vectors, md5s=None):
+        """Add new nodes, or replace the vectors of known ones."""
+        vectors = np.array(vectors, dtype=np.float32, order="C")
+        faiss.normalize_L2(vectors)
+        self.remove_many([node_id for node_id in node_ids if node_id in self.node_info_dict], compact=False)
+        ids = np.arange(self.next_id, self.next_id + len(node_ids), dtype=np.int64)
+        self.next_id += len(node_ids)
+        for i, (node_id, vector_id) in enumerate(zip(node_ids, ids.tolist())):
+            self.node_info_dict[node_id] = {
+                "id": vector_id,
+                "md5": md5s[i] if md5s else None,
+                # a copy, a view would keep the whole batch alive
+                "vector": vectors[i].copy()
+            }
+            self.id_to_node[vector_id] = node_id
+        if (self.node_index is None or self.__target_index_type() != self.requested_index_type
+                or self.__can_train_requested()):
+            self.rebuild()
+        else:
+            self.__make_writable()
+            self.node_index.add_with_ids(vectors, ids)
+            self.compact()
+
+    def upsert(self, node_id, vector, md5=None):
+        self.upsert_many([node_id], np.asarray([vector], dtype=np.float32), [md5])
+
+    def remove_many(self, node_ids, compact=True):
+        for node_id in node_ids:
+            node_info = self.node_info_dict.pop(node_id, None)
+            if node_info is None:
+                continue
+            self.id_to_node.pop(node_info["id"], None)
+            self.tombstones.add(node_info["id"])
+        if compact:
+            self.compact()
+
+    def remove(self, node_id):
+        self.remove_many([node_id])
+
+    def compact(self, force=False):
+        """Physically drop tombstoned vectors once they exceed `compact_ratio` of the index."""
+        if not self.tombstones:
+            return
+        if not force and len(self.tombstones) <= self.compact_ratio * self.node_index.ntotal:
+            return
+        if not supports_remove(self.built_index_type):
             self.rebuild()
+            return
+        self.__make_writable()
+        removed = self.node_index.remove_ids(np.fromiter(self.tombstones, dtype=np.int64))
+        logger.debug(f"Node index compacted, {removed} tombstoned vectors removed.")
+        self.tombstones.clear()
+
+    def __make_writable(self):
+        """Copy a memory-mapped index into memory before its first update, instead of rebuilding it."""
+        if not self.mmapped:
+            return
+        self.node_index = faiss.deserialize_index(faiss.serialize_index(self.node_index))
+        self.mmapped = False
+        self.set_search_params(self.index_params["hnsw_ef_search"], self.index_params["ivf_nprobe"])
+
+    def __can_train_requested(self):
+        """True when the index fell back to flat and there are now enough vectors to train the requested type."""
+        if self.built_index_type == self.requested_index_type:
+            return False
+        needed = training_size(self.requested_index_type, self.dim, self.index_params)
+        return needed is not None and len(self.node_info_dict) >= needed
+
+    def __target_index_type(self):
+        if self.index_type != INDEX_AUTO:
+            return self.index_type
+        return choose_index_type(len(self.node_info_dict), self.index_params)
 
     def rebuild(self):
-        node_ids, vectors = zip(*[(node_id, n['vector']) for node_id, n in self.node_info_dict.items()])
-        vectors = np.array(vectors, dtype='float32')
-        new_index = faiss.IndexFlatL2(self.dim)
-        new_index.add(vectors)
-        self.node_index = new_index
-        self.node_ids = node_ids
-        logger.debug("Node index rebuild finished.")
-
-    def search(self, query, limit=20):
-        vector = self.embedding.embedding_one(query)
-        results = []
-        if len(self.node_ids) > limit:
-            query_vector = np.array([vector], dtype='float32')
-            distances, indices = self.node_index.search(query_vector, limit)
-            for distance, index in zip(distances[0], indices[0]):
-                real_distance = 1 - distance / 2.0
-                node_id = self.node_ids[index]
-                logger.debug(f"search result index[{index}] distance[{real_distance}] node_id[{node_id}]")
-                results.append(node_id)
-        else:
-            results = self.node_ids
-        return results
\ No newline at end of file
+        """Build (and train) a fresh index from the live vectors, dropping all tombstones."""
+        node_infos = list(self.node_info_dict.values())
+        vectors = np.empty((len(node_infos), self.dim), dtype=np.float32)
+        for row, node_info in enumerate(node_infos):
+            vectors[row] = node_info["vector"]
+        ids = np.fromiter((node_info["id"] for node_info in node_infos), dtype=np.int64, count=len(node_infos))
+        self.requested_index_type = self.__target_index_type()
+        self.built_index_type, self.node_index = build_ann_index(
+            self.requested_index_type, self.dim, vectors, ids, self.index_params)
+        self.tombstones.clear()
+        self.mmapped = False
+        logger.debug(f"Node index rebuild finished, type[{self.built_index_type}] size[{len(node_infos)}].")
+
+    def save(self, snapshot_dir: str):
+        """
+        Write the index, vectors and node map to `snapshot_dir`. Data files get a fresh name and
+        are synced before meta.json is replaced, so readers always see a complete snapshot, also
+        after a crash. Several processes may save to one directory: each only deletes the data
+        files it wrote itself, once meta.json no longer names them.
+        """
+        with self.lock:
+            self.__save(snapshot_dir)
+
+    @staticmethod
+    def __fsync(path, directory=False):
+        fd = os.open(path, os.O_RDONLY if directory else os.O_RDWR)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def __save(self, snapshot_dir: str):
+        os.makedirs(snapshot_dir, exist_ok=True)
+        if self.node_index is None:
+            self.rebuild()
+        generation = uuid.uuid4().hex[:12]
+        index_file = f"index-{generation}.faiss"
+        vectors_file = f"vectors-{generation}.npy"
+        node_ids = self.node_ids
+        vectors = np.empty((len(node_ids), self.dim), dtype=np.float32)
+        for row, node_id in enumerate(node_ids):
+            vectors[row] = self.node_info_dict[node_id]["vector"]
+        faiss.write_index(self.node_index, os.path.join(snapshot_dir, index_file))
+        np.save(os.path.join(snapshot_dir, vectors_file), vectors)
+        self.snapshot_files.update((index_file, vectors_file))
+        self.__fsync(os.path.join(snapshot_dir, index_file))
+        self.__fsync(os.path.join(snapshot_dir, vectors_file))
+        self.__fsync(snapshot_dir, directory=True)
+        meta = {
+            "dim": self.dim,
+            "index_file": index_file,
+            "vectors_file": vectors_file,
+            "next_id": self.next_id,
+            "requested_index_type": self.requested_index_type,
+            "built_index_type": self.built_index_type,
+            "tombstones": sorted(self.tombstones),
+            "nodes": [[node_id, self.node_info_dict[node_id]["id"], self.node_info_dict[node_id]["md5"]]
+                      for node_id in node_ids]
+        }
+        meta_path = os.path.join(snapshot_dir, "meta.json")
+        temp_path = f"{meta_path}.{os.getpid()}-{uuid.uuid4().hex[:8]}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, meta_path)
+        self.__fsync(snapshot_dir, directory=True)
+        self.__remove_unreferenced(snapshot_dir, meta_path)
+        self.last_snapshot_time = time.time()
+        logger.debug(f"Node index snapshot saved to {snapshot_dir}, size[{len(node_ids)}].")
+
+    def __remove_unreferenced(self, snapshot_dir, meta_path):
+        """Delete the data files this instance wrote that meta.json, maybe another writer's, does not name."""
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return
+        # Processes that mapped older files keep them alive until they unmap.
+        for file_name in self.snapshot_files - {meta["index_file"], meta["vectors_file"]}:
+            try:
+                os.remove(os.path.join(snapshot_dir, file_name))
+            except FileNotFoundError:
+                pass
+            self.snapshot_files.discard(file_name)
+
+    def load(self, snapshot_dir: str, mmap: bool = True) -> bool:
+        """Load a snapshot written by `save`. Returns False if there is none or it does not match."""
+        meta_path = os.path.join(snapshot_dir, "meta.json")
+        if not os.path.exists(meta_path):
+            return False
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta["dim"] != self.dim:
+                logger.warning(f"Node index snapshot dim[{meta['dim']}] does not match embedding dim[{self.dim}], ignored.")
+                return False
+            io_flags = faiss.IO_FLAG_MMAP if mmap else 0
+            node_index = faiss.read_index(os.path.join(snapshot_dir, meta["index_file"]), io_flags)
+            vectors = np.load(os.path.join(snapshot_dir, meta["vectors_file"]), mmap_mode="r" if mmap else None)
+        except Exception:
+            logger.exception(f"Load node index snapshot from {snapshot_dir} error.")
+            return False
+        self.node_info_dict = {}
+        self.id_to_node = {}
+        for row, (node_id, vector_id, node_md5) in enumerate(meta["nodes"]):
+            self.node_info_dict[node_id] = {"id": vector_id, "md5": node_md5, "vector": vectors[row]}
+            self.id_to_node[vector_id] = node_id
+        self.tombstones = set(meta["tombstones"])
+        self.next_id = meta["next_id"]
+        self.requested_index_type = meta["requested_index_type"]
+        self.built_index_type = meta["built_index_type"]
+        self.node_index = node_index
+        self.mmapped = mmap
+        self.set_search_params(self.index_params["hnsw_ef_search"], self.index_params["ivf_nprobe"])
+        self.last_snapshot_time = time.time()
+        logger.debug(f"Node index snapshot loaded from {snapshot_dir}, size[{len(self.node_info_dict)}].")
+        return True
+
+    def set_search_params(self, hnsw_ef_search: Optional[int] = None, ivf_nprobe: Optional[int] = None):
+        """Trade recall for latency on the current and future indexes."""
+        if hnsw_ef_search is not None:
+            self.index_params["hnsw_ef_search"] = hnsw_ef_search
+        if ivf_nprobe is not None:
+            self.index_params["ivf_nprobe"] = ivf_nprobe
+        if self.node_index is None:
+            return
+        parameter_space = faiss.ParameterSpace()
+        if hnsw_ef_search is not None and self.built_index_type == INDEX_HNSW:
+            parameter_space.set_index_parameter(self.node_index, "efSearch", hnsw_ef_search)
+        if ivf_nprobe is not None and self.built_index_type in (INDEX_IVF_FLAT, INDEX_IVF_PQ):
+            parameter_space.set_index_parameter(self.node_index, "nprobe", ivf_nprobe)
+
+    def embed(self, texts) -> np.ndarray:
+        """Normalized embeddings of `texts`, comparable with the indexed vectors and centroids."""
+        vectors = np.array(self.embedding.embedding(list(texts)), dtype=np.float32, order="C")
+        faiss.normalize_L2(vectors)
+        return vectors
+
+    def intro_vectors(self, intros) -> np.ndarray:
+        """Normalized embeddings of `intros`, only those missing from the intro cache are embedded."""
+        keys = [hashlib.md5(intro.encode("utf-8")).hexdigest() for intro in intros]
+        vectors = {}
+        missing = {}
+        with self.lock:
+            for key, intro in zip(keys, intros):
+                if key in self.intro_cache:
+                    self.intro_cache.move_to_end(key)
+                    vectors[key] = self.intro_cache[key]
+                else:
+                    missing[key] = intro
+        if missing:
+            for key, vector in zip(missing, self.embed(missing.values())):
+                vectors[key] = vector.copy()
+            with self.lock:
+                for key in missing:
+                    self.intro_cache[key] = vectors[key]
+                while len(self.intro_cache) > self.intro_cache_size:
+                    self.intro_cache.popitem(last=False)
+        return np.array([vectors[key] for key in keys], dtype=np.float32).reshape(len(keys), self.dim)
+
+    def search(self, query, limit=20, min_score: Optional[float] = None):
+        """
+        Returns:
+            list of (node_id, score) ranked by descending cosine similarity, at most `limit` long
+            and only scores >= `min_score` when it is given.
+        """
+        return self.search_many([query], limit=limit, min_score=min_score)[0]
+
+    def search_many(self, queries, limit=20, min_score: Optional[float] = None, assign: bool = False):
+        """
+        Search several queries with one embedding batch and one matrix search.
+
+        Args:
+            assign: also pick one distinct node per query, greedily by highest score, and put it
+                first in that query's results. Only a query's own results are candidates, so a
+                query whose results were all picked by better scoring queries gets no node of its
+                own and keeps its ranking as is.
+        Returns:
+            one ranked list of (node_id, score) per query, in query order.
+        """
+        if self.node_index is None or not self.node_info_dict or not queries:
+            return [[] for _ in queries]
+        return self.search_vectors(self.embed(queries), limit=limit, min_score=min_score, assign=assign)
+
+    def search_vectors(self, query_vectors, limit=20, min_score: Optional[float] = None, assign: bool = False):
+        """search_many for queries already embedded with `embed`."""
+        if self.node_index is None or not self.node_info_dict or len(query_vectors) == 0:
+            return [[] for _ in query_vectors]
+        k = min(limit + len(self.tombstones), self.node_index.ntotal)
+        scores, indices = self.node_index.search(query_vectors, k)
+        all_results = []
+        for query_scores, query_indices in zip(scores, indices):
+            results = []
+            for score, index in zip(query_scores, query_indices):
+                node_id = self.id_to_node.get(int(index))
+                if node_id is None:
+                    continue
+                if min_score is not None and score < min_score:
+                    break
+                results.append((node_id, float(score)))
+                if len(results) >= limit:
+                    break
+            all_results.append(results)
+        logger.debug(f"search_many queries[{len(query_vectors)}] results{[len(r) for r in all_results]}")
+        if assign:
+            self.__assign_distinct(all_results)
+        return all_results
+
+    @staticmethod
+    def __assign_distinct(all_results):
+        candidates = sorted(
+            ((score, query_index, node_id)
+             for query_index, results in enumerate(all_results) for node_id, score in results),
+            key=lambda candidate: -candidate[0]
+        )
+        assigned = {}
+        used_node_ids = set()
+        for score, query_index, node_id in candidates:
+            if query_index not in assigned and node_id not in used_node_ids:
+                assigned[query_index] = (node_id, score)
+                used_node_ids.add(node_id)
+        for query_index, results in enumerate(all_results):
+            choice = assigned.get(query_index)
+            if choice is not None:
+                results.remove(choice)
+                results.insert(0, choice)
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import threading
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+import grpc
+
+from isek.node.noderpc import node_pb2, node_pb2_grpc
+from isek.util.logger import logger
+
+# The sidecar prints this prefix followed by {"peer_id", "p2p_address"} whenever its context changes.
+P2P_CONTEXT_SIGNAL = "ISEK_P2P_CONTEXT "
+
+
+class P2PSidecarClient(object):
+    """
+    Client of the Node.js p2p sidecar over one persistent gRPC channel.
+
+    The channel is kept healthy by HTTP/2 keepalive pings and reconnects on its own; calls never
+    drop it. Every call carries a deadline. `call_peer_async` returns a future right away, and
+    since gRPC multiplexes calls over the channel any number of them can be in flight at once.
+
+    The p2p context (peer id and address) is cached. It is replaced when the sidecar prints a
+    context line (see `on_output_line`), and fetched again only after the channel lost its
+    connection, which means the sidecar may have restarted.
+    """
+
+    def __init__(self,
+                 port: int,
+                 host: str = "localhost",
+                 call_timeout: float = 30,
+                 context_timeout: float = 5,
+                 keepalive_ms: int = 10000,
+                 on_context_change: Optional[Callable[[str, str], None]] = None):
+        self.address = f"{host}:{port}"
+        self.call_timeout = call_timeout
+        self.context_timeout = context_timeout
+        self.on_context_change = on_context_change
+        self.channel = grpc.insecure_channel(self.address, options=[
+            ("grpc.keepalive_time_ms", keepalive_ms),
+            ("grpc.keepalive_timeout_ms", keepalive_ms // 2),
+            ("grpc.keepalive_permit_without_calls", 1),
+            ("grpc.http2.max_pings_without_data", 0),
+        ])
+        self.stub = node_pb2_grpc.IsekP2PNodeServiceStub(self.channel)
+        self.lock = threading.Lock()
+        self.peer_id = None
+        self.p2p_address = None
+        self.context_stale = True
+        self.connectivity = None
+        self.channel.subscribe(self.__on_connectivity)
+
+    def __on_connectivity(self, connectivity):
+        if connectivity in (grpc.ChannelConnectivity.TRANSIENT_FAILURE, grpc.ChannelConnectivity.SHUTDOWN) \
+                and self.connectivity == grpc.ChannelConnectivity.READY:
+            logger.debug(f"p2p sidecar {self.address} connection lost.")
+            self.context_stale = True
+        elif connectivity == grpc.ChannelConnectivity.READY and self.context_stale and self.p2p_address:
+            # Reconnected to a possibly restarted sidecar. Not from this gRPC callback thread.
+            threading.Thread(target=self.__refresh_quietly, daemon=True).start()
+        self.connectivity = connectivity
+
+    def __refresh_quietly(self):
+        try:
+            self.refresh_context()
+        except Exception:
+            logger.exception(f"Load p2p context from {self.address} error.")
+
+    def wait_for_ready(self, timeout: float) -> bool:
+        """Block until the channel is connected, at most `timeout` seconds."""
+        try:
+            grpc.channel_ready_future(self.channel).result(timeout=timeout)
+            return True
+        except grpc.FutureTimeoutError:
+            return False
+
+    def context(self):
+        """(peer_id, p2p_address), from the cache unless it went stale."""
+        if self.context_stale or not self.p2p_address:
+            self.refresh_context()
+        return self.peer_id, self.p2p_address
+
+    def refresh_context(self):
+        response = self.stub.p2p_context(node_pb2.P2PContextRequest(), timeout=self.context_timeout)
+        self.set_context(response.peer_id, response.p2p_address)
+        return response
+
+    def set_context(self, peer_id: str, p2p_address: str):
+        with self.lock:
+            changed = (peer_id, p2p_address) != (self.peer_id, self.p2p_address)
+            self.peer_id = peer_id
+            self.p2p_address = p2p_address
+            self.context_stale = not p2p_address
+        if changed and self.on_context_change:
+            self.on_context_change(peer_id, p2p_address)
+
+    def on_output_line(self, line: str) -> bool:
+        """Feed one stdout line of the sidecar, returns True when it carried a new context."""
+        if not line.startswith(P2P_CONTEXT_SIGNAL):
+            return False
+        try:
+            context = json.loads(line[len(P2P_CONTEXT_SIGNAL):])
+        except ValueError:
+            logger.warning(f"Malformed p2p context line: {line.strip()}")
+            return False
+        self.set_context(context.get("peer_id"), context.get("p2p_address"))
+        return True
+
+    def call_peer(self, sender_node_id: str, receiver_p2p_address: str, message: str,
+                  timeout: Optional[float] = None) -> str:
+        """Send `message` to a peer and wait for its reply, at most `timeout` (default call_timeout) seconds."""
+        return self.call_peer_async(sender_node_id, receiver_p2p_address, message, timeout).result()
+
+    def call_peer_async(self, sender_node_id: str, receiver_p2p_address: str, message: str,
+                        timeout: Optional[float] = None) -> Future:
+        """Start a call_peer and return a Future of the peer's reply, the caller is not blocked."""
+        request = node_pb2.CallPeerRequest(sender_node_id=sender_node_id,
+                                           receiver_p2p_address=receiver_p2p_address, message=message)
+        call = self.stub.call_peer.future(request, timeout=timeout or self.call_timeout)
+        result = Future()
+
+        def done(call_future):
+            try:
+                result.set_result(decode_reply(call_future.result()))
+            except Exception as e:
+                result.set_exception(e)
+        call.add_done_callback(done)
+        return result
+
+    async def acall_peer(self, sender_node_id: str, receiver_p2p_address: str, message: str,
+                         timeout: Optional[float] = None) -> str:
+        """asyncio flavour of call_peer_async."""
+        return await asyncio.wrap_future(
+            self.call_peer_async(sender_node_id, receiver_p2p_address, message, timeout))
+
+    def close(self):
+        self.channel.unsubscribe(self.__on_connectivity)
+        self.channel.close()
+
+
+def decode_reply(response) -> str:
+    """The sidecar relays the peer's reply JSON encoded, and an error object when the peer did not answer."""
+    reply = json.loads(response.reply)
+    if not isinstance(reply, str):
+        raise ConnectionError(f"p2p call failed: {reply}")
+    return reply
@@ -1,23 +1,23 @@
+import itertools
 import json
 import threading
-import time
 from abc import ABC, abstractmethod
 from concurrent import futures
-from typing import Dict
-import atexit
+from typing import Dict, List
 import faiss
-import subprocess
 import grpc
 import numpy as np
 
-from isek.constant.exceptions import NodeUnavailableError
+from isek.constant.exceptions import AgentBusyError, NodeUnavailableError
 from isek.node.noderpc import node_pb2, node_pb2_grpc
 from isek.node.registry import Registry
 from isek.util.logger import logger
 from isek.node.node_index import NodeIndex
 from isek.embedding.abstract_embedding import AbstractEmbedding
 from isek.node.isek_center_registry import IsekCenterRegistry
-import os
+from isek.node.gossip import GossipMembership
+from isek.node.p2p_sidecar import P2PSidecar
+from isek.node.local_transport import local_transport
 
 
 class P2PNode(node_pb2_grpc.IsekP2PNodeServiceServicer, ABC):
@@ -27,6 +27,15 @@ class P2PNode(node_pb2_grpc.IsekP2PNodeServiceServicer, ABC):
                  p2p_server_port: int = 3000,
                  registry: Registry = IsekCenterRegistry(),
                  embedding: AbstractEmbedding = None,
+                 node_index_options: Dict = None,
+                 gossip_seeds: List[str] = None,
+                 gossip_options: Dict = None,
+                 p2p_call_timeout: float = 30,
+                 p2p_startup_timeout: float = 30,
+                 p2p_shared_server: bool = False,
+                 local_delivery: bool = True,
+                 local_serialize: bool = False,
+                 server_workers: int = 10,
                  **kwargs
                  ):
         if not host or not port:
@@ -40,9 +49,25 @@ class P2PNode(node_pb2_grpc.IsekP2PNodeServiceServicer, ABC):
         self.p2p_server_port = p2p_server_port
         self.peer_id = None
         self.p2p_address = None
-        self.p2p_server_stub = None
+        # deadline of a call to another peer through the sidecar, in seconds
+        self.p2p_call_timeout = p2p_call_timeout
+        self.p2p_startup_timeout = p2p_startup_timeout
+        # share one p2p server with the other nodes of this process that use the same p2p_server_port
+        self.p2p_shared_server = p2p_shared_server
+        self.p2p_sidecar = None
+        self.p2p_client = None
+        # Messages to nodes of this process skip the sidecar, local_serialize keeps the protobuf round trip for tests.
+        self.local_delivery = local_delivery
+        self.local_serialize = local_serialize
+        self.server_workers = server_workers
+        # serves gRPC and local deliveries to this node, created by build_server or the AgentHost's
+        self.executor = None
         if embedding:
-            self.node_index = NodeIndex(embedding)
+            self.node_index = NodeIndex(embedding, **(node_index_options or {}))
+        # Peers are discovered by SWIM gossip over call_peer, starting from the p2p addresses in gossip_seeds.
+        self.gossip_seeds = gossip_seeds or []
+        self.gossip_options = gossip_options or {}
+        self.membership = None
         self.node_list = None
         # self.__build_server()
 
@@ -59,86 +84,100 @@ class P2PNode(node_pb2_grpc.IsekP2PNodeServiceServicer, ABC):
         pass
 
     def build_server(self):
+        self.executor = futures.ThreadPoolExecutor(max_workers=self.server_workers)
         self.__bootstrap_p2p_server()
         # self.registry.register_node(node_id=self.node_id, host=self.host, port=self.port,
         #                             p2p_address=self.p2p_address, metadata=self.metadata())
-        self.__bootstrap_heartbeat()
+        self.membership = GossipMembership(self.__node_info(), send=self.__send_gossip, seeds=self.gossip_seeds,
+                                           on_change=self.__on_nodes_changed, **self.gossip_options)
+        # Joining waits on the seeds, keep it off this thread, which goes on to serve gRPC.
+        threading.Thread(target=self.membership.start, daemon=True).start()
         self.__bootstrap_grpc_server()
 
-    def __load_p2p_context(self):
-        try:
-            if not self.p2p_server_stub:
-                channel = grpc.insecure_channel(f"localhost:{self.p2p_server_port}")
-                self.p2p_server_stub = node_pb2_grpc.IsekP2PNodeServiceStub(channel)
-
-            response = self.p2p_server_stub.p2p_context(node_pb2.P2PContextRequest())
-            self.peer_id = response.peer_id
-            self.p2p_address = response.p2p_address
-            return response
-        except:
-            logger.exception("Load p2p server context error.")
-            self.p2p_server_stub = None
-            return None
+    def join_host(self, host):
+        """
+        Run this node inside an AgentHost instead of build_server: the host's gRPC server, p2p
+        sidecar and executors serve it, and the host probes its gossip membership.
+        """
+        self.host = host.host
+        self.port = host.port
+        self.p2p_server_port = host.p2p_server_port
+        self.p2p_sidecar = host.sidecar
+        self.p2p_client = host.sidecar.client
+        self.executor = host.executor
+        self.p2p_sidecar.attach(self.node_id, self.__on_p2p_context_changed, self)
+        self.membership = GossipMembership(self.__node_info(), send=self.__send_gossip, seeds=self.gossip_seeds,
+                                           on_change=self.__on_nodes_changed, executor=host.gossip_executor,
+                                           notifier=host.notify_executor,
+                                           **self.gossip_options)
+        host.probe_executor.submit(self.membership.start, False)
+
+    def leave_host(self):
+        if self.membership is not None:
+            self.membership.leave()
+        local_transport.unregister(self.p2p_address, self.__handle_message)
+        if self.p2p_sidecar is not None:
+            self.p2p_sidecar.detach(self.node_id)
+
+    def __node_info(self):
+        return {
+            "node_id": self.node_id,
+            "host": self.host,
+            "port": self.port,
+            "p2p_address": self.p2p_address,
+            "metadata": self.metadata()
+        }
+
+    def __send_gossip(self, p2p_address, message, timeout):
+        return self.__call_peer(p2p_address, message, timeout)
+
+    def __call_peer(self, p2p_address, message, timeout=None):
+        timeout = timeout or self.p2p_call_timeout
+        return self.__call_peer_async(p2p_address, message, timeout).result(timeout=timeout)
+
+    def __call_peer_async(self, p2p_address, message, timeout=None):
+        local = local_transport.send(self.node_id, p2p_address, message, self.local_serialize) \
+            if self.local_delivery else None
+        if local is not None:
+            return local
+        return self.p2p_sidecar.call_peer_async(self.node_id, p2p_address, message, timeout)
+
+    def __handle_message(self, sender_node_id, message):
+        if self.membership is not None and GossipMembership.is_gossip(message):
+            return self.membership.handle(message)
+        return self.on_message(sender_node_id, message)
+
+    def __on_p2p_context_changed(self, peer_id, p2p_address):
+        local_transport.unregister(self.p2p_address, self.__handle_message)
+        local_transport.register(p2p_address, self.__handle_message, self.executor)
+        self.peer_id = peer_id
+        self.p2p_address = p2p_address
+        logger.debug(f"[{self.node_id}] p2p context: peer_id={peer_id}, p2p_address={p2p_address}")
+        if self.membership is not None and p2p_address:
+            # A new relay address must reach the other members before they can call us again.
+            self.membership.update_self(self.__node_info())
 
     def __bootstrap_p2p_server(self):
-        def stream_output(stream):
-            for line in iter(stream.readline, ''):
-                logger.debug(line)
-        dirc = os.path.dirname(__file__)
-        parent = os.path.abspath(os.path.join(dirc, "..", ".."))
-        p2p_file_path = os.path.join(parent, "p2p-server", "p2p_server.js")
-        process = subprocess.Popen(
-            ["node", p2p_file_path, f"--port={self.p2p_server_port}", f"--agent_port={self.port}"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1
-        )
-
-        def cleanup():
-            if process and process.poll() is None:
-                process.terminate()
-            logger.debug(f"p2p_server[port:{self.p2p_server_port}] process terminated")
-        atexit.register(cleanup)
-        thread = threading.Thread(target=stream_output, args=(process.stdout,), daemon=True)
-        thread.start()
-        while True:
-            p2p_context = self.__load_p2p_context()
-            if p2p_context and p2p_context.peer_id and p2p_context.p2p_address:
-                logger.debug(f"The p2p service has been completed: {p2p_context}")
-                break
-            time.sleep(1)
-
-    def __bootstrap_heartbeat(self):
-        self.__load_p2p_context()
-        # self.registry.lease_refresh(self.node_id)
-        self.__refresh_nodes()
-        # logger.debug(f"{self.node_id} get all available nodes: {self.all_nodes}")
-        timer = threading.Timer(5, self.__bootstrap_heartbeat)
-        timer.daemon = True
-        timer.start()
-
-    def __refresh_nodes(self):
-        # all_nodes = self.registry.get_available_nodes()
-        all_nodes = {}
-        # todo self.node_index.compare_and_build(all_nodes)
-        # is_nodes_changed = False
-        # for node_id, node_info in all_nodes.items():
-        #     if node_id not in self.all_nodes:
-        #         is_nodes_changed = True
-        #         break
-        # if is_nodes_changed or len(all_nodes) != len(self.all_nodes):
-        #     node_ids, vectors = zip(*[(node_id, n['metadata']['intro_vector']) for node_id, n in all_nodes.items()])
-        #     vector_dim = len(vectors[0])
-        #     vectors = np.array(vectors, dtype='float32')
-        #     self.node_index = faiss.IndexFlatL2(vector_dim)
-        #     self.node_index.add(vectors)
-        #     self.node_list = node_ids
-        #     logger.debug("Node index rebuild finished.")
+        options = dict(startup_timeout=self.p2p_startup_timeout, call_timeout=self.p2p_call_timeout)
+        if self.p2p_shared_server:
+            self.p2p_sidecar = P2PSidecar.shared(self.p2p_server_port, self.port, **options)
+        else:
+            self.p2p_sidecar = P2PSidecar(self.p2p_server_port, self.port, **options)
+        self.p2p_client = self.p2p_sidecar.client
+        self.p2p_sidecar.attach(self.node_id, self.__on_p2p_context_changed, self)
+        self.p2p_sidecar.start()
+        logger.debug(f"The p2p service has been completed: {self.peer_id} {self.p2p_address}")
+
+    def __on_nodes_changed(self, all_nodes):
+        if self.node_index is not None:
+            try:
+                self.node_index.compare_and_build(all_nodes)
+            except Exception:
+                logger.exception(f"[{self.node_id}] Node index update failed.")
         self.all_nodes = all_nodes
 
     def __bootstrap_grpc_server(self):
-        server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+        server = grpc.server(self.executor)
         node_pb2_grpc.add_IsekP2PNodeServiceServicer_to_server(self, server)
 
         # 监听端口
@@ -154,50 +193,50 @@ class P2PNode(node_pb2_grpc.IsekP2PNodeServiceServicer, ABC):
 
     def send_p2p_message(self, receiver_p2p_address, message):
         logger.info(f"[{self.node_id}] send msg to [{receiver_p2p_address}]: {message}")
-
-        request = node_pb2.CallPeerRequest(sender_node_id=self.node_id,
-                                           receiver_p2p_address=receiver_p2p_address, message=message)
-
-        # receiver_p2p_address = "/ip4/127.0.0.1/tcp/50706/ws/p2p/12D3KooWF5mcsBaMKdJ9Rc1A2cp6KWSsaJUVxG2YkXJduJAkiQTK/p2p-circuit/p2p/12D3KooWKQgxkeJAa1wUTGVCi8X3KpLxL7za51srd8m46PirmVvS"
-        # request = node_pb2.CallPeerRequest(sender_node_id=self.node_id, receiver_p2p_address=receiver_p2p_address, message=message)
-
-        # 调用远程服务方法
-        response = self.p2p_server_stub.call_peer(request)
-        # log the response
-        logger.info(f"[{self.node_id}] receive message from [{receiver_p2p_address}]: {response.reply}")
-        return f"{response.reply}"
+        reply = self.__call_peer(receiver_p2p_address, message)
+        logger.info(f"[{self.node_id}] receive message from [{receiver_p2p_address}]: {reply}")
+        return reply
 
     def send_message(self, receiver_node_id, message):
         """
         send message to another node by providing receiver_node_id= agent_name and message = message
         """
+        return self.send_message_async(receiver_node_id, message).result(timeout=self.p2p_call_timeout)
+
+    def send_message_async(self, receiver_node_id, message):
+        """
+        Same as send_message but returns a concurrent.futures.Future of the reply right away,
+        so an agent can fan out to several peers and collect the replies later.
+        """
         logger.info(f"[{self.node_id}] send msg to [{receiver_node_id}]: {message}")
         receiver_node = self.all_nodes.get(receiver_node_id, None)
         if not receiver_node:
             raise NodeUnavailableError(receiver_node)
 
-        request = node_pb2.CallPeerRequest(sender_node_id=self.node_id, receiver_p2p_address=receiver_node["p2p_address"], message=message)
-
-        # receiver_p2p_address = "/ip4/127.0.0.1/tcp/50706/ws/p2p/12D3KooWF5mcsBaMKdJ9Rc1A2cp6KWSsaJUVxG2YkXJduJAkiQTK/p2p-circuit/p2p/12D3KooWKQgxkeJAa1wUTGVCi8X3KpLxL7za51srd8m46PirmVvS"
-        # request = node_pb2.CallPeerRequest(sender_node_id=self.node_id, receiver_p2p_address=receiver_p2p_address, message=message)
-
-        # 调用远程服务方法
-        response = self.p2p_server_stub.call_peer(request)
-        # log the response
-        logger.info(f"[{self.node_id}] receive message from [{receiver_node_id}]: {response.reply}")
-        return f"{response.reply}"
-
+        future = self.__call_peer_async(receiver_node["p2p_address"], message)
+        future.add_done_callback(lambda f: f.exception() is None and logger.info(
+            f"[{self.node_id}] receive message from [{receiver_node_id}]: {f.result()}"))
+        return future
 
-    def get_nodes_by_vector(self, query, limit=20):
-        return self.all_nodes.values()
-        # todo
-        # if len(self.all_nodes) > limit and self.node_index is not None:
-        #     node_ids = self.node_index.search(query, limit=limit)
-        #     results = [self.all_nodes[node_id] for node_id in node_ids]
-        # else:
-        #     results = self.all_nodes.values()
-        # return results
+    def get_nodes_by_vector(self, query, limit=20, min_score=None):
+        """
+        Return the nodes whose intro best matches `query`, most similar first.
+        Without a node index the first `limit` known nodes are returned, unranked.
+        """
+        if self.node_index is None:
+            return list(itertools.islice(self.all_nodes.values(), limit))
+        results = self.node_index.search(query, limit=limit, min_score=min_score)
+        return [self.all_nodes[node_id] for node_id, _ in results if node_id in self.all_nodes]
 
     def call_peer(self, request, context):
-        # 返回消息
-        return node_pb2.CallPeerResponse(reply=self.on_message(request.sender_node_id, request.message))
+        tenant = self.p2p_sidecar.tenant_of(request.receiver_p2p_address) if self.p2p_sidecar else None
+        if tenant is not None and tenant is not self:
+            # another node sharing our p2p server
+            return tenant.call_peer(request, context)
+        try:
+            # 返回消息
+            return node_pb2.CallPeerResponse(reply=self.__handle_message(request.sender_node_id, request.message))
+        except AgentBusyError as e:
+            if context is None:
+                raise
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, e.message)
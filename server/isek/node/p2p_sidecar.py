@@ -0,0 +1,176 @@
+import atexit
+import collections
+import os
+import subprocess
+import threading
+from concurrent import futures
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional, Tuple
+
+from isek.constant.exceptions import P2PServerStartError
+from isek.node.noderpc import node_pb2
+from isek.node.p2p_client import P2PSidecarClient
+from isek.util.logger import logger
+
+P2P_SERVER_SCRIPT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "p2p-server", "p2p_server.js"))
+# Nodes sharing one sidecar are addressed as <sidecar p2p address>#<node_id>.
+TENANT_SEPARATOR = "#"
+
+
+class P2PSidecar(object):
+    """
+    The Node.js p2p server process of one or more P2PNodes, and the client talking to it.
+
+    `start` returns as soon as the sidecar prints its p2p context (see P2P_CONTEXT_SIGNAL), and
+    raises P2PServerStartError when that does not happen within startup_timeout or the process
+    exits first.
+
+    A shared sidecar (see `shared`) serves every node of the process that asks for the same port:
+    one libp2p peer and one relay connection instead of one per node. The sidecar hands inbound
+    messages to the gRPC port of the node that started it, which dispatches them by the node id
+    after TENANT_SEPARATOR in the receiver address (see `tenant_of`).
+    """
+
+    shared_sidecars: Dict[int, "P2PSidecar"] = {}
+    shared_lock = threading.Lock()
+
+    def __init__(self,
+                 port: int,
+                 agent_port: int,
+                 startup_timeout: float = 30,
+                 call_timeout: float = 30,
+                 is_shared: bool = False):
+        self.port = port
+        self.agent_port = agent_port
+        self.startup_timeout = startup_timeout
+        self.is_shared = is_shared
+        self.client = P2PSidecarClient(port, call_timeout=call_timeout, on_context_change=self.__on_context_change)
+        self.process = None
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        # node_id -> (on_context_change(peer_id, p2p_address), node)
+        self.tenants: Dict[str, Tuple[Callable[[str, str], None], object]] = {}
+        # the last lines the sidecar printed, reported when it fails to start
+        self.output_tail = collections.deque(maxlen=20)
+        # delivers to attached nodes that have no executor of their own yet
+        self.executor = futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="p2p-sidecar")
+
+    @classmethod
+    def shared(cls, port: int, agent_port: int, **kwargs) -> "P2PSidecar":
+        """The process wide sidecar on `port`, started by the first caller, `agent_port` is ignored after that."""
+        with cls.shared_lock:
+            sidecar = cls.shared_sidecars.get(port)
+            if sidecar is None:
+                sidecar = cls(port, agent_port, is_shared=True, **kwargs)
+                cls.shared_sidecars[port] = sidecar
+        return sidecar
+
+    def start(self):
+        """Spawn the sidecar unless it runs already, and block until it is ready."""
+        with self.lock:
+            if self.process is None:
+                logger.debug(f"Starting p2p_server[port:{self.port}] for agent port {self.agent_port}")
+                self.process = subprocess.Popen(
+                    ["node", P2P_SERVER_SCRIPT, f"--port={self.port}", f"--agent_port={self.agent_port}"],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    text=True,
+                    bufsize=1
+                )
+                atexit.register(self.stop)
+                threading.Thread(target=self.__stream_output, daemon=True).start()
+
+        if not self.ready.wait(self.startup_timeout):
+            self.stop()
+            raise P2PServerStartError(self.port, f"no p2p context within {self.startup_timeout}s, "
+                                                 f"last output: {self.__tail()}")
+        if not self.client.p2p_address:
+            self.stop()
+            raise P2PServerStartError(self.port, f"exited with code {self.process.returncode}, "
+                                                 f"last output: {self.__tail()}")
+
+    def __stream_output(self):
+        process = self.process
+        for line in iter(process.stdout.readline, ''):
+            if not self.client.on_output_line(line):
+                self.output_tail.append(line.rstrip())
+                logger.debug(line)
+        code = process.wait()
+        logger.debug(f"p2p_server[port:{self.port}] exited with code {code}")
+        # wake up start() instead of letting it wait for the timeout
+        self.ready.set()
+
+    def __tail(self):
+        return " | ".join(self.output_tail) or "none"
+
+    def __on_context_change(self, peer_id, p2p_address):
+        if not p2p_address:
+            return
+        self.ready.set()
+        with self.lock:
+            tenants = list(self.tenants.items())
+        for node_id, (on_context_change, _) in tenants:
+            on_context_change(peer_id, self.address_of(node_id, p2p_address))
+
+    def attach(self, node_id: str, on_context_change: Callable[[str, str], None], node=None):
+        """Register a node using this sidecar, `on_context_change` gets its peer id and p2p address."""
+        with self.lock:
+            self.tenants[node_id] = (on_context_change, node)
+        if self.client.p2p_address:
+            on_context_change(self.client.peer_id, self.address_of(node_id))
+
+    def detach(self, node_id: str):
+        with self.lock:
+            self.tenants.pop(node_id, None)
+
+    def address_of(self, node_id: str, p2p_address: Optional[str] = None) -> Optional[str]:
+        """The p2p address other nodes reach `node_id` at."""
+        p2p_address = p2p_address or self.client.p2p_address
+        if not self.is_shared or not p2p_address:
+            return p2p_address
+        return f"{p2p_address}{TENANT_SEPARATOR}{node_id}"
+
+    def tenant_of(self, receiver_p2p_address: str):
+        """The attached node an inbound message is addressed to, None when it names no tenant."""
+        if not receiver_p2p_address or TENANT_SEPARATOR not in receiver_p2p_address:
+            return None
+        node_id = receiver_p2p_address.rsplit(TENANT_SEPARATOR, 1)[1]
+        with self.lock:
+            tenant = self.tenants.get(node_id)
+        return tenant[1] if tenant else None
+
+    def local_tenant(self, p2p_address: str):
+        """The attached node `p2p_address` points at, None when it is not behind this sidecar."""
+        own_address = self.client.p2p_address
+        if not own_address or not p2p_address or not p2p_address.startswith(own_address + TENANT_SEPARATOR):
+            return None
+        return self.tenant_of(p2p_address)
+
+    def call_peer(self, sender_node_id: str, receiver_p2p_address: str, message: str,
+                  timeout: Optional[float] = None) -> str:
+        return self.call_peer_async(sender_node_id, receiver_p2p_address, message, timeout).result()
+
+    def call_peer_async(self, sender_node_id: str, receiver_p2p_address: str, message: str,
+                        timeout: Optional[float] = None) -> Future:
+        """
+        Like P2PSidecarClient.call_peer_async, but delivers to an attached node directly, on the
+        executor that node serves its messages on, so the caller gets the Future right away.
+        """
+        tenant = self.local_tenant(receiver_p2p_address)
+        if tenant is None:
+            return self.client.call_peer_async(sender_node_id, receiver_p2p_address, message, timeout)
+        # libp2p cannot dial its own peer
+        request = node_pb2.CallPeerRequest(sender_node_id=sender_node_id,
+                                           receiver_p2p_address=receiver_p2p_address, message=message)
+        executor = getattr(tenant, "executor", None) or self.executor
+        return executor.submit(lambda: tenant.call_peer(request, None).reply)
+
+    def stop(self):
+        if self.is_shared:
+            with P2PSidecar.shared_lock:
+                if P2PSidecar.shared_sidecars.get(self.port) is self:
+                    del P2PSidecar.shared_sidecars[self.port]
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            logger.debug(f"p2p_server[port:{self.port}] process terminated")
+        self.client.close()
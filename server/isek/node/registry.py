@@ -1,14 +1,45 @@
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Optional, Dict
+from typing import Optional, Dict, Callable, List
+
+from isek.util.logger import logger
+from isek.util.shard import shard_of
 
 
 class Registry(ABC):
 
+    def __init__(self, watch_interval: float = 5, heartbeat_interval: float = 5,
+                 shards: Optional[List[str]] = None):
+        # Shards (capabilities or regions) whose nodes this registry lists and watches, None for all.
+        self.shards = list(shards) if shards else None
+        self.watch_interval = watch_interval
+        self.watch_callbacks = []
+        self.watch_lock = threading.Lock()
+        # Held while callbacks run, so they see node lists one at a time and in order.
+        self.notify_lock = threading.Lock()
+        self.watch_thread = None
+        # Latest node list handed to watchers, so later watchers start from it without a fetch.
+        self.watched_nodes = None
+
+        # Nodes of this process whose leases the shared heartbeat thread renews.
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_node_ids = set()
+        self.heartbeat_lock = threading.Lock()
+        self.heartbeat_thread = None
+
     @abstractmethod
     def register_node(self, node_id: str, host: str, port: int,
                       p2p_address: Optional[str] = None,
-                      metadata: Optional[Dict[str, str]] = None):
-        """注册节点到注册中心"""
+                      metadata: Optional[Dict[str, str]] = None,
+                      shard: Optional[str] = None,
+                      vector: Optional[List[float]] = None):
+        """注册节点到注册中心
+
+        Args:
+            shard: capability or region the node is listed under.
+            vector: normalized intro embedding of the node, feeds its shard's centroid where the registry keeps one.
+        """
         pass
 
     @abstractmethod
@@ -24,3 +55,106 @@ class Registry(ABC):
     @abstractmethod
     def lease_refresh(self, node_id: str):
         pass
+
+    def get_shard_summaries(self) -> Dict[str, dict]:
+        """
+        {shard: {"count", "centroid"}} for routing a query to the shards worth listing. This default
+        derives counts from the listed nodes and has no centroids, registries with a summary layer override it.
+        """
+        summaries = {}
+        for node_info in self.get_available_nodes().values():
+            summary = summaries.setdefault(shard_of(node_info), {"count": 0, "centroid": None})
+            summary["count"] += 1
+        return summaries
+
+    def get_nodes_in_shards(self, shards: List[str]) -> Dict[str, dict]:
+        """Nodes of `shards`, which need not be among the watched ones."""
+        return {node_id: node_info for node_id, node_info in self.get_available_nodes().items()
+                if shard_of(node_info) in shards}
+
+    def lease_refresh_many(self, node_ids: List[str]):
+        """Renew the leases of several nodes, registries with a batch API override this with one request."""
+        for node_id in node_ids:
+            try:
+                self.lease_refresh(node_id)
+            except Exception:
+                logger.exception(f"Lease refresh failed for node {node_id}.")
+
+    def start_heartbeat(self, node_id: str):
+        """
+        Keep the lease of node_id alive. All nodes of one registry share a single heartbeat thread
+        that renews them together every `heartbeat_interval` seconds.
+        """
+        with self.heartbeat_lock:
+            self.heartbeat_node_ids.add(node_id)
+            if self.heartbeat_thread is None:
+                self.heartbeat_thread = threading.Thread(target=self.__heartbeat_loop, daemon=True)
+                self.heartbeat_thread.start()
+
+    def stop_heartbeat(self, node_id: str):
+        with self.heartbeat_lock:
+            self.heartbeat_node_ids.discard(node_id)
+
+    def __heartbeat_loop(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self.heartbeat_lock:
+                node_ids = list(self.heartbeat_node_ids)
+            if not node_ids:
+                continue
+            try:
+                self.lease_refresh_many(node_ids)
+            except Exception:
+                # Keep the heartbeat alive, the next round may re-register the nodes.
+                logger.exception("Registry heartbeat error.")
+
+    def watch(self, callback: Callable[[Dict[str, dict]], None]):
+        """
+        Call `callback` with the current node list right away, and again with the full node list
+        whenever membership changes. All callbacks of one registry share a single watch thread,
+        and the first call never overlaps a delivery of the watch thread nor follows a newer one.
+        """
+        with self.watch_lock:
+            nodes = self.watched_nodes
+        fetched = self.get_available_nodes() if nodes is None else None
+        with self.notify_lock:
+            with self.watch_lock:
+                if self.watched_nodes is None:
+                    self.watched_nodes = fetched
+                # the latest list, a delivery during the fetch may have replaced it
+                nodes = self.watched_nodes
+                self.watch_callbacks.append(callback)
+                if self.watch_thread is None:
+                    self.watch_thread = threading.Thread(target=self._watch_loop, daemon=True)
+                    self.watch_thread.start()
+            callback(nodes)
+
+    def unwatch(self, callback: Callable[[Dict[str, dict]], None]):
+        with self.watch_lock:
+            if callback in self.watch_callbacks:
+                self.watch_callbacks.remove(callback)
+
+    def _notify_watchers(self, nodes: Dict[str, dict]):
+        with self.notify_lock:
+            with self.watch_lock:
+                self.watched_nodes = nodes
+                callbacks = list(self.watch_callbacks)
+            for callback in callbacks:
+                try:
+                    callback(nodes)
+                except Exception:
+                    logger.exception(f"Registry watch callback {callback} error.")
+
+    def _watch_loop(self):
+        """Fallback for registries without change notification: poll every `watch_interval` seconds."""
+        last_nodes = None
+        while True:
+            time.sleep(self.watch_interval)
+            try:
+                nodes = self.get_available_nodes()
+            except Exception:
+                logger.exception("Registry watch poll error.")
+                continue
+            if nodes != last_nodes:
+                last_nodes = nodes
+                self._notify_watchers(nodes)
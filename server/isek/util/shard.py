@@ -0,0 +1,7 @@
+# Shard of nodes that register without one.
+DEFAULT_SHARD = "default"
+
+
+def shard_of(node_info: dict) -> str:
+    """The shard (capability or region) a node is listed under, for registries and the isek center alike."""
+    return node_info.get("shard") or DEFAULT_SHARD
@@ -66,6 +66,24 @@ def split_list(input_list, chunk_size):
     return [input_list[i:i + chunk_size] for i in range(0, len(input_list), chunk_size)]
 
 
+def split_batches(input_list, max_items, max_tokens, token_counter):
+    """Split into consecutive batches holding at most `max_items` items and `max_tokens` tokens each."""
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for item in input_list:
+        tokens = token_counter(item)
+        if batch and (len(batch) >= max_items or batch_tokens + tokens > max_tokens):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(item)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
 def md5(source):
     return hashlib.md5(source.encode()).hexdigest()
 
@@ -54,7 +54,7 @@ class P2PNode {
   constructor(name) {
     this.name = name
     this.handlers = {
-      '/query': async (body) => {
+      '/query': async (body, { sender, receiver } = {}) => {
         const client = new isekNodeProto.IsekP2PNodeService(`localhost:${isek_agent_port}`, grpc.credentials.createInsecure());
 
         const callPeerAsync = (request) => {
@@ -70,8 +70,9 @@ class P2PNode {
 
         try {
           const reply = await callPeerAsync({
-            senderNodeId: 'sender_node_id',
-            receiverP2pAddress: 'receiver_p2p_address',
+            senderNodeId: sender || 'sender_node_id',
+            // names the node to deliver to when several nodes share this p2p server
+            receiverP2pAddress: receiver ? `${this.listenAddress}#${receiver}` : 'receiver_p2p_address',
             message: body,
           });
     
@@ -133,8 +134,10 @@ class P2PNode {
     })
     this.node.addEventListener('self:peer:update', () => {
       this.node.getMultiaddrs().forEach(ma => {
-        if (ma.toString() == `${RELAY_ADDRESS}/p2p-circuit/p2p/${this.peerId}`) {
+        if (ma.toString() == `${RELAY_ADDRESS}/p2p-circuit/p2p/${this.peerId}` && this.listenAddress != ma.toString()) {
           this.listenAddress = ma.toString()
+          // the python node caches the context and replaces it from this line (see isek/node/p2p_client.py)
+          console.log(`ISEK_P2P_CONTEXT ${JSON.stringify({ peer_id: this.peerId, p2p_address: this.listenAddress })}`)
         }
         console.log(`Listening on ${ma.toString()}`)
       })
@@ -186,7 +189,7 @@ class P2PNode {
     try {
       const lp = lpStream(stream)
       const req = await lp.read()
-      const { path, body } = JSON.parse(new TextDecoder().decode(req.subarray()))
+      const { path, body, sender, receiver } = JSON.parse(new TextDecoder().decode(req.subarray()))
 
       console.log(`Received request: ${path}`)
 
@@ -194,7 +197,7 @@ class P2PNode {
       let response
 
       if (handler) {
-        response = await handler(body)
+        response = await handler(body, { sender, receiver })
       } else {
         response = { error: 'Not Found', status: 404 }
       }
@@ -205,12 +208,14 @@ class P2PNode {
     }
   }
 
-  async callPeer(remoteAddrs, body) {
-    const ma = multiaddr(remoteAddrs)
+  async callPeer(remoteAddrs, body, sender) {
+    // a node sharing its p2p server with others is addressed as <multiaddr>#<node_id>
+    const [address, receiver] = remoteAddrs.toString().split('#')
+    const ma = multiaddr(address)
     const stream = await this.node.dialProtocol(ma, CHAT_PROTOCOL, { runOnLimitedConnection: true })
     const lp = lpStream(stream)
 
-    await lp.write(new TextEncoder().encode(JSON.stringify({ path: QUERY_PATH, body: body })))
+    await lp.write(new TextEncoder().encode(JSON.stringify({ path: QUERY_PATH, body: body, sender: sender, receiver: receiver })))
     const res = await lp.read()
     return JSON.parse(new TextDecoder().decode(res.subarray()))
   }
@@ -251,7 +256,15 @@ const n = new P2PNode("node_name");
 // 实现服务
 const callPeer = async (call, callback) => {
   const { senderNodeId, receiverP2pAddress, message } = call.request;
-  const reply = await n.callPeer(receiverP2pAddress, message)
+  let reply
+  try {
+    reply = await n.callPeer(receiverP2pAddress, message, senderNodeId)
+  } catch (err) {
+    // an unreachable peer or a broken stream fails this call, not the sidecar process
+    console.error(`callPeer to ${receiverP2pAddress} failed:`, err)
+    callback({ code: grpc.status.UNAVAILABLE, details: `callPeer to ${receiverP2pAddress} failed: ${err.message}` })
+    return
+  }
   console.log(`Received callPeer request: message=${message} senderNodeId=${senderNodeId}, receiverP2pAddress=${receiverP2pAddress}`);
   callback(null, {
     reply: JSON.stringify(reply)